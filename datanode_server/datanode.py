@@ -3,18 +3,23 @@ import time
 import socket
 import threading
 from functions_datanode import *
+from peer_server import start_peer_server_bg
 import requests
 
-# CLI: python datanode.py [<namenode_host>] [<namenode_port>] [<task_listen_port>]
+# CLI: python datanode.py [<namenode_host>] [<namenode_port>] [<task_listen_port>] [<slots>] [<peer_port>]
 NAMENODE_HOST      = sys.argv[1] if len(sys.argv) > 1 else '127.0.0.1'
 NAMENODE_PORT      = int(sys.argv[2]) if len(sys.argv) > 2 else 5001
 TASK_LISTEN_PORT   = int(sys.argv[3]) if len(sys.argv) > 3 else 7000
+TASK_SLOTS         = int(sys.argv[4]) if len(sys.argv) > 4 else 2   # số task chạy đồng thời
+PEER_PORT          = int(sys.argv[5]) if len(sys.argv) > 5 else TASK_LISTEN_PORT + 1  # HTTP cho DataNode khác
 HEARTBEAT_INTERVAL = 10  # seconds
 
 def main():
     # Khởi động background listener nhận task từ NameNode (luôn chạy)
-    start_task_listener_bg(listen_host='0.0.0.0', listen_port=TASK_LISTEN_PORT)
+    start_task_listener_bg(listen_host='0.0.0.0', listen_port=TASK_LISTEN_PORT, slots=TASK_SLOTS)
     print(f"[DataNode] Task listener started on 0.0.0.0:{TASK_LISTEN_PORT}")
+    # Peer server: DataNode khác kéo partition shuffle + replica block trực tiếp từ đây
+    start_peer_server_bg(listen_host='0.0.0.0', listen_port=PEER_PORT)
 
     # Kết nối tới NameNode để đăng ký + heartbeat
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
@@ -24,20 +29,24 @@ def main():
         node_id = f"{local_ip}:{TASK_LISTEN_PORT}"
         print(f"[DataNode] My node_id = {node_id}")
 
-        # Gửi register
-        resp = send_message(sock, {"type": "register", "id": node_id})
+        # Gửi register kèm block report (block đã có trên đĩa từ lần chạy trước)
+        inventory = BlockInventory()
+        register = lambda: send_message(sock, {"type": "register", "id": node_id, "slots": TASK_SLOTS,
+                                               "peer_port": PEER_PORT, "blocks": inventory.full_report()})
+        resp = register()
+        inventory.commit()
         print(f"[DataNode] register → {resp}")
 
-        download_block(server_ip ="192.168.1.14", 
-                   server_port = 5000, 
-                   file_base = "alogs", 
-                   block_id = "alogs_block1.csv", 
-                   dest_dir = os.path.join("task", "alogs.csv"))
-
-        # Heartbeat loop
+        # Heartbeat loop: kèm delta block report (block mới tải / nhận replica / bị xóa)
         while True:
             time.sleep(HEARTBEAT_INTERVAL)
-            resp = send_message(sock, {"type": "heartbeat", "id": node_id})
+            delta = inventory.delta()
+            resp = send_message(sock, {"type": "heartbeat", "id": node_id,
+                                       **{k: v for k, v in delta.items() if v}})
+            if resp.get('status') == 'unknown_node':
+                # NameNode đã restart / coi node là chết → register lại với full report
+                resp = register()
+            inventory.commit()
             print(f"[DataNode] heartbeat → {resp}")
         
         
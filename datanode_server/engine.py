@@ -0,0 +1,425 @@
+# engine.py
+# Engine thực thi block của DataNode (task role 'leader').
+# Pipeline toán tử trên 1 block CSV: scan → filter → project | group-by + aggregate.
+#   - scan đọc CSV theo batch lớn (BATCH_ROWS dòng) và chuyển thành mảng theo cột,
+#     không tạo dict cho từng dòng
+#   - cột số được parse sang float64 (NumPy nếu có, không thì array('d')) khi cần
+#   - filter/aggregate chạy trên cả cột; NumPy là tùy chọn, thiếu thì dùng kernel Python
+#
+# Plan (dict):
+#   {
+#     'filters':    [{'column': 'status', 'op': '==', 'value': '200'}, ...],   # AND
+#     'columns':    ['host', 'bytes'],          # projection khi không có aggregates
+#     'group_by':   ['host'],
+#     'aggregates': [{'op': 'count'}, {'op': 'sum', 'column': 'bytes'}, ...],
+#   }
+#   op filter   : == != < <= > >= in   (value là số → so sánh số, chuỗi → so sánh chuỗi)
+#   op aggregate: count sum min max avg   (count(column) đếm ô không rỗng, cả cột chuỗi)
+# Block có thể được lưu nén (codec chọn theo file lúc upload: gzip / lzma / bz2);
+# scan giải nén dạng stream, không bung cả block ra đĩa hay bộ nhớ.
+# Kết quả aggregate của 1 block là kết quả *từng phần* (avg ghi cả sum và count)
+# để có thể gộp với block khác; thứ tự dòng theo khóa group.
+#
+# Shuffle (job có group_by): map ghi kết quả từng phần đã combine của block thành
+# `partitions` file theo hash khóa group (partition_of); reduce gộp file cùng
+# partition từ mọi block bằng merge k-way (Pipeline.merge) — mỗi node giữ 1 dải khóa.
+
+import bz2
+import csv
+import gzip
+import heapq
+import itertools
+import lzma
+import math
+import operator
+import os
+import zlib
+from array import array
+
+from aggstate import init_state, merge_state, parse_state, state_cells, state_columns
+
+try:
+    import numpy as np
+except ImportError:  # NumPy là tùy chọn
+    np = None
+
+BATCH_ROWS = 64 * 1024
+
+DEFAULT_PLAN = {'aggregates': [{'op': 'count'}]}
+
+FILTER_OPS = {
+    '==': operator.eq, '!=': operator.ne,
+    '<': operator.lt, '<=': operator.le,
+    '>': operator.gt, '>=': operator.ge,
+}
+AGG_OPS = ('count', 'sum', 'min', 'max', 'avg')
+
+
+def _parse_float(s: str) -> float:
+    try:
+        return float(s)
+    except ValueError:
+        return math.nan
+
+
+# ─── Batch (cột) ─────────────────────────────────────────────────────────────
+
+class Batch:
+    """
+    1 batch dòng của block, lưu theo cột.
+    raw(name)     : cột chuỗi gốc (ndarray str hoặc tuple)
+    numeric(name) : cột float64, ô rỗng / không phải số → NaN (parse 1 lần, có cache)
+    """
+
+    def __init__(self, columns: dict, nrows: int):
+        self._raw = columns
+        self._num = {}
+        self.nrows = nrows
+
+    def raw(self, name: str):
+        try:
+            return self._raw[name]
+        except KeyError:
+            raise KeyError(f"column '{name}' not in block") from None
+
+    def numeric(self, name: str):
+        col = self._num.get(name)
+        if col is None:
+            raw = self.raw(name)
+            if np is not None:
+                try:
+                    col = np.where(raw == '', 'nan', raw).astype(np.float64)
+                except ValueError:
+                    col = np.fromiter(map(_parse_float, raw), np.float64, len(raw))
+            else:
+                col = array('d', map(_parse_float, raw))
+            self._num[name] = col
+        return col
+
+    def take(self, mask) -> 'Batch':
+        """Giữ các dòng có mask True."""
+        if np is not None:
+            cols = {k: v[mask] for k, v in self._raw.items()}
+            nrows = int(mask.sum())
+        else:
+            cols = {k: tuple(itertools.compress(v, mask)) for k, v in self._raw.items()}
+            nrows = sum(mask)
+        return Batch(cols, nrows)
+
+
+# codec → hàm mở file nén ở chế độ text; magic bytes dùng khi không biết codec
+_CODEC_OPENERS = {'gzip': gzip.open, 'zlib': gzip.open, 'lzma': lzma.open, 'bz2': bz2.open}
+_CODEC_MAGIC = ((b'\x1f\x8b', 'gzip'), (b'\xfd7zXZ\x00', 'lzma'), (b'BZh', 'bz2'))
+
+
+def _sniff_codec(path: str) -> str:
+    with open(path, 'rb') as f:
+        head = f.read(6)
+    return next((codec for magic, codec in _CODEC_MAGIC if head.startswith(magic)), 'none')
+
+
+def open_block(path: str, codec: str = None):
+    """
+    Mở block ở chế độ text (utf-8, newline='' cho csv), giải nén dạng stream theo codec.
+    codec None → đoán theo magic bytes đầu file; 'none' → file CSV thường.
+    """
+    if codec is None:
+        codec = _sniff_codec(path)
+    opener = _CODEC_OPENERS.get(codec)
+    if opener is None:
+        return open(path, 'r', encoding='utf-8', newline='')
+    return opener(path, 'rt', encoding='utf-8', newline='')
+
+
+def scan(path: str, batch_rows: int = BATCH_ROWS, codec: str = None):
+    """
+    Toán tử scan: đọc block CSV (có thể nén, xem open_block),
+    yield (header, Batch) theo từng batch_rows dòng. Dòng có số ô khác header bị bỏ qua.
+    """
+    with open_block(path, codec) as f:
+        reader = csv.reader(f)
+        header = next(reader, None)
+        if not header:
+            return
+        ncols = len(header)
+        while True:
+            rows = list(itertools.islice(reader, batch_rows))
+            if not rows:
+                break
+            if len(set(map(len, rows))) != 1 or len(rows[0]) != ncols:
+                rows = [r for r in rows if len(r) == ncols]
+                if not rows:
+                    continue
+            cols = zip(*rows)   # chuyển vị dòng → cột ở tốc độ C
+            if np is not None:
+                columns = {name: np.asarray(col) for name, col in zip(header, cols)}
+            else:
+                columns = dict(zip(header, cols))
+            yield header, Batch(columns, len(rows))
+
+
+# ─── Filter ──────────────────────────────────────────────────────────────────
+
+def _predicate_mask(batch: Batch, flt: dict):
+    col, op, value = flt['column'], flt['op'], flt['value']
+    if op == 'in':
+        values = list(value)
+        if all(isinstance(v, (int, float)) for v in values):
+            data, values = batch.numeric(col), [float(v) for v in values]
+        else:
+            data, values = batch.raw(col), [str(v) for v in values]
+        if np is not None:
+            return np.isin(data, values)
+        wanted = set(values)
+        return [x in wanted for x in data]
+    fn = FILTER_OPS[op]
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        data, value = batch.numeric(col), float(value)
+    else:
+        data, value = batch.raw(col), str(value)
+    if np is not None:
+        return fn(data, value)
+    return [fn(x, value) for x in data]
+
+
+def apply_filters(batch: Batch, filters: list) -> Batch:
+    """Toán tử filter: AND của mọi điều kiện."""
+    if not filters:
+        return batch
+    mask = None
+    for flt in filters:
+        m = _predicate_mask(batch, flt)
+        if mask is None:
+            mask = m
+        elif np is not None:
+            mask &= m
+        else:
+            mask = [a and b for a, b in zip(mask, m)]
+    return batch.take(mask)
+
+
+# ─── Aggregate ───────────────────────────────────────────────────────────────
+
+def partition_of(key: tuple, partitions: int) -> int:
+    """Partition của 1 khóa group; crc32 ổn định giữa các process/máy (khác hash())."""
+    return zlib.crc32('\x1f'.join(key).encode('utf-8')) % partitions
+
+
+def _group_codes_np(batch: Batch, group_by: list):
+    """Mã nhóm (0..G-1) cho từng dòng + danh sách khóa tuple của G nhóm."""
+    if not group_by:
+        return np.zeros(batch.nrows, dtype=np.int64), [()]
+    uniques, codes = [], None
+    for name in group_by:
+        u, inv = np.unique(batch.raw(name), return_inverse=True)
+        uniques.append(u)
+        inv = inv.astype(np.int64).ravel()
+        codes = inv if codes is None else codes * len(u) + inv
+    combo, codes = np.unique(codes, return_inverse=True)
+    keys = []
+    for c in combo.tolist():
+        parts = []
+        for u in reversed(uniques):
+            c, r = divmod(c, len(u))
+            parts.append(str(u[r]))
+        keys.append(tuple(reversed(parts)))
+    return codes.ravel(), keys
+
+
+def _partials_np(batch: Batch, codes, ngroups: int, agg: dict) -> list:
+    """Trạng thái từng phần của 1 aggregate cho mỗi nhóm, tính bằng kernel NumPy."""
+    op, col = agg['op'], agg.get('column')
+    if op == 'count':
+        if not col:
+            return np.bincount(codes, minlength=ngroups).tolist()
+        # count(col) đếm ô không rỗng, kể cả cột chuỗi (không qua numeric())
+        return np.bincount(codes, weights=batch.raw(col) != '',
+                           minlength=ngroups).astype(np.int64).tolist()
+    vals = batch.numeric(col)
+    valid = ~np.isnan(vals)
+    cnt = np.bincount(codes, weights=valid, minlength=ngroups)
+    if op in ('sum', 'avg'):
+        sums = np.bincount(codes, weights=np.where(valid, vals, 0.0), minlength=ngroups).tolist()
+        if op == 'sum':
+            return sums
+        return [[s, int(c)] for s, c in zip(sums, cnt.tolist())]
+    out = np.full(ngroups, np.nan)
+    (np.fmin if op == 'min' else np.fmax).at(out, codes, vals)
+    return [None if math.isnan(v) else v for v in out.tolist()]
+
+
+def _aggregate_batch_py(batch: Batch, group_by: list, aggregates: list, groups: dict):
+    """Kernel Python thuần khi không có NumPy: 1 vòng qua các dòng của batch."""
+    keys = zip(*[batch.raw(k) for k in group_by]) if group_by else itertools.repeat((), batch.nrows)
+    # count(col) đếm ô không rỗng trên cột chuỗi gốc; sum/avg/min/max dùng cột số
+    cols = [None if not a.get('column') else
+            batch.raw(a['column']) if a['op'] == 'count' else batch.numeric(a['column'])
+            for a in aggregates]
+    for i, key in enumerate(keys):
+        accs = groups.get(key)
+        if accs is None:
+            accs = groups[key] = [init_state(a['op']) for a in aggregates]
+        for j, a in enumerate(aggregates):
+            op, col = a['op'], cols[j]
+            if col is None:
+                accs[j] += 1
+                continue
+            v = col[i]
+            if op == 'count':
+                if v != '':
+                    accs[j] += 1
+                continue
+            if v != v:      # NaN = null
+                continue
+            if op == 'sum':
+                accs[j] += v
+            elif op == 'avg':
+                accs[j][0] += v
+                accs[j][1] += 1
+            else:
+                accs[j] = merge_state(op, accs[j], v)
+
+
+def aggregate_batch(batch: Batch, group_by: list, aggregates: list, groups: dict):
+    """Toán tử group-by + aggregate: gộp batch vào `groups` { key_tuple: [acc, ...] }."""
+    if batch.nrows == 0:
+        return
+    if np is None:
+        _aggregate_batch_py(batch, group_by, aggregates, groups)
+        return
+    codes, keys = _group_codes_np(batch, group_by)
+    partials = [_partials_np(batch, codes, len(keys), a) for a in aggregates]
+    for g, key in enumerate(keys):
+        accs = groups.get(key)
+        if accs is None:
+            accs = groups[key] = [init_state(a['op']) for a in aggregates]
+        for j, a in enumerate(aggregates):
+            accs[j] = merge_state(a['op'], accs[j], partials[j][g])
+
+
+# ─── Plan ────────────────────────────────────────────────────────────────────
+
+class Pipeline:
+    """
+    Plan đã compile: chạy được trên nhiều block mà không phải phân tích lại plan.
+    """
+
+    def __init__(self, plan: dict):
+        self.filters = list(plan.get('filters') or [])
+        self.columns = list(plan.get('columns') or [])
+        self.group_by = list(plan.get('group_by') or [])
+        self.aggregates = list(plan.get('aggregates') or [])
+        for flt in self.filters:
+            if flt.get('op') not in FILTER_OPS and flt.get('op') != 'in':
+                raise ValueError(f"unknown filter op {flt.get('op')}")
+        for agg in self.aggregates:
+            if agg.get('op') not in AGG_OPS:
+                raise ValueError(f"unknown aggregate {agg.get('op')}")
+            if agg['op'] != 'count' and not agg.get('column'):
+                raise ValueError(f"aggregate {agg['op']} needs a column")
+
+    def output_header(self, header: list) -> list[str]:
+        if self.aggregates:
+            return self.group_by + [c for a in self.aggregates for c in state_columns(a)]
+        return self.columns or header
+
+    def _state_row(self, key: tuple, accs: list) -> list:
+        row = list(key)
+        for a, acc in zip(self.aggregates, accs):
+            row.extend(state_cells(a['op'], acc))
+        return row
+
+    def run(self, block_path: str, out_path: str, partitions: int = 0, codec: str = None) -> int:
+        """
+        Chạy pipeline trên 1 block, ghi kết quả CSV ra out_path. Trả về số dòng kết quả.
+        codec: codec nén của block (None → tự nhận theo magic bytes).
+        partitions > 0 (chỉ khi có group_by): out_path là thư mục, kết quả đã combine
+        được chia theo hash khóa vào <out_path>/<p>.csv, p = 0..partitions-1.
+        """
+        groups = {}
+        header = None
+        nrows = 0
+        if partitions and self.group_by and self.aggregates:
+            for header, batch in scan(block_path, codec=codec):
+                batch = apply_filters(batch, self.filters)
+                aggregate_batch(batch, self.group_by, self.aggregates, groups)
+            return self._write_partitions(groups, out_path, partitions)
+        header_written = False
+        with open(out_path, 'w', encoding='utf-8', newline='') as out:
+            writer = csv.writer(out)
+            for header, batch in scan(block_path, codec=codec):
+                batch = apply_filters(batch, self.filters)
+                if self.aggregates:
+                    aggregate_batch(batch, self.group_by, self.aggregates, groups)
+                    continue
+                if not header_written:
+                    # header đúng 1 lần, kể cả khi batch đầu bị lọc hết
+                    writer.writerow(self.output_header(header))
+                    header_written = True
+                cols = [batch.raw(c) for c in (self.columns or header)]
+                writer.writerows(zip(*cols))
+                nrows += batch.nrows
+            if self.aggregates:
+                if not self.group_by and not groups:
+                    # aggregate toàn bộ block rỗng vẫn có 1 dòng (count = 0)
+                    groups[()] = [init_state(a['op']) for a in self.aggregates]
+                writer.writerow(self.output_header(header or []))
+                writer.writerows(self._state_row(key, groups[key]) for key in sorted(groups))
+                nrows = len(groups)
+            elif not header_written and header is not None:
+                writer.writerow(self.output_header(header))
+        return nrows
+
+    def _write_partitions(self, groups: dict, out_dir: str, partitions: int) -> int:
+        """Combiner đã chạy (groups); chia theo partition, mỗi file sắp theo khóa."""
+        os.makedirs(out_dir, exist_ok=True)
+        parts = [[] for _ in range(partitions)]
+        for key in sorted(groups):
+            parts[partition_of(key, partitions)].append(self._state_row(key, groups[key]))
+        header = self.output_header([])
+        for p, rows in enumerate(parts):
+            # ghi cả partition rỗng để reducer luôn tìm thấy đủ file
+            with open(os.path.join(out_dir, f"{p}.csv"), 'w', encoding='utf-8', newline='') as out:
+                writer = csv.writer(out)
+                writer.writerow(header)
+                writer.writerows(rows)
+        return len(groups)
+
+    def merge(self, paths: list, out_path: str) -> int:
+        """
+        Gộp nhiều file kết quả từng phần (cùng plan, mỗi file đã sắp theo khóa group)
+        bằng merge k-way: bộ nhớ chỉ giữ 1 dòng / file, không phụ thuộc số dòng.
+        Kết quả vẫn là trạng thái từng phần. Trả về số nhóm.
+        """
+        ngroup = len(self.group_by)
+        files = [open(p, 'r', encoding='utf-8', newline='') for p in paths]
+        try:
+            readers = []
+            for f in files:
+                r = csv.reader(f)
+                next(r, None)       # header
+                readers.append(r)
+            merged = heapq.merge(*readers, key=lambda row: row[:ngroup])
+            nrows = 0
+            with open(out_path, 'w', encoding='utf-8', newline='') as out:
+                writer = csv.writer(out)
+                writer.writerow(self.output_header([]))
+                for key, rows in itertools.groupby(merged, key=lambda row: row[:ngroup]):
+                    accs = [init_state(a['op']) for a in self.aggregates]
+                    for row in rows:
+                        i = ngroup
+                        for j, a in enumerate(self.aggregates):
+                            width = len(state_columns(a))
+                            part = parse_state(a['op'], row[i:i + width])
+                            accs[j] = merge_state(a['op'], accs[j], part)
+                            i += width
+                    writer.writerow(self._state_row(tuple(key), accs))
+                    nrows += 1
+            return nrows
+        finally:
+            for f in files:
+                f.close()
+
+
+def compile_plan(plan: dict = None) -> Pipeline:
+    return Pipeline(plan or DEFAULT_PLAN)
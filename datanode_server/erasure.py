@@ -0,0 +1,69 @@
+# erasure.py
+# Erasure coding XOR k=2 + m=1 cho chế độ lưu trữ 'erasure' của file:
+#   block (đúng byte như trên đĩa, kể cả khi đã nén) được chia làm 2 nửa d0, d1
+#   (d1 đệm 0 cho bằng độ dài d0), parity p = d0 XOR d1.
+#   3 fragment nằm trên 3 DataNode khác nhau: tổng 1.5x kích thước block thay vì 2x
+#   của 2 follower giữ nguyên block; mất 1 fragment bất kỳ vẫn dựng lại được từ 2 cái còn lại.
+# Fragment i của block lưu ở storage/<file_base>/<block_id>.ec<i>.
+
+EC_DATA_FRAGMENTS = 2
+EC_PARITY_FRAGMENTS = 1
+EC_FRAGMENTS = EC_DATA_FRAGMENTS + EC_PARITY_FRAGMENTS
+FRAGMENT_SUFFIX = '.ec'
+
+
+def fragment_name(block_id: str, index: int) -> str:
+    return f"{block_id}{FRAGMENT_SUFFIX}{index}"
+
+
+def parse_fragment_name(name: str):
+    """'<block_id>.ec<i>' → (block_id, i); tên khác → None."""
+    block_id, sep, index = name.rpartition(FRAGMENT_SUFFIX)
+    if not sep or not block_id or not index.isdigit() or int(index) >= EC_FRAGMENTS:
+        return None
+    return block_id, int(index)
+
+
+def fragment_size(nbytes: int) -> int:
+    """Kích thước mỗi fragment của block nbytes byte."""
+    return (nbytes + EC_DATA_FRAGMENTS - 1) // EC_DATA_FRAGMENTS
+
+
+def _xor(a: bytes, b: bytes) -> bytes:
+    # XOR trên số nguyên lớn: chạy ở tốc độ C, không lặp từng byte trong Python
+    return (int.from_bytes(a, 'little') ^ int.from_bytes(b, 'little')).to_bytes(len(a), 'little')
+
+
+def encode(data: bytes) -> list[bytes]:
+    """Block → [d0, d1, parity], mỗi fragment fragment_size(len(data)) byte."""
+    size = fragment_size(len(data))
+    d0 = data[:size]
+    d1 = data[size:].ljust(size, b'\0')
+    return [d0, d1, _xor(d0, d1)]
+
+
+def decode(fragments: dict, nbytes: int) -> bytes:
+    """
+    Dựng lại block nbytes byte từ ít nhất EC_DATA_FRAGMENTS fragment { index: bytes }.
+    Raise ValueError nếu không đủ fragment hoặc fragment sai kích thước.
+    """
+    size = fragment_size(nbytes)
+    if any(len(frag) != size for frag in fragments.values()):
+        raise ValueError(f"fragment size mismatch (expected {size} bytes)")
+    if 0 in fragments and 1 in fragments:
+        d0, d1 = fragments[0], fragments[1]
+    elif 2 in fragments and (0 in fragments or 1 in fragments):
+        known = 0 if 0 in fragments else 1
+        other = _xor(fragments[known], fragments[2])
+        d0, d1 = (fragments[0], other) if known == 0 else (other, fragments[1])
+    else:
+        raise ValueError(f"need {EC_DATA_FRAGMENTS} of {EC_FRAGMENTS} fragments, "
+                         f"have {sorted(fragments)}")
+    return (d0 + d1)[:nbytes]
+
+
+def rebuild_fragment(fragments: dict, index: int, nbytes: int) -> bytes:
+    """Fragment `index` dựng lại từ các fragment còn lại (ít nhất EC_DATA_FRAGMENTS cái)."""
+    if index in fragments:
+        return fragments[index]
+    return encode(decode(fragments, nbytes))[index]
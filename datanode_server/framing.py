@@ -0,0 +1,116 @@
+# framing.py
+# Framing có tiền tố độ dài cho message giữa upload server, NameNode và DataNode.
+# Mỗi frame: [4 byte độ dài payload, big-endian][1 byte codec][payload]
+#   codec 0 = JSON UTF-8
+#   codec 1 = msgpack (gọn hơn, chỉ dùng được khi đã `pip install msgpack`)
+# Bên nhận giải mã theo byte codec của từng frame nên 2 codec dùng lẫn được.
+# File này có bản sao giống hệt ở namenode/, datanode_server/ và server/functions/ (mỗi thành phần
+# chạy độc lập từ thư mục của mình): sửa mọi bản cùng lúc, tests/test_shared_modules.py
+# kiểm tra các bản giống nhau.
+
+import asyncio
+import json
+import struct
+
+try:
+    import msgpack
+except ImportError:  # msgpack là tùy chọn
+    msgpack = None
+
+HEADER = struct.Struct('>IB')
+CODEC_JSON = 0
+CODEC_MSGPACK = 1
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+# Codec dùng khi gửi; đổi thành CODEC_MSGPACK để dùng encoding nhị phân
+DEFAULT_CODEC = CODEC_JSON
+
+
+class FrameError(ValueError):
+    """Frame sai định dạng (độ dài vượt giới hạn, codec lạ, payload hỏng)."""
+
+
+def encode_frame(msg: dict, codec: int = None) -> bytes:
+    """Đóng gói 1 message thành bytes của 1 frame."""
+    codec = DEFAULT_CODEC if codec is None else codec
+    if codec == CODEC_MSGPACK and msgpack is not None:
+        payload = msgpack.packb(msg, use_bin_type=True)
+    else:
+        codec = CODEC_JSON
+        payload = json.dumps(msg, separators=(',', ':')).encode('utf-8')
+    if len(payload) > MAX_FRAME_SIZE:
+        raise FrameError(f"frame quá lớn: {len(payload)} bytes")
+    return HEADER.pack(len(payload), codec) + payload
+
+
+def _check_header(header: bytes) -> tuple[int, int]:
+    length, codec = HEADER.unpack(header)
+    if length > MAX_FRAME_SIZE:
+        raise FrameError(f"frame quá lớn: {length} bytes")
+    return length, codec
+
+
+def decode_payload(codec: int, payload: bytes) -> dict:
+    """Giải mã payload theo codec ghi trong header."""
+    try:
+        if codec == CODEC_JSON:
+            return json.loads(payload.decode('utf-8'))
+        if codec == CODEC_MSGPACK and msgpack is not None:
+            return msgpack.unpackb(payload, raw=False)
+    except Exception as e:
+        raise FrameError(f"payload hỏng: {e}") from e
+    raise FrameError(f"codec không hỗ trợ: {codec}")
+
+
+# ─── Socket blocking ─────────────────────────────────────────────────────────
+
+def _recv_exact(sock, n: int) -> bytes:
+    """Đọc đúng n byte; trả về b'' nếu bên kia đóng kết nối trước khi gửi byte nào."""
+    buf = bytearray()
+    while len(buf) < n:
+        chunk = sock.recv(n - len(buf))
+        if not chunk:
+            if buf:
+                raise ConnectionError("kết nối đóng giữa chừng 1 frame")
+            return b''
+        buf += chunk
+    return bytes(buf)
+
+
+def send_frame(sock, msg: dict, codec: int = None):
+    sock.sendall(encode_frame(msg, codec))
+
+
+def recv_frame(sock):
+    """Đọc 1 frame từ socket. Trả về dict, hoặc None nếu kết nối đã đóng."""
+    header = _recv_exact(sock, HEADER.size)
+    if not header:
+        return None
+    length, codec = _check_header(header)
+    payload = _recv_exact(sock, length) if length else b''
+    if length and not payload:
+        raise ConnectionError("kết nối đóng giữa chừng 1 frame")
+    return decode_payload(codec, payload)
+
+
+# ─── asyncio streams ─────────────────────────────────────────────────────────
+
+async def read_frame(reader):
+    """Đọc 1 frame từ asyncio.StreamReader. Trả về dict, hoặc None khi EOF."""
+    try:
+        header = await reader.readexactly(HEADER.size)
+    except asyncio.IncompleteReadError as e:
+        if not e.partial:
+            return None
+        raise ConnectionError("kết nối đóng giữa chừng 1 frame") from e
+    length, codec = _check_header(header)
+    try:
+        payload = await reader.readexactly(length)
+    except asyncio.IncompleteReadError as e:
+        raise ConnectionError("kết nối đóng giữa chừng 1 frame") from e
+    return decode_payload(codec, payload)
+
+
+async def write_frame(writer, msg: dict, codec: int = None):
+    writer.write(encode_frame(msg, codec))
+    await writer.drain()
@@ -2,10 +2,21 @@
 
 import socket
 import threading
+import functools
 import json
+import time
 import os
+import random
+import shutil
+import struct
+import zlib
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 import requests
 
+from engine import compile_plan
+from erasure import EC_FRAGMENTS, decode, encode, fragment_name, parse_fragment_name, rebuild_fragment
+from framing import send_frame, recv_frame
+
 # Cấu hình địa chỉ của Upload-Server (có thể override từ datanode.py nếu cần)
 UPLOAD_SERVER_HOST = '127.0.0.1'
 UPLOAD_SERVER_PORT = 5000
@@ -19,59 +30,597 @@ def get_local_node_id(sock: socket.socket) -> str:
 
 def send_message(sock: socket.socket, msg: dict) -> dict:
     """
-    Gửi 1 dict (JSON) qua socket, nhận về dict (JSON) response.
+    Gửi 1 dict qua socket (1 frame, xem framing.py), nhận về dict response.
+    """
+    send_frame(sock, msg)
+    resp = recv_frame(sock)
+    if resp is None:
+        raise ConnectionError("NameNode đã đóng kết nối")
+    return resp
+
+def file_crc32(path: str, chunk_size: int = 1024 * 1024) -> int:
+    """CRC32 của cả file, cùng cách tính với manifest của splitter."""
+    crc = 0
+    with open(path, 'rb') as f:
+        while True:
+            buf = f.read(chunk_size)
+            if not buf:
+                return crc
+            crc = zlib.crc32(buf, crc)
+
+
+def block_intact(path: str, nbytes: int = None, crc: int = None) -> bool:
+    """
+    True nếu file block ở path khớp manifest (kích thước rồi CRC32).
+    Không có manifest (nbytes/crc None) thì không kiểm tra được → False.
     """
-    data = json.dumps(msg).encode('utf-8')
-    sock.sendall(data)
-    raw = sock.recv(4096)
+    if nbytes is None or crc is None:
+        return False
     try:
-        return json.loads(raw.decode('utf-8'))
-    except Exception:
-        return {"_raw": raw.decode('utf-8')}
+        if os.path.getsize(path) != nbytes:
+            return False
+        return file_crc32(path) == crc
+    except OSError:
+        return False
+
+
+# ─── Block inventory ─────────────────────────────────────────────────────────
+# Block DataNode đang giữ trên đĩa, báo cho NameNode để không phải tải lại sau khi restart:
+#   register : full report  'blocks': [[dir, block_id, crc32], ...]
+#   heartbeat: delta        'added': [[dir, block_id, crc32], ...], 'removed': [[dir, block_id], ...]
+# dir là 'task' (bản leader đã tải), 'storage' (replica follower) hoặc 'ec<i>'
+# (fragment i của block file erasure-coded, storage/<file_base>/<block_id>.ec<i>).
+
+INVENTORY_DIRS = ('task', 'storage')
+_TEMP_SUFFIXES = ('.part', '.etag', '.replica')
+
+
+class BlockInventory:
+    """
+    Quét task/<file_base>/<block_id> và storage/<file_base>/<block_id>; block có
+    block_id không thuộc file_base của thư mục không được báo.
+    CRC32 chỉ tính lại cho file mới hoặc đã đổi (size / mtime), nên quét mỗi heartbeat rẻ.
+    Delta tính so với lần báo gần nhất NameNode đã nhận (commit()), nên heartbeat lỗi
+    thì lần sau báo lại đủ.
+    """
+
+    def __init__(self, dirs=INVENTORY_DIRS):
+        self.dirs = dirs
+        self._crc_cache = {}       # { path: ((size, mtime_ns), crc32) }
+        self._reported = {}        # { (dir, block_id): crc32 } NameNode đã nhận
+        self._pending = {}         # kết quả quét gần nhất, chờ commit()
+
+    def scan(self) -> dict:
+        found, cache = {}, {}
+        for top in self.dirs:
+            if not os.path.isdir(top):
+                continue
+            for file_base in os.listdir(top):
+                sub = os.path.join(top, file_base)
+                if not os.path.isdir(sub):
+                    continue
+                for name in os.listdir(sub):
+                    if name.endswith(_TEMP_SUFFIXES):
+                        continue
+                    frag = parse_fragment_name(name) if top == 'storage' else None
+                    blk = frag[0] if frag else name
+                    if blk.rsplit('_block', 1)[0] != file_base:
+                        # block nằm sai thư mục: peer tìm ở <top>/<file_base của block>/ → 404
+                        continue
+                    path = os.path.join(sub, name)
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        continue
+                    key = (st.st_size, st.st_mtime_ns)
+                    cached = self._crc_cache.get(path)
+                    crc = cached[1] if cached and cached[0] == key else file_crc32(path)
+                    cache[path] = (key, crc)
+                    found[(f"ec{frag[1]}", blk) if frag else (top, blk)] = crc
+        self._crc_cache = cache
+        return found
+
+    def full_report(self) -> list:
+        """Toàn bộ block đang có, gửi kèm register."""
+        self._pending = self.scan()
+        return [[top, blk, crc] for (top, blk), crc in sorted(self._pending.items())]
+
+    def delta(self) -> dict:
+        """Block thêm / đổi / mất từ lần báo trước, gửi kèm heartbeat."""
+        now = self.scan()
+        self._pending = now
+        return {
+            'added': [[top, blk, crc] for (top, blk), crc in sorted(now.items())
+                      if self._reported.get((top, blk)) != crc],
+            'removed': [[top, blk] for (top, blk) in sorted(self._reported) if (top, blk) not in now],
+        }
+
+    def commit(self):
+        """NameNode đã nhận report / delta gần nhất."""
+        self._reported = self._pending
+
+
+DOWNLOAD_RETRIES = 5          # số lần thử tải 1 block
+DOWNLOAD_BACKOFF = 0.5        # seconds, nhân đôi sau mỗi lần lỗi (+ jitter)
+DOWNLOAD_TIMEOUT = (5, 30)    # (connect, read) seconds
+DOWNLOAD_CHUNK   = 256 * 1024
+
+_download_locks = {}          # { local_path: Lock } để 2 task cùng block không ghi chung 1 file .part
+_download_locks_guard = threading.Lock()
+
+
+def _path_lock(path: str) -> threading.Lock:
+    with _download_locks_guard:
+        return _download_locks.setdefault(path, threading.Lock())
+
+
+def _fetch_into_part(url: str, part_path: str, forward=None) -> int:
+    """
+    1 lần tải vào file .part, tiếp tục từ byte cuối đã có bằng header Range.
+    Server không hỗ trợ Range (trả 200) thì ghi lại từ đầu.
+    forward: ChainForwarder — mỗi chunk vừa ghi được đẩy tiếp xuống hop sau của chain.
+    Trả về CRC32 của toàn bộ file .part sau khi tải.
+    Lỗi mạng / HTTP được raise để download_block thử lại.
+    """
+    etag_path = part_path + '.etag'
+    have = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    headers = {}
+    if have:
+        headers['Range'] = f"bytes={have}-"
+        if os.path.exists(etag_path):
+            # If-Range: block trên server đã đổi thì server trả cả file (200) thay vì phần tiếp
+            with open(etag_path) as f:
+                headers['If-Range'] = f.read().strip()
+    with requests.get(url, stream=True, headers=headers, timeout=DOWNLOAD_TIMEOUT) as resp:
+        if resp.status_code == 416:
+            # phần đã có dài hơn (hoặc bằng) file trên server → tải lại từ đầu
+            os.remove(part_path)
+            raise IOError(f"range {have}- not satisfiable, restarting")
+        resp.raise_for_status()
+        if resp.status_code == 206:
+            crc = file_crc32(part_path)
+            mode, pos = 'ab', have
+        else:
+            crc, mode, pos = 0, 'wb', 0
+            etag = resp.headers.get('ETag')
+            if etag:
+                with open(etag_path, 'w') as f:
+                    f.write(etag)
+        with open(part_path, mode) as f:
+            for chunk in resp.iter_content(DOWNLOAD_CHUNK):
+                if chunk:
+                    f.write(chunk)
+                    crc = zlib.crc32(chunk, crc)
+                    if forward is not None:
+                        forward.feed(part_path, pos, chunk)
+                    pos += len(chunk)
+    return crc
+
 
 def download_block(server_ip: str,
                    server_port: int,
                    file_base: str,
                    block_id: str,
-                   dest_dir: str) -> bool:
+                   dest_dir: str,
+                   expected_bytes: int = None,
+                   expected_crc: int = None,
+                   forward=None,
+                   sources: list = None) -> bool:
     """
-    Tải block_id từ Upload-Server về thư mục dest_dir.
+    Tải block_id về thư mục dest_dir từ replica trên DataNode khác (nếu có) hoặc Upload-Server.
     - server_ip: IP của Upload-Server (host Flask upload_server.py)
     - server_port: port của Upload-Server (mặc định 5000)
     - file_base: tên file gốc không đuôi .csv (ví dụ 'alogs')
     - block_id: tên block file (ví dụ 'alogs_block1.csv')
     - dest_dir: thư mục local để lưu file này
+    - expected_bytes/expected_crc: manifest của block; nếu có thì block đã có sẵn
+      và nguyên vẹn không tải lại, block tải xong sai checksum bị xóa và tải lại.
+    Dữ liệu được ghi vào <block_id>.part; mất kết nối giữa chừng thì lần thử sau
+    tiếp tục từ byte cuối (HTTP Range) thay vì tải lại cả block. Thử tối đa
+    DOWNLOAD_RETRIES lần, chờ tăng dần (exponential backoff) giữa các lần.
+    forward: ChainForwarder (chain replication) nhận từng chunk ngay khi ghi xuống đĩa.
+    sources: replica trên các DataNode khác do NameNode gửi kèm task,
+      [{'node', 'peer': 'ip:peer_port', 'dir': 'storage' | 'task', 'load'}, ...];
+      thử lần lượt theo thứ tự NameNode đã xếp (cùng host trước, rồi peer ít tải nhất;
+      peer_server.py), peer lỗi thì chuyển ngay sang nguồn kế tiếp;
+      Upload-Server là nguồn cuối cùng.
     Trả về True nếu thành công, False nếu lỗi.
     """
     os.makedirs(dest_dir, exist_ok=True)
-    url = f"http://{server_ip}:{server_port}/download/{file_base}.csv/blocks/{block_id}"
-    local_path = os.path.join(dest_dir, file_base)
-    try:
-        resp = requests.get(url, stream=True )
-        if resp.status_code == 200:
-            print(f"[DataNode] Downloaded block {block_id} → {local_path}") 
-            with open(local_path, 'wb') as f:
-                for chunk in resp.iter_content(32 * 1024):
-                    if chunk:
-                        f.write(chunk)
-            print(f"[DataNode] Downloaded block {block_id} → {local_path}")
+    urls = [f"http://{src['peer']}/{src.get('dir') or 'storage'}/{file_base}/{block_id}"
+            for src in sources or [] if src.get('peer')]
+    urls.append(f"http://{server_ip}:{server_port}/download/{file_base}.csv/blocks/{block_id}")
+    local_path = os.path.join(dest_dir, block_id)
+    part_path = local_path + '.part'
+    with _path_lock(local_path):
+        if block_intact(local_path, expected_bytes, expected_crc):
+            print(f"[DataNode] Block {block_id} already intact at {local_path}, skip download")
             return True
+        attempt = 0
+        while True:
+            url = urls[0]
+            try:
+                crc = _fetch_into_part(url, part_path, forward)
+                size = os.path.getsize(part_path)
+                if expected_bytes is not None and size < expected_bytes:
+                    # kết nối đóng sớm: giữ .part, lần sau tải tiếp
+                    raise IOError(f"incomplete ({size}/{expected_bytes} bytes), resuming")
+                if ((expected_bytes is not None and size != expected_bytes)
+                        or (expected_crc is not None and crc != expected_crc)):
+                    os.remove(part_path)
+                    raise IOError(f"checksum mismatch ({size} bytes, crc {crc}), refetching")
+                os.replace(part_path, local_path)
+                if os.path.exists(part_path + '.etag'):
+                    os.remove(part_path + '.etag')
+                print(f"[DataNode] Downloaded block {block_id} from {url} → {local_path}")
+                return True
+            except requests.HTTPError as e:
+                err = e
+                if (e.response is not None and e.response.status_code == 404
+                        and len(urls) == 1):
+                    print(f"[DataNode] ERROR 404 when downloading block: {url}")
+                    return False
+            except (requests.RequestException, OSError) as e:
+                err = e
+            if len(urls) > 1:
+                print(f"[DataNode] Download {block_id} from peer {url} failed: {err}; trying next source")
+                urls.pop(0)
+                continue
+            attempt += 1
+            if attempt >= DOWNLOAD_RETRIES:
+                break
+            delay = DOWNLOAD_BACKOFF * 2 ** (attempt - 1) * (1 + random.random())
+            print(f"[DataNode] Download {block_id} attempt {attempt} failed: {err}; retry in {delay:.1f}s")
+            time.sleep(delay)
+        print(f"[DataNode] Download {block_id} failed after {DOWNLOAD_RETRIES} attempts: {err}")
+        return False
+
+# ─── Chain replication ───────────────────────────────────────────────────────
+# Leader tải block từ Upload-Server 1 lần rồi đẩy tiếp theo chain leader → f1 → f2:
+# mỗi hop vừa ghi chunk xuống đĩa vừa gửi chunk đó cho hop sau (pipelined),
+# nên Upload-Server chỉ gửi mỗi block 1 lần thay vì 1 lần cho mỗi replica.
+# Giao thức trên task port của hop sau (kết nối riêng, không phải kênh NameNode):
+#   frame {'type': 'replicate', 'file', 'block_id', 'bytes', 'crc32', 'chain': [các hop còn lại]}
+#   rồi các chunk [4 byte độ dài, big-endian][dữ liệu]; chunk độ dài 0 = hết block
+#   hop sau kiểm tra manifest rồi trả frame
+#   {'type': 'replicated', 'status', 'replicas': [node đã lưu phía sau nó], 'error'}
+
+REPLICATE_TIMEOUT = 30        # seconds, connect / mỗi lần gửi-nhận giữa 2 hop
+_CHUNK_HEADER = struct.Struct('>I')
+
+
+def _recv_exactly(sock: socket.socket, n: int) -> bytes:
+    buf = bytearray()
+    while len(buf) < n:
+        chunk = sock.recv(n - len(buf))
+        if not chunk:
+            raise ConnectionError("hop trước đóng kết nối giữa chừng block")
+        buf += chunk
+    return bytes(buf)
+
+
+class ChainForwarder:
+    """
+    Đẩy 1 block xuống hop kế tiếp của chain trong lúc block đang được ghi local.
+    Lỗi ở hop sau không làm hỏng task của node này: forwarder ghi lại lỗi (error),
+    ngừng gửi và finish() trả về danh sách replica rỗng.
+    """
+
+    def __init__(self, msg: dict, chain: list):
+        self.next_hop = chain[0]
+        self.header = {'type': 'replicate', 'file': msg['file'], 'block_id': msg['block_id'],
+                       'bytes': msg.get('bytes'), 'crc32': msg.get('crc32'),
+                       'fragment': msg.get('fragment'), 'chain': list(chain[1:])}
+        self.sock = None
+        self.sent = 0              # số byte đầu block hop sau đã nhận
+        self.error = None
+
+    def _open(self):
+        self.close()
+        host, port = self.next_hop.rsplit(':', 1)
+        self.sock = socket.create_connection((host, int(port)), timeout=REPLICATE_TIMEOUT)
+        send_frame(self.sock, self.header)
+        self.sent = 0
+
+    def close(self):
+        """Đóng kết nối; hop sau thấy block chưa có chunk kết thúc nên bỏ bản dở."""
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+            self.sock = None
+
+    def _send(self, data: bytes):
+        self.sock.sendall(_CHUNK_HEADER.pack(len(data)))
+        self.sock.sendall(data)
+        self.sent += len(data)
+
+    def _catch_up(self, path: str, upto: int):
+        """Gửi đoạn [sent, upto) đã có trên đĩa mà hop sau chưa nhận (VD tải tiếp bằng Range)."""
+        with open(path, 'rb') as f:
+            f.seek(self.sent)
+            while self.sent < upto:
+                buf = f.read(min(DOWNLOAD_CHUNK, upto - self.sent))
+                if not buf:
+                    raise IOError(f"{path} ngắn hơn {upto} bytes")
+                self._send(buf)
+
+    def _fail(self, err):
+        self.error = f"replicate to {self.next_hop}: {err}"
+        print(f"[DataNode] {self.error}")
+        self.close()
+
+    def feed(self, path: str, pos: int, data: bytes):
+        """data vừa được ghi tại offset pos của file path."""
+        if self.error is not None:
+            return
+        try:
+            if self.sock is None or pos < self.sent:
+                # lần đầu, hoặc block đang được tải lại từ đầu → hop sau nhận lại từ byte 0
+                self._open()
+            if pos > self.sent:
+                self._catch_up(path, pos)
+            self._send(data)
+        except OSError as e:
+            self._fail(e)
+
+    def finish(self, path: str) -> list:
+        """
+        Block đã đủ ở path: gửi phần hop sau còn thiếu + chunk kết thúc rồi chờ xác nhận.
+        Trả về các node đã lưu block: hop sau + các hop phía sau nó.
+        """
+        if self.error is not None:
+            return []
+        try:
+            nbytes = os.path.getsize(path)
+            if self.sock is None or self.sent > nbytes:
+                self._open()
+            self._catch_up(path, nbytes)
+            self.sock.sendall(_CHUNK_HEADER.pack(0))
+            ack = recv_frame(self.sock)
+        except (OSError, ValueError) as e:
+            self._fail(e)
+            return []
+        self.close()
+        if not ack or ack.get('status') != 'ok':
+            self._fail((ack or {}).get('error', 'no reply'))
+            return []
+        if ack.get('error'):
+            self.error = ack['error']      # hop sau lưu được, hop xa hơn thì lỗi
+        return [self.next_hop] + list(ack.get('replicas') or [])
+
+
+def _replica_fields(msg: dict) -> tuple:
+    """
+    Kiểm tra frame 'replicate' từ hop trước, trả về (file_base, tên file lưu, bytes, crc32, chain).
+    Sai kiểu / thiếu trường → ValueError (frame do peer gửi, không tin được như NameNode).
+    """
+    file_base, block_id = msg.get('file'), msg.get('block_id')
+    for field in (file_base, block_id):
+        if not isinstance(field, str) or not field or os.path.basename(field) != field or field == '..':
+            raise ValueError(f"bad file/block_id {file_base!r}/{block_id!r}")
+    name = block_id
+    if msg.get('fragment') is not None:
+        index = int(msg['fragment'])
+        if not 0 <= index < EC_FRAGMENTS:
+            raise ValueError(f"bad fragment {index}")
+        name = fragment_name(block_id, index)
+    nbytes, crc = msg.get('bytes'), msg.get('crc32')
+    nbytes = None if nbytes is None else int(nbytes)
+    crc = None if crc is None else int(crc)
+    chain = msg.get('chain') or []
+    if not isinstance(chain, list) or not all(isinstance(nd, str) and ':' in nd for nd in chain):
+        raise ValueError(f"bad chain {chain!r}")
+    return file_base, name, nbytes, crc, chain
+
+
+def receive_replica(conn: socket.socket, msg: dict) -> dict:
+    """
+    Hop giữa / cuối của chain: nhận block từ hop trước vào storage/<file>/,
+    đồng thời đẩy tiếp cho msg['chain'][0] nếu còn hop sau.
+    msg['fragment'] = i: nhận fragment erasure i của block (storage/<file>/<block_id>.ec<i>),
+    bytes/crc32 là của fragment.
+    Trả về frame 'replicated' gửi lại hop trước.
+    """
+    block_id = msg.get('block_id')
+    try:
+        file_base, name, nbytes, expected_crc, chain = _replica_fields(msg)
+    except (TypeError, ValueError) as e:
+        return {'type': 'replicated', 'status': 'error', 'error': f"malformed replicate: {e}"}
+    dest_dir = os.path.join('storage', file_base)
+    os.makedirs(dest_dir, exist_ok=True)
+    local_path = os.path.join(dest_dir, name)
+    part_path = local_path + '.replica'
+    forward = ChainForwarder(msg, chain) if chain else None
+    conn.settimeout(REPLICATE_TIMEOUT)
+    with _path_lock(local_path):
+        crc = pos = 0
+        try:
+            with open(part_path, 'wb') as f:
+                while True:
+                    (n,) = _CHUNK_HEADER.unpack(_recv_exactly(conn, _CHUNK_HEADER.size))
+                    if n == 0:
+                        break
+                    data = _recv_exactly(conn, n)
+                    f.write(data)
+                    crc = zlib.crc32(data, crc)
+                    if forward is not None:
+                        forward.feed(part_path, pos, data)
+                    pos += n
+        except OSError as e:
+            if forward is not None:
+                forward.close()
+            os.remove(part_path)
+            return {'type': 'replicated', 'status': 'error', 'error': f"receive {block_id}: {e}"}
+        if (nbytes is not None and pos != nbytes) or (expected_crc is not None and crc != expected_crc):
+            if forward is not None:
+                forward.close()
+            os.remove(part_path)
+            return {'type': 'replicated', 'status': 'error',
+                    'error': f"{block_id}: checksum mismatch ({pos} bytes, crc {crc})"}
+        os.replace(part_path, local_path)
+        print(f"[DataNode] Replica {name} received via chain → {local_path}")
+        downstream = forward.finish(local_path) if forward is not None else []
+    return {'type': 'replicated', 'status': 'ok', 'replicas': downstream,
+            'error': forward.error if forward is not None else None}
+
+
+# ─── Erasure-coded storage ───────────────────────────────────────────────────
+# File upload với ?erasure=1: thay vì 2 follower giữ nguyên block, leader chia block
+# (erasure.py, XOR 2+1) và đẩy fragment i cho msg['ec'][i] bằng frame 'replicate' như
+# chain replication (kèm 'fragment': i). Fragment mất (node chết) được NameNode giao
+# dựng lại từ 2 fragment còn lại; leader không có bản đầy đủ nào để tải thì dựng block
+# từ fragment trước khi về Upload-Server.
+
+EC_TMP_DIR = 'ec_tmp'         # block tạm khi dựng fragment (ngoài INVENTORY_DIRS)
+
+
+def push_fragment(node: str, msg: dict, index: int, data: bytes):
+    """Gửi fragment index của block cho node (receive_replica). Trả về None hoặc lỗi (str)."""
+    header = {'type': 'replicate', 'file': msg['file'], 'block_id': msg['block_id'],
+              'fragment': index, 'bytes': len(data), 'crc32': zlib.crc32(data), 'chain': []}
+    host, port = node.rsplit(':', 1)
+    try:
+        with socket.create_connection((host, int(port)), timeout=REPLICATE_TIMEOUT) as sock:
+            send_frame(sock, header)
+            for pos in range(0, len(data), DOWNLOAD_CHUNK):
+                chunk = data[pos:pos + DOWNLOAD_CHUNK]
+                sock.sendall(_CHUNK_HEADER.pack(len(chunk)))
+                sock.sendall(chunk)
+            sock.sendall(_CHUNK_HEADER.pack(0))
+            ack = recv_frame(sock)
+    except (OSError, ValueError) as e:
+        return f"fragment {index} → {node}: {e}"
+    if not ack or ack.get('status') != 'ok':
+        return f"fragment {index} → {node}: {(ack or {}).get('error', 'no reply')}"
+    return None
+
+
+def push_fragments(msg: dict, block_path: str, targets: list) -> tuple:
+    """
+    Chia block ở block_path thành fragment và gửi fragment i cho targets[i]
+    (None: fragment i đã có / đang được dựng trên node khác → bỏ qua).
+    Trả về ({node: index} đã lưu, lỗi đầu tiên hoặc None).
+    """
+    with open(block_path, 'rb') as f:
+        fragments = encode(f.read())
+    stored, error = {}, None
+    for index, node in enumerate(targets[:len(fragments)]):
+        if node is None:
+            continue
+        err = push_fragment(node, msg, index, fragments[index])
+        if err is None:
+            stored[node] = index
         else:
-            print(f"[DataNode] ERROR {resp.status_code} when downloading block: {url}")
-            return False
-    except Exception as e:
-        print(f"[DataNode] Download exception for {block_id}: {e}")
+            print(f"[DataNode] {err}")
+            error = error or err
+    return stored, error
+
+
+def fetch_fragments(file_base: str, block_id: str, sources: list, nbytes: int,
+                    need: int = 2, skip=()) -> dict:
+    """
+    Tải fragment của block từ peer server các DataNode giữ fragment,
+    sources = [{'node', 'peer', 'index'}, ...]; dừng khi đủ `need` fragment.
+    Trả về { index: bytes } (có thể ít hơn need nếu peer lỗi).
+    """
+    got = {}
+    for src in sources or []:
+        index = src.get('index')
+        if len(got) >= need:
+            break
+        if index in got or index in skip or not src.get('peer'):
+            continue
+        url = f"http://{src['peer']}/storage/{file_base}/{fragment_name(block_id, index)}"
+        try:
+            resp = requests.get(url, timeout=DOWNLOAD_TIMEOUT)
+            resp.raise_for_status()
+        except requests.RequestException as e:
+            print(f"[DataNode] Fetch fragment {index} of {block_id} from {src['peer']} failed: {e}")
+            continue
+        got[index] = resp.content
+    return got
+
+
+def reconstruct_block(file_base: str, block_id: str, dest_dir: str,
+                      nbytes: int, crc: int, sources: list) -> bool:
+    """
+    Dựng lại block từ fragment trên các DataNode khác rồi ghi vào dest_dir/block_id.
+    Block dựng lại phải khớp manifest (bytes, crc32); không đủ fragment / sai checksum → False.
+    """
+    if nbytes is None or crc is None:
         return False
+    local_path = os.path.join(dest_dir, block_id)
+    with _path_lock(local_path):
+        if block_intact(local_path, nbytes, crc):
+            return True
+        fragments = fetch_fragments(file_base, block_id, sources, nbytes)
+        try:
+            data = decode(fragments, nbytes)
+        except ValueError as e:
+            print(f"[DataNode] Cannot reconstruct {block_id}: {e}")
+            return False
+        if zlib.crc32(data) != crc:
+            print(f"[DataNode] Reconstructed {block_id} fails checksum, discarding")
+            return False
+        os.makedirs(dest_dir, exist_ok=True)
+        part_path = local_path + '.part'
+        with open(part_path, 'wb') as f:
+            f.write(data)
+        os.replace(part_path, local_path)
+    print(f"[DataNode] Reconstructed block {block_id} from fragments {sorted(fragments)} → {local_path}")
+    return True
+
 
-def handle_message(msg: dict):
+def store_fragment(msg: dict) -> dict:
+    """
+    Task storage có msg['fragment'] = i: tạo fragment i của block trên node này.
+    Ưu tiên dựng lại từ fragment còn lại (msg['fragments']); không đủ thì lấy bản đầy đủ
+    (peer trong msg['sources'] hoặc Upload-Server) vào EC_TMP_DIR rồi chia lại.
+    """
+    file_base, block_id, index = msg['file'], msg['block_id'], int(msg['fragment'])
+    nbytes, crc = msg.get('bytes'), msg.get('crc32')
+    dest_dir = os.path.join('storage', file_base)
+    local_path = os.path.join(dest_dir, fragment_name(block_id, index))
+    fragments = fetch_fragments(file_base, block_id, msg.get('fragments'), nbytes, skip=(index,))
+    try:
+        data = rebuild_fragment(fragments, index, nbytes)
+    except (ValueError, TypeError):
+        data = None
+    if data is not None and zlib.crc32(decode({**fragments, index: data}, nbytes)) != crc:
+        data = None
+    if data is None:
+        tmp_dir = os.path.join(EC_TMP_DIR, file_base)
+        if not download_block(UPLOAD_SERVER_HOST, UPLOAD_SERVER_PORT, file_base, block_id, tmp_dir,
+                              expected_bytes=nbytes, expected_crc=crc, sources=msg.get('sources')):
+            return {'status': 'error', 'error': f"fragment {index} of {block_id}: no source"}
+        tmp_path = os.path.join(tmp_dir, block_id)
+        with open(tmp_path, 'rb') as f:
+            data = encode(f.read())[index]
+        os.remove(tmp_path)
+    os.makedirs(dest_dir, exist_ok=True)
+    with _path_lock(local_path):
+        with open(local_path + '.part', 'wb') as f:
+            f.write(data)
+        os.replace(local_path + '.part', local_path)
+    print(f"[DataNode] Stored fragment {index} of {block_id} → {local_path}")
+    return {'status': 'ok', 'result': local_path, 'fragment': index}
+
+
+def handle_message(msg: dict) -> dict:
     """
     Xử lý message JSON nhận từ NameNode.
     Nếu là 'task', sẽ tự động tải block về đúng thư mục.
+    Task leader có msg['chain'] (follower) thì block được đẩy tiếp theo chain replication
+    trong lúc tải; kết quả có thêm 'replicas' = follower đã lưu block.
+    Trả về {'status': 'ok' | 'error', 'result': <vị trí kết quả>, 'error': ...}
+    để gửi lại NameNode trong message 'complete'.
     """
     mtype = msg.get('type')
     if mtype != 'task':
         print(f"[DataNode] Ignored message: {msg}")
-        return
+        return {'status': 'error', 'error': f"unexpected message type {mtype}"}
 
     # Các field: 'role', 'block_id', 'file'
     role      = msg.get('role')
@@ -80,75 +629,342 @@ def handle_message(msg: dict):
 
     if not all([role, block_id, file_base]):
         print(f"[DataNode] Malformed task message: {msg}")
-        return
+        return {'status': 'error', 'error': 'malformed task'}
+
+    if role == 'reduce':
+        return fetch_partitions(msg)
+
+    if role == 'storage' and msg.get('fragment') is not None:
+        return store_fragment(msg)
 
     if role == 'leader':
         # Tải về thư mục 'task/<file_base>/'
         dest_dir = os.path.join('task', file_base)
-        download_block(
-            server_ip=UPLOAD_SERVER_HOST,
-            server_port=UPLOAD_SERVER_PORT,
-            file_base=file_base,
-            block_id=block_id,   
-            dest_dir=dest_dir
-        )
-        # TODO: xử lý data sau khi download tại đây, gọi hàm xử lý data từ functions_datanode.py, nhớ update cái status là free và ghi kết quả vào file txt nha
     elif role == 'storage':
         # Tải về thư mục 'storage/<file_base>/'
         dest_dir = os.path.join('storage', file_base)
-        download_block(
-            server_ip=UPLOAD_SERVER_HOST,
-            server_port=UPLOAD_SERVER_PORT,
-            file_base=file_base,
-            block_id=block_id,
-            dest_dir=dest_dir
-        )
     else:
         print(f"[DataNode] Unknown role '{role}' in task message: {msg}")
+        return {'status': 'error', 'error': f"unknown role {role}"}
+
+    chain = msg.get('chain') if role == 'leader' else None
+    forward = ChainForwarder(msg, chain) if chain else None
+    replica = os.path.join('storage', file_base, block_id)
+    if role == 'leader' and block_intact(replica, msg.get('bytes'), msg.get('crc32')):
+        # NameNode ưu tiên giao block cho node đã giữ replica: chạy thẳng trên replica, không tải
+        print(f"[DataNode] Block {block_id}: using local replica {replica}")
+        return _leader_outcome(replica, forward, msg)
+    if (role == 'leader' and not msg.get('sources') and msg.get('fragments')
+            and reconstruct_block(file_base, block_id, dest_dir, msg.get('bytes'),
+                                  msg.get('crc32'), msg['fragments'])):
+        # không còn bản đầy đủ trên DataNode nào: dựng lại từ fragment thay vì tải Upload-Server
+        return _leader_outcome(os.path.join(dest_dir, block_id), forward, msg)
+    ok = download_block(
+        server_ip=UPLOAD_SERVER_HOST,
+        server_port=UPLOAD_SERVER_PORT,
+        file_base=file_base,
+        block_id=block_id,
+        dest_dir=dest_dir,
+        expected_bytes=msg.get('bytes'),
+        expected_crc=msg.get('crc32'),
+        forward=forward,
+        sources=msg.get('sources')
+    )
+    if not ok:
+        if forward is not None:
+            forward.close()
+        return {'status': 'error', 'error': f"download {block_id} failed"}
+    return _leader_outcome(os.path.join(dest_dir, block_id), forward, msg)
+
 
-def task_listener(listen_host: str, listen_port: int):
+def _leader_outcome(block_path: str, forward, msg: dict) -> dict:
     """
-    Lắng nghe task từ NameNode qua TCP, mỗi message là 1 JSON.
-    Khi nhận được, gọi handle_message.
+    Block đã sẵn ở block_path: hoàn tất chain replication / gửi fragment erasure (msg['ec'])
+    nếu có và trả kết quả giai đoạn I/O.
     """
+    outcome = {'status': 'ok', 'result': block_path}
+    if forward is not None:
+        outcome['replicas'] = forward.finish(block_path)
+        if forward.error:
+            outcome['replication_error'] = forward.error
+    if msg.get('role') == 'leader' and msg.get('ec'):
+        outcome['fragments'], error = push_fragments(msg, block_path, msg['ec'])
+        if error:
+            outcome['replication_error'] = error
+    return outcome
+
+def fetch_partitions(msg: dict) -> dict:
+    """
+    Giai đoạn I/O của task reduce: kéo partition msg['partition'] của mọi block
+    từ DataNode đã chạy map block đó (peer server, xem peer_server.py)
+    về reduce/<job_id>/<partition>/.
+    msg['sources'] = [{'block_id': ..., 'peer': 'ip:port'}, ...]
+    """
+    job_id, part = msg.get('job_id'), msg.get('partition')
+    dest_dir = os.path.join('reduce', job_id, str(part))
+    os.makedirs(dest_dir, exist_ok=True)
+    with requests.Session() as session:
+        for src in msg.get('sources') or []:
+            url = f"http://{src['peer']}/shuffle/{job_id}/{src['block_id']}/{part}.csv"
+            local_path = os.path.join(dest_dir, src['block_id'])
+            try:
+                with session.get(url, stream=True, timeout=20) as resp:
+                    if resp.status_code != 200:
+                        return {'status': 'error', 'error': f"fetch {url}: HTTP {resp.status_code}"}
+                    with open(local_path, 'wb') as f:
+                        for chunk in resp.iter_content(256 * 1024):
+                            f.write(chunk)
+            except requests.RequestException as e:
+                return {'status': 'error', 'error': f"fetch {url}: {e}"}
+    return {'status': 'ok', 'result': dest_dir}
+
+
+def _send_on_channel(conn: socket.socket, lock: threading.Lock, msg: dict):
+    """Ghi 1 frame lên kênh NameNode; nhiều thread cùng ghi nên phải giữ lock."""
+    with lock:
+        send_frame(conn, msg)
+
+
+@functools.lru_cache(maxsize=64)
+def _compiled_plan(plan_json: str):
+    """
+    Plan của job chỉ compile 1 lần cho mỗi process worker; các block sau
+    của cùng job dùng lại Pipeline đã có (key là spec dạng JSON chuẩn).
+    """
+    return compile_plan(json.loads(plan_json) if plan_json else None)
+
+
+def process_block(msg: dict, block_path: str) -> dict:
+    """
+    Giai đoạn CPU của task leader: chạy plan của job (msg['plan'], xem engine.py;
+    mặc định đếm số dòng) trên block đã tải, ghi kết quả gọn vào
+    results/<file_base>/<job_id>/. outcome['upload'] = file cục bộ cần gửi lên
+    Upload-Server; việc gửi (I/O) do upload_result chạy trên thread pool I/O.
+    Chạy trong process pool nên chỉ nhận/trả dữ liệu picklable.
+    """
+    file_base = msg['file']
+    block_id  = msg['block_id']
+    job_id    = msg.get('job_id')
+
+    plan = msg.get('plan')
+    pipeline = _compiled_plan(json.dumps(plan, sort_keys=True) if plan else '')
+
+    if msg.get('partitions'):
+        # shuffle: giữ kết quả đã combine tại chỗ, reducer sẽ kéo qua peer server
+        out_dir = os.path.join('shuffle', job_id, block_id)
+        rows = pipeline.run(block_path, out_dir, partitions=int(msg['partitions']),
+                            codec=msg.get('codec'))
+        print(f"[DataNode] Mapped {block_id}: {rows} group(s) → {out_dir}")
+        return {'status': 'ok', 'result': out_dir, 'rows': rows}
+
+    out_dir = os.path.join('results', file_base, job_id or '')
+    os.makedirs(out_dir, exist_ok=True)
+    out_path = os.path.join(out_dir, block_id)
+    rows = pipeline.run(block_path, out_path, codec=msg.get('codec'))
+    print(f"[DataNode] Processed {block_id}: {rows} result row(s) → {out_path}")
+
+    result = '/'.join(p for p in ('results', file_base, job_id, block_id) if p)
+    return {'status': 'ok', 'result': result, 'rows': rows, 'upload': out_path}
+
+
+def reduce_partition(msg: dict, part_dir: str) -> dict:
+    """
+    Giai đoạn CPU của task reduce: merge k-way các partition đã kéo về
+    thành 1 file (vẫn là kết quả từng phần, đã sắp theo khóa); upload_result gửi file
+    lên Upload-Server với tên msg['block_id'] (VD: part-00003.csv).
+    """
+    file_base, name, job_id = msg['file'], msg['block_id'], msg.get('job_id')
+    plan = msg.get('plan')
+    pipeline = _compiled_plan(json.dumps(plan, sort_keys=True) if plan else '')
+    paths = [os.path.join(part_dir, src['block_id']) for src in msg.get('sources') or []]
+    out_dir = os.path.join('results', file_base, job_id)
+    os.makedirs(out_dir, exist_ok=True)
+    out_path = os.path.join(out_dir, name)
+    rows = pipeline.merge(paths, out_path)
+    print(f"[DataNode] Reduced {len(paths)} partition file(s) → {out_path} ({rows} group(s))")
+    shutil.rmtree(part_dir, ignore_errors=True)
+    return {'status': 'ok', 'result': f"results/{file_base}/{job_id}/{name}", 'rows': rows,
+            'upload': out_path}
+
+
+def upload_result(msg: dict, outcome: dict) -> dict:
+    """
+    Giai đoạn I/O sau CPU: gửi file kết quả outcome['upload'] lên Upload-Server
+    (results/<file_base>/<job_id>/<block_id>). Trả outcome không còn khóa 'upload'.
+    """
+    outcome = dict(outcome)
+    path = outcome.pop('upload')
+    if not upload_block_to_server(UPLOAD_SERVER_HOST, UPLOAD_SERVER_PORT,
+                                  msg['file'], msg['block_id'], path, job_id=msg.get('job_id')):
+        return {'status': 'error', 'error': f"upload result {msg['block_id']} failed"}
+    return outcome
+
+
+# Giai đoạn CPU theo role; role không có ở đây (storage) chỉ có giai đoạn I/O
+CPU_STAGES = {'leader': process_block, 'reduce': reduce_partition}
+
+
+class TaskExecutor:
+    """
+    Chạy task theo các giai đoạn tách biệt:
+      - I/O  : tải block / kéo partition (handle_message) trên thread pool `slots` worker
+      - CPU  : xử lý block (process_block) hoặc reduce (reduce_partition) trên process pool
+      - I/O  : gửi file kết quả lên Upload-Server (upload_result), lại trên thread pool;
+               process CPU không phải ngồi chờ mạng
+    `slots` = số task leader chạy đồng thời, được báo cho NameNode khi register.
+    Task storage 'background' (NameNode chép lại block thiếu bản) chạy trên 1 thread riêng
+    để không chiếm slot I/O của task compute.
+    Xong mỗi task thì gửi message 'complete' lên NameNode qua chính kênh đã nhận task.
+    """
+
+    def __init__(self, slots: int):
+        self.slots = max(int(slots), 1)
+        self.io_pool = ThreadPoolExecutor(max_workers=self.slots, thread_name_prefix='task-io')
+        self.background_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='replica-io')
+        self.cpu_pool = ProcessPoolExecutor(max_workers=min(self.slots, os.cpu_count() or 1))
+
+    def submit(self, msg: dict, reply):
+        t0 = time.monotonic()
+        pool = self.background_pool if msg.get('background') else self.io_pool
+        fut = pool.submit(handle_message, msg)
+        fut.add_done_callback(lambda f: self._after_io(f, msg, reply, t0))
+
+    def _after_io(self, fut, msg, reply, t0):
+        outcome = self._outcome(fut, msg)
+        stage = CPU_STAGES.get(msg.get('role'))
+        if outcome.get('status') == 'ok' and stage is not None:
+            # kết quả chain replication của giai đoạn I/O vẫn được báo cùng message 'complete'
+            extra = {k: outcome[k] for k in ('replicas', 'fragments', 'replication_error')
+                     if k in outcome}
+            try:
+                cpu = self.cpu_pool.submit(stage, msg, outcome['result'])
+            except Exception as e:
+                self._report(msg, reply, t0, {**extra, 'status': 'error', 'error': str(e)})
+                return
+            cpu.add_done_callback(lambda f: self._after_cpu(f, msg, reply, t0, extra))
+            return
+        self._report(msg, reply, t0, outcome)
+
+    def _after_cpu(self, fut, msg, reply, t0, extra):
+        outcome = self._outcome(fut, msg)
+        if outcome.get('status') == 'ok' and 'upload' in outcome:
+            try:
+                up = self.io_pool.submit(upload_result, msg, outcome)
+            except Exception as e:
+                self._report(msg, reply, t0, {**extra, 'status': 'error', 'error': str(e)})
+                return
+            up.add_done_callback(
+                lambda f: self._report(msg, reply, t0, {**extra, **self._outcome(f, msg)}))
+            return
+        self._report(msg, reply, t0, {**extra, **outcome})
+
+    @staticmethod
+    def _outcome(fut, msg) -> dict:
+        try:
+            return fut.result()
+        except Exception as e:
+            print(f"[DataNode] Error handling task {msg.get('block_id')}: {e}")
+            return {'status': 'error', 'error': str(e)}
+
+    @staticmethod
+    def _report(msg, reply, t0, outcome: dict):
+        done = {
+            'type':     'complete',
+            'req_id':   msg.get('req_id'),
+            'role':     msg.get('role'),
+            'block_id': msg.get('block_id'),
+            'file':     msg.get('file'),
+            'job_id':   msg.get('job_id'),
+            'duration': round(time.monotonic() - t0, 3),
+            **outcome,
+        }
+        try:
+            reply(done)
+        except OSError as e:
+            print(f"[DataNode] Cannot report completion of {msg.get('block_id')}: {e}")
+
+
+def serve_task_channel(conn: socket.socket, addr, executor: TaskExecutor):
+    """
+    Phục vụ 1 kênh task lâu dài từ NameNode: đọc liên tục các frame,
+    ACK ngay theo req_id rồi giao task cho executor.
+    Kết nối mở đầu bằng frame 'replicate' là hop trước của chain replication
+    (receive_replica), không phải NameNode.
+    """
+    write_lock = threading.Lock()
+    print(f"[DataNode] Task channel opened from {addr}")
+    with conn:
+        while True:
+            try:
+                msg = recv_frame(conn)
+            except (OSError, ValueError) as e:
+                print(f"[DataNode] Task channel error from {addr}: {e}")
+                break
+            if msg is None:
+                break
+            if msg.get('type') == 'replicate':
+                reply = receive_replica(conn, msg)
+                try:
+                    send_frame(conn, reply)
+                except OSError as e:
+                    print(f"[DataNode] Cannot confirm replica {msg.get('block_id')} to {addr}: {e}")
+                break
+            ok = msg.get('type') == 'task' and all(msg.get(k) for k in ('role', 'block_id', 'file'))
+            ack = {'type': 'ack', 'req_id': msg.get('req_id'), 'status': 'ok' if ok else 'rejected'}
+            try:
+                _send_on_channel(conn, write_lock, ack)
+            except OSError as e:
+                print(f"[DataNode] Cannot ack task from {addr}: {e}")
+                break
+            if ok:
+                executor.submit(msg, functools.partial(_send_on_channel, conn, write_lock))
+            else:
+                print(f"[DataNode] Malformed task message: {msg}")
+    print(f"[DataNode] Task channel closed from {addr}")
+
+
+def task_listener(listen_host: str, listen_port: int, slots: int = 1):
+    """
+    Lắng nghe kênh task từ NameNode qua TCP. Mỗi kết nối là 1 kênh lâu dài
+    mang nhiều task (framing.py), được phục vụ trên 1 thread riêng.
+    Task được chạy song song trên `slots` slot (TaskExecutor).
+    """
+    executor = TaskExecutor(slots)
+
     srv = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     srv.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     srv.bind((listen_host, listen_port))
     srv.listen()
-    print(f"[DataNode] Listening for task assignment at {listen_host}:{listen_port}")
+    print(f"[DataNode] Listening for task assignment at {listen_host}:{listen_port} ({executor.slots} slots)")
     while True:
         conn, addr = srv.accept()
-        with conn:
-            raw = conn.recv(8192)
-            if not raw:
-                continue
-            try:
-                msg = json.loads(raw.decode('utf-8'))
-                handle_message(msg)
-            except Exception as e:
-                print(f"[DataNode] Error handling task from {addr}: {e}")
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        threading.Thread(target=serve_task_channel, args=(conn, addr, executor), daemon=True).start()
 
-def start_task_listener_bg(listen_host='0.0.0.0', listen_port=7000):
+def start_task_listener_bg(listen_host='0.0.0.0', listen_port=7000, slots=1):
     """
     Chạy task_listener trên 1 thread mới (background).
     """
-    t = threading.Thread(target=task_listener, args=(listen_host, listen_port), daemon=True)
+    t = threading.Thread(target=task_listener, args=(listen_host, listen_port, slots), daemon=True)
     t.start()
     return t
 
 
-def upload_block_to_server(server_ip, server_port, file_base, block_id, block_path):
+def upload_block_to_server(server_ip, server_port, file_base, block_id, block_path, job_id=None):
     """
     Gửi block_id (file CSV) lên Upload-Server.
     - server_ip/server_port: địa chỉ server Flask
     - file_base: tên file gốc (không .csv)
     - block_id: tên file block (VD: alogs_block1.csv)
     - block_path: đường dẫn tới file block trên máy DataNode
+    - job_id: nếu có, server lưu vào results/<file_base>/<job_id>/
     """
     url = f"http://{server_ip}:{server_port}/upload_block"
     with open(block_path, 'rb') as f:
         files = {'file': (block_id, f, 'text/csv')}
         data = {'file_base': file_base, 'block_id': block_id}
+        if job_id:
+            data['job_id'] = job_id
         resp = requests.post(url, files=files, data=data, timeout=20)
     if resp.status_code == 200:
         print(f"[DataNode] Uploaded {block_id} to server")
@@ -0,0 +1,94 @@
+# peer_server.py
+# HTTP server nhỏ của DataNode để DataNode khác kéo dữ liệu trực tiếp (peer-to-peer):
+#   GET /shuffle/<job_id>/<block_id>/<p>.csv   partition p của kết quả map 1 block
+#   GET /storage/<file_base>/<block_id>        replica block (follower)
+#   GET /storage/<file_base>/<block_id>.ec<i>  fragment erasure i của block (erasure.py)
+#   GET /task/<file_base>/<block_id>           bản block leader đã tải để xử lý
+# Block được đọc từ replica trên các DataNode thay vì dồn hết về Upload-Server;
+# hỗ trợ Range / If-Range / ETag như route /download của Upload-Server để tải tiếp được.
+# Chỉ phục vụ file nằm trong các thư mục ở SERVED_DIRS (tương đối với thư mục chạy DataNode).
+
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote, urlsplit
+
+SERVED_DIRS = ('shuffle', 'storage', 'task')
+COPY_CHUNK  = 256 * 1024
+
+
+class PeerRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'   # keep-alive: reducer kéo nhiều partition trên 1 kết nối
+
+    def _local_path(self):
+        parts = [p for p in unquote(urlsplit(self.path).path).split('/') if p]
+        if len(parts) < 2 or parts[0] not in SERVED_DIRS:
+            return None
+        if any(p in ('.', '..') or os.sep in p for p in parts):
+            return None
+        return os.path.join(*parts)
+
+    def _byte_range(self, size: int, etag: str):
+        """
+        (start, end) theo header Range (1 đoạn bytes=a-b | a- | -n), hoặc None nếu không có
+        Range, Range dạng khác, hay If-Range không khớp ETag (→ trả cả file).
+        """
+        rng = self.headers.get('Range', '')
+        if not rng.startswith('bytes=') or ',' in rng:
+            return None
+        if_range = self.headers.get('If-Range')
+        if if_range and if_range != etag:
+            return None
+        first, _, last = rng[len('bytes='):].strip().partition('-')
+        try:
+            if not first:
+                return max(size - int(last), 0), size - 1
+            return int(first), min(int(last), size - 1) if last else size - 1
+        except ValueError:
+            return None
+
+    def do_GET(self):
+        path = self._local_path()
+        if path is None or not os.path.isfile(path):
+            self.send_error(404)
+            return
+        with open(path, 'rb') as f:
+            st = os.fstat(f.fileno())
+            size = st.st_size
+            etag = f'"{st.st_mtime_ns:x}-{size:x}"'
+            rng = self._byte_range(size, etag)
+            if rng is not None and rng[0] >= size:
+                self.send_response(416)
+                self.send_header('Content-Range', f"bytes */{size}")
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            start, end = rng if rng is not None else (0, size - 1)
+            self.send_response(206 if rng is not None else 200)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', str(end - start + 1))
+            self.send_header('Accept-Ranges', 'bytes')
+            self.send_header('ETag', etag)
+            if rng is not None:
+                self.send_header('Content-Range', f"bytes {start}-{end}/{size}")
+            self.end_headers()
+            f.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                buf = f.read(min(COPY_CHUNK, remaining))
+                if not buf:
+                    break
+                self.wfile.write(buf)
+                remaining -= len(buf)
+
+    def log_message(self, fmt, *args):
+        pass    # mỗi partition / block 1 request → không in log từng request
+
+
+def start_peer_server_bg(listen_host: str = '0.0.0.0', listen_port: int = 7001):
+    """Chạy peer server trên 1 thread nền, trả về server (gọi .shutdown() để dừng)."""
+    srv = ThreadingHTTPServer((listen_host, listen_port), PeerRequestHandler)
+    srv.daemon_threads = True
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    print(f"[DataNode] Peer server listening on {listen_host}:{listen_port}")
+    return srv
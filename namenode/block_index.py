@@ -0,0 +1,228 @@
+# block_index.py
+# Chỉ mục block ↔ DataNode của Scheduler (tách khỏi scheduler.py):
+#   - locations / node_blocks / node_dirs: node nào giữ bản đầy đủ của block, ở thư mục nào
+#   - fragments / node_fragments: fragment erasure node đang giữ
+#   - storage (StorageLoad) + reserved: byte mỗi node đang lưu / đã được giữ chỗ
+#   - apply_block_report: cập nhật các chỉ mục theo block report của DataNode
+# BlockIndexMixin dùng chung trạng thái + Condition của Scheduler (xem docstring Scheduler).
+
+import heapq
+
+from replication import DEFAULT_REPLICATION, EC_DIRS, _fragment_bytes
+
+
+class StorageLoad:
+    """
+    Số byte mỗi node đang lưu (hoặc đã được giao sẽ lưu) + min-heap (bytes, node_id)
+    để lấy k node ít tải nhất trong O(k log n), không phải sắp xếp mọi node mỗi lần giao block.
+    Mỗi lần cập nhật đẩy entry mới vào heap; entry cũ (bytes khác giá trị hiện tại) bị bỏ
+    khi gặp (lazy deletion), heap được dựng lại khi entry cũ chiếm quá nửa.
+    """
+
+    def __init__(self):
+        self.bytes = {}            # { node_id: bytes }, chỉ node còn sống
+        self._heap = []
+
+    def set(self, node_id: str, nbytes: int):
+        self.bytes[node_id] = nbytes
+        heapq.heappush(self._heap, (nbytes, node_id))
+        if len(self._heap) > 2 * len(self.bytes) + 64:
+            self._heap = [(b, n) for n, b in self.bytes.items()]
+            heapq.heapify(self._heap)
+
+    def add(self, node_id: str, delta: int):
+        if delta and node_id in self.bytes:
+            self.set(node_id, self.bytes[node_id] + delta)
+
+    def discard(self, node_id: str):
+        self.bytes.pop(node_id, None)
+
+    def least(self, k: int, exclude=()) -> list[str]:
+        """k node ít byte nhất (hòa thì theo node_id), bỏ qua node trong exclude."""
+        picked, seen = [], []
+        while self._heap and len(picked) < k:
+            entry = heapq.heappop(self._heap)
+            nbytes, node_id = entry
+            if self.bytes.get(node_id) != nbytes or any(n == node_id for _, n in seen):
+                continue            # entry cũ / trùng → bỏ hẳn
+            seen.append(entry)
+            if node_id not in exclude:
+                picked.append(node_id)
+        for entry in seen:
+            heapq.heappush(self._heap, entry)
+        return picked
+
+
+class BlockIndexMixin:
+    """Phần chỉ mục block của Scheduler; block mất bản được chuyển cho _check_replication."""
+
+    def _add_location(self, blk: str, node_id: str, where: str, replace: bool = True,
+                      nbytes: int = 0):
+        """
+        Ghi nhận node giữ blk (thư mục where, nbytes byte theo manifest) và cộng vào
+        byte đang lưu của node (trừ khi đã được giữ chỗ lúc assign). Gọi khi đang giữ self._cond.
+        """
+        holders = self.locations.setdefault(blk, {})
+        if replace or node_id not in holders:
+            holders[node_id] = where
+        self.node_dirs.setdefault(node_id, {}).setdefault(blk, set()).add(where)
+        held = self.node_blocks.setdefault(node_id, {})
+        if blk not in held:
+            reserved = self._unreserve(blk, node_id)
+            held[blk] = reserved if reserved is not None else (nbytes or 0)
+            if reserved is None:
+                self.storage.add(node_id, held[blk])
+
+    def _drop_location(self, blk: str, node_id: str):
+        """Bỏ node khỏi danh sách giữ blk (không đụng node_blocks). Gọi khi đang giữ self._cond."""
+        holders = self.locations.get(blk)
+        if holders is not None:
+            holders.pop(node_id, None)
+            if not holders:
+                del self.locations[blk]
+
+    def _remove_location(self, blk: str, node_id: str):
+        """Node không còn giữ blk: bỏ khỏi cả 2 chỉ mục và trừ byte. Gọi khi đang giữ self._cond."""
+        nbytes = self.node_blocks.get(node_id, {}).pop(blk, None)
+        if nbytes is not None:
+            self.storage.add(node_id, -nbytes)
+        self.node_dirs.get(node_id, {}).pop(blk, None)
+        self._drop_location(blk, node_id)
+
+    def _remove_copy(self, blk: str, node_id: str, where: str) -> bool:
+        """
+        Bản blk trong thư mục where của node đã mất. Node chỉ thôi giữ blk khi không còn bản
+        ở thư mục khác (VD xóa task/ nhưng storage/ vẫn còn); trả về True nếu đã bỏ node.
+        Gọi khi đang giữ self._cond.
+        """
+        dirs = self.node_dirs.get(node_id, {}).get(blk)
+        if dirs is not None:
+            dirs.discard(where)
+            if dirs:
+                # vẫn còn bản ở thư mục khác (ưu tiên storage, như _add_location)
+                self.locations.setdefault(blk, {})[node_id] = ('storage' if 'storage' in dirs
+                                                               else min(dirs))
+                return False
+        self._remove_location(blk, node_id)
+        return True
+
+    def _add_fragment(self, blk: str, node_id: str, index: int, nbytes: int = 0):
+        """Ghi nhận node giữ fragment index của blk (nbytes byte), như _add_location."""
+        self.fragments.setdefault(blk, {})[node_id] = index
+        held = self.node_fragments.setdefault(node_id, {})
+        if blk not in held:
+            reserved = self._unreserve(blk, node_id)
+            held[blk] = reserved if reserved is not None else (nbytes or 0)
+            if reserved is None:
+                self.storage.add(node_id, held[blk])
+
+    def _drop_fragment(self, blk: str, node_id: str):
+        holders = self.fragments.get(blk)
+        if holders is not None:
+            holders.pop(node_id, None)
+            if not holders:
+                del self.fragments[blk]
+
+    def _remove_fragment(self, blk: str, node_id: str):
+        nbytes = self.node_fragments.get(node_id, {}).pop(blk, None)
+        if nbytes is not None:
+            self.storage.add(node_id, -nbytes)
+        self._drop_fragment(blk, node_id)
+
+    def _fragment_sources(self, blk: str) -> list[dict]:
+        """Fragment của blk trên node còn sống, node ít tải trước. Gọi khi đang giữ self._cond."""
+        sources = [{'node': nd, 'peer': self.peers[nd], 'index': index}
+                   for nd, index in self.fragments.get(blk, {}).items()
+                   if nd in self.slots and nd in self.peers]
+        sources.sort(key=lambda src: (self.busy[src['node']] / self.slots[src['node']], src['index']))
+        return sources
+
+    def _reserve(self, blk: str, node_id: str, nbytes: int):
+        """Giữ chỗ nbytes trên node sắp nhận blk (nếu node chưa giữ / chưa được giữ chỗ)."""
+        if blk in self.node_blocks.get(node_id, ()) or node_id in self.reserved.get(blk, ()):
+            return
+        self.reserved.setdefault(blk, {})[node_id] = nbytes or 0
+        self.storage.add(node_id, nbytes or 0)
+
+    def _unreserve(self, blk: str, node_id: str):
+        """Bỏ entry giữ chỗ (không trừ byte), trả về số byte đã giữ hoặc None."""
+        held = self.reserved.get(blk)
+        if not held or node_id not in held:
+            return None
+        nbytes = held.pop(node_id)
+        if not held:
+            del self.reserved[blk]
+        return nbytes
+
+    def _release(self, blk: str, node_id: str):
+        """Bỏ phần byte giữ chỗ khi node sẽ không lưu blk. Gọi khi đang giữ self._cond."""
+        nbytes = self._unreserve(blk, node_id)
+        if nbytes:
+            self.storage.add(node_id, -nbytes)
+
+    def apply_block_report(self, node_id: str, added: list, removed: list = (),
+                           manifests: dict = None, full: bool = False) -> int:
+        """
+        Cập nhật locations theo block report của DataNode.
+        - added  : [[dir, block_id, crc32], ...] block node đang giữ (dir 'task' | 'storage',
+          hoặc 'ec<i>' = fragment erasure i; CRC fragment không có trong catalog nên không
+          kiểm tra ở đây — DataNode kiểm tra khi nhận, block dựng lại được kiểm tra theo manifest)
+        - removed: [[dir, block_id], ...] block node đã xóa (chỉ có trong delta)
+        - manifests: { block_id: (bytes, crc32, file_base, replication, erasure) } theo catalog;
+          bản khác CRC (VD file đã upload lại) hoặc block không có trong catalog bị bỏ qua
+        - full=True (register): thay toàn bộ block đã biết của node, byte đang lưu của node
+          tính lại từ report (+ phần đang giữ chỗ cho task chưa xong)
+        Block mất bản (bị xóa, hỏng, không còn trong full report) được kiểm tra replication.
+        Trả về số block được ghi nhận.
+        """
+        manifests = manifests or {}
+        accepted = 0
+        changed = []
+        with self._cond:
+            if full:
+                changed = list(self.node_blocks.pop(node_id, {}))
+                self.node_dirs.pop(node_id, None)
+                for blk in changed:
+                    self._drop_location(blk, node_id)
+                for blk in self.node_fragments.pop(node_id, {}):
+                    self._drop_fragment(blk, node_id)
+                    changed.append(blk)
+                if node_id in self.storage.bytes:
+                    self.storage.set(node_id, sum(held.get(node_id, 0)
+                                                  for held in self.reserved.values()))
+            for entry in removed or ():
+                if not isinstance(entry, (list, tuple)) or len(entry) < 2:
+                    continue
+                where, blk = entry[0], entry[1]
+                if where in EC_DIRS:
+                    if blk in self.node_fragments.get(node_id, ()):
+                        self._remove_fragment(blk, node_id)
+                        changed.append(blk)
+                elif blk in self.node_blocks.get(node_id, ()) and self._remove_copy(blk, node_id, where):
+                    changed.append(blk)
+            for entry in added or ():
+                try:
+                    where, blk, crc = entry
+                except (TypeError, ValueError):
+                    continue
+                if where not in ('task', 'storage') + EC_DIRS or blk not in manifests:
+                    continue
+                nbytes, expected_crc, file_base, replication, erasure = manifests[blk]
+                self.block_meta[blk] = (file_base, nbytes, expected_crc,
+                                        replication or DEFAULT_REPLICATION, bool(erasure))
+                changed.append(blk)
+                if where in EC_DIRS:
+                    self._add_fragment(blk, node_id, EC_DIRS.index(where), _fragment_bytes(nbytes))
+                    accepted += 1
+                    continue
+                if expected_crc is not None and expected_crc != crc:
+                    if blk in self.node_blocks.get(node_id, ()):
+                        self._remove_copy(blk, node_id, where)
+                    continue
+                # cùng block ở cả task/ và storage/: ưu tiên storage (replica lâu dài)
+                self._add_location(blk, node_id, where, replace=(where == 'storage'), nbytes=nbytes)
+                accepted += 1
+            for blk in changed:
+                self._check_replication(blk)
+            self._cond.notify_all()
+        return accepted
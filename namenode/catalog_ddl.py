@@ -0,0 +1,97 @@
+# catalog_ddl.py
+# DDL của schema `catalog` (files / blocks / placements / node_storage), idempotent.
+# Upload server (functions.py) và NameNode (functions_namenode.py) đều chạy lúc khởi động,
+# nên thứ tự khởi động không quan trọng. Cả khối chạy trong 1 transaction (1 query nhiều
+# câu lệnh), advisory lock tránh 2 process cùng tạo bảng / trigger.
+# File này có bản sao giống hệt ở namenode/ và server/functions/ (mỗi thành phần
+# chạy độc lập từ thư mục của mình): sửa mọi bản cùng lúc, tests/test_shared_modules.py
+# kiểm tra các bản giống nhau.
+
+CATALOG_DDL = """
+-- chạy tuần tự khi upload server và NameNode cùng khởi động trên database mới
+SELECT pg_advisory_xact_lock(hashtext('catalog_ddl'));
+
+CREATE SCHEMA IF NOT EXISTS catalog;
+
+CREATE TABLE IF NOT EXISTS catalog.files (
+  file_base  TEXT PRIMARY KEY,
+  status     VARCHAR(10) NOT NULL DEFAULT 'uploading',
+  created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+CREATE TABLE IF NOT EXISTS catalog.blocks (
+  block_id  TEXT PRIMARY KEY,
+  file_base TEXT NOT NULL REFERENCES catalog.files (file_base) ON DELETE CASCADE,
+  block_num INT  NOT NULL,
+  status    VARCHAR(10) NOT NULL DEFAULT 'pending',
+  leader    TEXT,
+  followers TEXT[] NOT NULL DEFAULT '{}'
+);
+CREATE INDEX IF NOT EXISTS blocks_file_status_idx ON catalog.blocks (file_base, status);
+-- kết quả task do DataNode báo về khi hoàn tất (message 'complete')
+ALTER TABLE catalog.blocks ADD COLUMN IF NOT EXISTS duration_s REAL;
+ALTER TABLE catalog.blocks ADD COLUMN IF NOT EXISTS result     TEXT;
+-- manifest do splitter tạo: kiểm tra block không cần tải về, cân bằng theo kích thước
+ALTER TABLE catalog.blocks ADD COLUMN IF NOT EXISTS bytes      BIGINT;
+ALTER TABLE catalog.blocks ADD COLUMN IF NOT EXISTS rows       BIGINT;
+ALTER TABLE catalog.blocks ADD COLUMN IF NOT EXISTS crc32      BIGINT;
+ALTER TABLE catalog.blocks ADD COLUMN IF NOT EXISTS src_start  BIGINT;
+ALTER TABLE catalog.blocks ADD COLUMN IF NOT EXISTS src_end    BIGINT;
+-- zone map: min/max/nulls/ndv từng cột, NameNode dùng để bỏ qua block không khớp filter
+ALTER TABLE catalog.blocks ADD COLUMN IF NOT EXISTS zone_map   JSONB;
+-- nén block: codec chọn cho cả file; bytes/crc32 ở trên là của file đã nén, raw_bytes là CSV gốc
+ALTER TABLE catalog.files  ADD COLUMN IF NOT EXISTS codec      VARCHAR(8) NOT NULL DEFAULT 'none';
+ALTER TABLE catalog.blocks ADD COLUMN IF NOT EXISTS raw_bytes  BIGINT;
+-- số bản mỗi block (DEFAULT_REPLICATION), NameNode giữ đủ bằng re-replication
+ALTER TABLE catalog.files  ADD COLUMN IF NOT EXISTS replication SMALLINT NOT NULL DEFAULT 3;
+-- erasure = true: block lưu dạng fragment XOR 2+1 (placements.role 'ec0' | 'ec1' | 'ec2')
+ALTER TABLE catalog.files  ADD COLUMN IF NOT EXISTS erasure    BOOLEAN NOT NULL DEFAULT false;
+
+CREATE TABLE IF NOT EXISTS catalog.placements (
+  block_id TEXT NOT NULL REFERENCES catalog.blocks (block_id) ON DELETE CASCADE,
+  node_id  TEXT NOT NULL,
+  role     VARCHAR(10) NOT NULL,
+  PRIMARY KEY (block_id, node_id)
+);
+CREATE INDEX IF NOT EXISTS placements_node_idx ON catalog.placements (node_id);
+ALTER TABLE catalog.placements ADD COLUMN IF NOT EXISTS bytes BIGINT NOT NULL DEFAULT 0;
+
+-- số block / byte mỗi node đang giữ, trigger trên placements giữ cho khớp
+-- (kể cả khi placement bị xóa theo file) → chọn node ít tải không phải quét placements
+CREATE TABLE IF NOT EXISTS catalog.node_storage (
+  node_id TEXT PRIMARY KEY,
+  blocks  BIGINT NOT NULL DEFAULT 0,
+  bytes   BIGINT NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS node_storage_bytes_idx ON catalog.node_storage (bytes, node_id);
+
+CREATE OR REPLACE FUNCTION catalog.track_node_storage() RETURNS trigger AS $$
+BEGIN
+  IF TG_OP IN ('DELETE', 'UPDATE') THEN
+    UPDATE catalog.node_storage SET blocks = blocks - 1, bytes = bytes - OLD.bytes
+     WHERE node_id = OLD.node_id;
+  END IF;
+  IF TG_OP IN ('INSERT', 'UPDATE') THEN
+    INSERT INTO catalog.node_storage AS s (node_id, blocks, bytes)
+    VALUES (NEW.node_id, 1, NEW.bytes)
+    ON CONFLICT (node_id) DO UPDATE SET blocks = s.blocks + 1, bytes = s.bytes + EXCLUDED.bytes;
+  END IF;
+  RETURN NULL;
+END $$ LANGUAGE plpgsql;
+
+DO $$
+BEGIN
+  IF NOT EXISTS (SELECT 1 FROM pg_trigger WHERE tgname = 'placements_node_storage') THEN
+    -- lần đầu: điền bytes cho placement cũ và đếm counter trước khi bật trigger
+    UPDATE catalog.placements p SET bytes = b.bytes
+      FROM catalog.blocks b
+     WHERE b.block_id = p.block_id AND b.bytes IS NOT NULL;
+    INSERT INTO catalog.node_storage (node_id, blocks, bytes)
+    SELECT node_id, count(*), sum(bytes) FROM catalog.placements GROUP BY node_id
+    ON CONFLICT (node_id) DO UPDATE SET blocks = EXCLUDED.blocks, bytes = EXCLUDED.bytes;
+    CREATE TRIGGER placements_node_storage
+      AFTER INSERT OR DELETE OR UPDATE OF node_id, bytes ON catalog.placements
+      FOR EACH ROW EXECUTE FUNCTION catalog.track_node_storage();
+  END IF;
+END $$;
+"""
@@ -0,0 +1,156 @@
+# channels.py
+# Kênh task lâu dài NameNode → DataNode:
+#   - 1 kết nối TCP / DataNode, mở lần đầu cần gửi rồi giữ lại
+#   - mỗi message mang req_id; DataNode trả frame {'type': 'ack', 'req_id': ...}
+#   - nhiều message in-flight cùng lúc (pipelined), tối đa MAX_INFLIGHT → backpressure
+#   - message khác 'ack' từ DataNode được chuyển cho handler đăng ký bằng set_message_handler;
+#     handler chạy trên thread đọc nên phải trả về ngay (chỉ xếp hàng), không được send()
+#     qua kênh nào: kênh đầy thì send chờ ACK, mà ACK lại cần chính các thread đọc này
+
+import itertools
+import socket
+import threading
+
+from framing import send_frame, recv_frame
+
+MAX_INFLIGHT    = 64    # số message chưa ACK tối đa trên 1 kênh
+CONNECT_TIMEOUT = 5     # seconds
+ACK_TIMEOUT     = 30    # seconds, chỉ dùng khi send(..., wait=True)
+
+
+class ChannelClosed(ConnectionError):
+    """Kênh tới DataNode đã đóng (mất kết nối hoặc bị close)."""
+
+
+class TaskChannel:
+    """
+    Kết nối lâu dài tới task port của 1 DataNode, có 1 thread đọc ACK.
+    """
+
+    def __init__(self, node_id: str, max_inflight: int = MAX_INFLIGHT):
+        self.node_id = node_id
+        host, port = node_id.split(':')
+        self._sock = socket.create_connection((host, int(port)), timeout=CONNECT_TIMEOUT)
+        self._sock.settimeout(None)
+        self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._write_lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_inflight)
+        self._req_ids = itertools.count(1)
+        self._inflight = {}        # { req_id: [Event, ack | None] }
+        self._inflight_lock = threading.Lock()
+        self.closed = False
+        threading.Thread(target=self._reader_loop, daemon=True).start()
+
+    def send(self, payload: dict, wait: bool = False, timeout: float = ACK_TIMEOUT):
+        """
+        Gửi 1 message qua kênh. Chờ nếu đã có MAX_INFLIGHT message chưa ACK.
+        - wait=False: trả về req_id ngay sau khi ghi frame
+        - wait=True : chờ và trả về frame ACK (TimeoutError nếu quá timeout)
+        """
+        if self.closed:
+            raise ChannelClosed(f"channel to {self.node_id} closed")
+        self._slots.acquire()
+        req_id = next(self._req_ids)
+        waiter = [threading.Event(), None]
+        with self._inflight_lock:
+            self._inflight[req_id] = waiter
+        try:
+            with self._write_lock:
+                send_frame(self._sock, dict(payload, req_id=req_id))
+        except OSError as e:
+            self._finish(req_id, None)
+            self.close()
+            raise ChannelClosed(f"send to {self.node_id} failed: {e}") from e
+        if not wait:
+            return req_id
+        if not waiter[0].wait(timeout):
+            raise TimeoutError(f"no ack from {self.node_id} for req {req_id}")
+        if waiter[1] is None:
+            raise ChannelClosed(f"channel to {self.node_id} closed before ack")
+        return waiter[1]
+
+    def inflight(self) -> int:
+        with self._inflight_lock:
+            return len(self._inflight)
+
+    def _finish(self, req_id, ack):
+        with self._inflight_lock:
+            waiter = self._inflight.pop(req_id, None)
+        if waiter is not None:
+            waiter[1] = ack
+            waiter[0].set()
+            self._slots.release()
+
+    def _reader_loop(self):
+        try:
+            while True:
+                msg = recv_frame(self._sock)
+                if msg is None:
+                    break
+                if msg.get('type') == 'ack':
+                    if msg.get('status') != 'ok':
+                        print(f"[Channel] {self.node_id} rejected req {msg.get('req_id')}: {msg}")
+                    self._finish(msg.get('req_id'), msg)
+                elif _message_handler is not None:
+                    try:
+                        _message_handler(self.node_id, msg)
+                    except Exception as e:
+                        print(f"[Channel] Handler error for {msg}: {e}")
+        except (OSError, ValueError) as e:
+            if not self.closed:
+                print(f"[Channel] Read error from {self.node_id}: {e}")
+        self.close()
+
+    def close(self):
+        """Đóng kênh; các message chưa ACK được đánh dấu thất bại."""
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self._sock.close()
+        except OSError:
+            pass
+        with self._inflight_lock:
+            pending = list(self._inflight)
+        for req_id in pending:
+            self._finish(req_id, None)
+        if pending:
+            print(f"[Channel] {len(pending)} unacked message(s) to {self.node_id} dropped")
+        with _channels_lock:
+            if _channels.get(self.node_id) is self:
+                del _channels[self.node_id]
+
+
+_channels = {}            # { node_id: TaskChannel }
+_channels_lock = threading.Lock()
+_message_handler = None   # fn(node_id, msg) cho message DataNode gửi lên qua kênh
+
+
+def set_message_handler(fn):
+    global _message_handler
+    _message_handler = fn
+
+
+def get_channel(node_id: str) -> TaskChannel:
+    """Lấy kênh tới node_id, mở kết nối mới nếu chưa có hoặc kênh cũ đã đóng."""
+    with _channels_lock:
+        ch = _channels.get(node_id)
+    if ch is not None and not ch.closed:
+        return ch
+    # connect ngoài lock để 1 node chậm không chặn kênh tới node khác
+    new = TaskChannel(node_id)
+    with _channels_lock:
+        ch = _channels.get(node_id)
+        if ch is None or ch.closed:
+            _channels[node_id] = ch = new
+            new = None
+    if new is not None:
+        new.close()
+    return ch
+
+
+def close_channel(node_id: str):
+    with _channels_lock:
+        ch = _channels.get(node_id)
+    if ch is not None:
+        ch.close()
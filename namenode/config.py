@@ -2,9 +2,14 @@ SUPERUSER = 'postgres'
 SUPERUSER_PW = '12345'
 
 DB = {
-    'dbname':   'postgres',       # ban đầu kết nối để tạo DB
+    'dbname':   'postgres',       # database chứa schema catalog + active_node_manager
     'user':     SUPERUSER,
     'password': SUPERUSER_PW,
     'host':     'localhost',
     'port':     5432
 }
+
+
+# Upload server: NameNode gọi /finalize khi job xong để gộp kết quả
+UPLOAD_SERVER_HOST = '127.0.0.1'
+UPLOAD_SERVER_PORT = 5000
@@ -0,0 +1,180 @@
+# db.py
+# Lớp truy cập Postgres dùng chung cho NameNode:
+#   - pool thread-safe theo từng database (ThreadedConnectionPool + semaphore để chờ thay vì lỗi)
+#   - server-side prepared statements cho các câu query nóng (PREPARE 1 lần / connection)
+#   - thống kê sử dụng pool (pool_stats)
+
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+from psycopg2 import extensions, pool
+
+from config import DB
+
+POOL_MINCONN = 1
+POOL_MAXCONN = 10
+# COMMIT không chờ WAL flush (trước đây làm bằng SET LOCAL mỗi lần lấy connection)
+CONN_OPTIONS = '-c synchronous_commit=off'
+
+
+class PreparedConnection(extensions.connection):
+    """
+    Connection ghi nhớ các prepared statement đã PREPARE trên session của nó
+    và số lần được mượn từ pool (0 = connection mới mở, xem BlockingPool.getconn).
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+        self.checkouts = 0
+
+
+class BlockingPool:
+    """
+    ThreadedConnectionPool cho 1 database.
+    Khi hết connection thì chờ (semaphore) thay vì raise PoolError,
+    và đếm số lần mượn / chờ / connection mở mới.
+    """
+
+    def __init__(self, dbname: str, minconn: int = POOL_MINCONN, maxconn: int = POOL_MAXCONN):
+        params = dict(DB, dbname=dbname)
+        self.dbname = dbname
+        self.maxconn = maxconn
+        self._pool = pool.ThreadedConnectionPool(
+            minconn, maxconn,
+            connection_factory=PreparedConnection,
+            options=CONN_OPTIONS,
+            **params
+        )
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._lock = threading.Lock()
+        self._stats = {
+            'checkouts':   0,     # số lần getconn
+            'waits':       0,     # số lần phải chờ vì pool đầy
+            'wait_time':   0.0,   # tổng thời gian chờ (s)
+            'in_use':      0,
+            'peak_in_use': 0,
+            'opened':      0,     # số TCP connection đã mở tới Postgres
+            'discarded':   0,     # connection hỏng bị đóng bỏ
+        }
+
+    def getconn(self) -> PreparedConnection:
+        t0 = time.monotonic()
+        waited = not self._slots.acquire(blocking=False)
+        if waited:
+            self._slots.acquire()
+        try:
+            conn = self._pool.getconn()
+        except Exception:
+            self._slots.release()
+            raise
+        with self._lock:
+            st = self._stats
+            st['checkouts'] += 1
+            if waited:
+                st['waits'] += 1
+                st['wait_time'] += time.monotonic() - t0
+            st['in_use'] += 1
+            st['peak_in_use'] = max(st['peak_in_use'], st['in_use'])
+            # đếm theo chính connection: id() của connection pool đã đóng có thể được dùng lại
+            if not conn.checkouts:
+                st['opened'] += 1
+            conn.checkouts += 1
+        return conn
+
+    def putconn(self, conn, close: bool = False):
+        with self._lock:
+            self._stats['in_use'] -= 1
+            if close:
+                self._stats['discarded'] += 1
+        try:
+            self._pool.putconn(conn, close=close)
+        finally:
+            self._slots.release()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self._stats, maxconn=self.maxconn)
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(dbname: str = None) -> BlockingPool:
+    """
+    Lấy (tạo nếu chưa có) pool cho database `dbname` (mặc định DB['dbname']).
+    """
+    dbname = dbname or DB['dbname']
+    with _pools_lock:
+        p = _pools.get(dbname)
+        if p is None:
+            p = _pools[dbname] = BlockingPool(dbname)
+        return p
+
+
+@contextmanager
+def connection(dbname: str = None, autocommit: bool = True):
+    """
+    Mượn 1 connection từ pool của `dbname`, tự trả lại khi xong.
+    - autocommit=False: COMMIT khi block kết thúc bình thường, ROLLBACK nếu có exception.
+    - Connection bị hỏng (mất kết nối) sẽ bị đóng bỏ thay vì trả về pool.
+    """
+    p = get_pool(dbname)
+    conn = p.getconn()
+    broken = False
+    try:
+        conn.autocommit = autocommit
+        yield conn
+        if not autocommit:
+            conn.commit()
+    except Exception:
+        if conn.closed:
+            broken = True
+        else:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                broken = True
+        raise
+    finally:
+        p.putconn(conn, close=broken or bool(conn.closed))
+
+
+# ─── Prepared Statements ─────────────────────────────────────────────────────
+
+STATEMENTS = {}   # { name: (argtypes, sql dùng $1, $2, ...) }
+
+
+def register_statement(name: str, argtypes: tuple, sql_text: str):
+    """
+    Khai báo 1 prepared statement; PREPARE sẽ chạy lười ở lần đầu dùng trên mỗi connection.
+    """
+    STATEMENTS[name] = (tuple(argtypes), sql_text)
+
+
+def execute_prepared(cur, name: str, params: tuple = ()):
+    """
+    EXECUTE prepared statement `name` với params, PREPARE trước nếu connection chưa có.
+    """
+    conn = cur.connection
+    if name not in conn.prepared:
+        argtypes, sql_text = STATEMENTS[name]
+        types = f" ({', '.join(argtypes)})" if argtypes else ''
+        cur.execute(f"PREPARE {name}{types} AS {sql_text}")
+        conn.prepared.add(name)
+    if params:
+        cur.execute(f"EXECUTE {name} ({', '.join(['%s'] * len(params))})", params)
+    else:
+        cur.execute(f"EXECUTE {name}")
+
+
+def pool_stats() -> dict:
+    """
+    Thống kê sử dụng của mọi pool: { dbname: {...} }.
+    """
+    with _pools_lock:
+        pools = list(_pools.values())
+    return {p.dbname: p.stats() for p in pools}
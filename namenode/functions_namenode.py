@@ -1,28 +1,52 @@
-import psycopg2
-from psycopg2 import pool, sql
-from config import DB
-import time
-
-# ─── Connection Pool ───────────────────────────────────────────────────────────
-# Khởi connection pool khi module load
-# minconn=1, maxconn=10 (tùy nhu cầu)
-db_pool = psycopg2.pool.SimpleConnectionPool(
-    minconn=1,
-    maxconn=10,
-    **DB
-)
-
-
-def get_pooled_conn():
-    """
-    Lấy connection từ pool, tắt synchronous_commit để COMMIT nhanh.
-    Caller phải putconn lại sau khi xong.
-    """
-    conn = db_pool.getconn()
-    conn.autocommit = False
-    with conn.cursor() as cur:
-        cur.execute("SET LOCAL synchronous_commit = OFF;")
-    return conn
+import json
+import urllib.error
+import urllib.request
+
+from catalog_ddl import CATALOG_DDL
+from channels import get_channel
+from config import UPLOAD_SERVER_HOST, UPLOAD_SERVER_PORT
+from db import connection, execute_prepared, register_statement
+
+FINALIZE_TIMEOUT = 600  # seconds, merge kết quả job lớn trên upload server
+PREPARE_TIMEOUT = 30    # seconds, xóa kết quả cũ của job trên upload server
+
+# ─── Prepared Statements ───────────────────────────────────────────────────────
+# Các câu query nóng (heartbeat, lập lịch) được PREPARE 1 lần trên mỗi connection của pool.
+
+register_statement('upsert_node', ('text', 'text', 'int'), """
+    INSERT INTO active_node_manager (node_id, status, slots)
+    VALUES ($1, $2, COALESCE($3, 1))
+    ON CONFLICT (node_id) DO UPDATE
+      SET status = EXCLUDED.status,
+          slots  = COALESCE($3, active_node_manager.slots)
+""")
+
+register_statement('remove_node', ('text',), """
+    WITH del_placements AS (
+        DELETE FROM catalog.placements WHERE node_id = $1
+    )
+    DELETE FROM active_node_manager WHERE node_id = $1
+""")
+
+register_statement('file_blocks', ('text',), """
+    SELECT block_id, bytes, crc32, zone_map FROM catalog.blocks
+     WHERE file_base = $1
+     ORDER BY block_num
+""")
+
+register_statement('file_status', ('text',), """
+    SELECT status FROM catalog.files WHERE file_base = $1
+""")
+
+register_statement('block_manifests', ('text[]',), """
+    SELECT b.block_id, b.bytes, b.crc32, b.file_base, f.replication, f.erasure
+      FROM catalog.blocks b JOIN catalog.files f USING (file_base)
+     WHERE b.block_id = ANY($1)
+""")
+
+register_statement('file_settings', ('text',), """
+    SELECT codec, replication, erasure FROM catalog.files WHERE file_base = $1
+""")
 
 
 # ─── Metadata Table ──────────────────────────────────────────────────────────
@@ -32,306 +56,258 @@ def init_active_node_manager_table():
     Tạo bảng active_node_manager nếu chưa tồn tại:
       - node_id TEXT PRIMARY KEY
       - status  VARCHAR(10) NOT NULL
-      - task    TEXT DEFAULT 'free'
-      - storage TEXT
+      - task    TEXT DEFAULT 'free'   (block leader giao gần nhất, 'free' khi rảnh)
+      - slots   INT  DEFAULT 1        (số task DataNode chạy đồng thời)
     """
-    conn = get_pooled_conn()
-    try:
-        with conn.cursor() as cur:
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS active_node_manager (
-                    node_id TEXT PRIMARY KEY,
-                    status  VARCHAR(10) NOT NULL,
-                    task    TEXT DEFAULT 'free',
-                    storage TEXT
-                );
-            """)
-        conn.commit()
-    finally:
-        db_pool.putconn(conn)
+    with connection() as conn, conn.cursor() as cur:
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS active_node_manager (
+                node_id TEXT PRIMARY KEY,
+                status  VARCHAR(10) NOT NULL,
+                task    TEXT DEFAULT 'free'
+            );
+            ALTER TABLE active_node_manager ADD COLUMN IF NOT EXISTS slots INT NOT NULL DEFAULT 1;
+            -- replica giờ nằm ở catalog.placements (+ counter catalog.node_storage),
+            -- không còn chuỗi block_id nối bằng dấu phẩy
+            ALTER TABLE active_node_manager DROP COLUMN IF EXISTS storage;
+        """)
+
+
+def upsert_node(node_id: str, status: str = 'alive', slots: int = None):
+    """
+    Chèn mới hoặc cập nhật status (và số slot nếu có) của datanode.
+    """
+    with connection() as conn, conn.cursor() as cur:
+        execute_prepared(cur, 'upsert_node', (node_id, status, slots))
 
 
-def upsert_node(node_id: str, status: str = 'alive'):
+def remove_node(node_id: str):
     """
-    Chèn mới hoặc cập nhật status của datanode.
+    Xóa entry datanode theo node_id cùng các placement của nó (replica trên node chết
+    coi như mất; scheduler chép lại block lên node khác).
     """
-    conn = get_pooled_conn()
-    try:
-        with conn.cursor() as cur:
-            cur.execute(
-                sql.SQL("""
-                    INSERT INTO active_node_manager (node_id, status)
-                    VALUES (%s, %s)
-                    ON CONFLICT (node_id) DO UPDATE
-                      SET status = EXCLUDED.status
-                """),
-                (node_id, status)
-            )
-        conn.commit()
-    finally:
-        db_pool.putconn(conn)
+    with connection() as conn, conn.cursor() as cur:
+        execute_prepared(cur, 'remove_node', (node_id,))
 
 
-def remove_node(node_id: str):
+# ─── Block Catalog ───────────────────────────────────────────────────────────
+# Bảng catalog.files / catalog.blocks / catalog.placements / catalog.node_storage
+# (catalog_ddl.py, upload server và NameNode cùng tạo), dùng chung 1 database với
+# active_node_manager.
+
+def init_catalog_schema():
     """
-    Xóa entry datanode theo node_id.
+    Tạo schema catalog nếu chưa có (idempotent, cùng DDL với upload server), để NameNode
+    khởi động được trên database mới trước lần upload đầu tiên.
     """
-    conn = get_pooled_conn()
-    try:
-        with conn.cursor() as cur:
-            cur.execute(
-                sql.SQL("DELETE FROM active_node_manager WHERE node_id = %s"),
-                (node_id,)
-            )
-        conn.commit()
-    finally:
-        db_pool.putconn(conn)
+    with connection() as conn, conn.cursor() as cur:
+        cur.execute(CATALOG_DDL)
 
 
-def has_free_node() -> bool:
+def get_file_blocks(file_base: str) -> list[tuple]:
     """
-    Trả về True nếu còn ít nhất 1 datanode alive mà đang free (task='free').
+    Lấy các block của file_base từ catalog.blocks, theo thứ tự block:
+    [(block_id, bytes, crc32, zone_map), ...] — lấy từ manifest (None nếu không có).
     """
-    conn = psycopg2.connect(**DB)
-    try:
-        with conn.cursor() as cur:
-            cur.execute("""
-                SELECT COUNT(*)
-                  FROM active_node_manager
-                 WHERE status='alive'
-                   AND task = 'free';
-            """)
-            return cur.fetchone()[0] > 0
-    finally:
-        conn.close()
+    with connection() as conn, conn.cursor() as cur:
+        execute_prepared(cur, 'file_blocks', (file_base,))
+        return cur.fetchall()
 
 
-# ─── File DB Connection ──────────────────────────────────────────────────────
+def get_block_manifests(block_ids: list[str]) -> dict:
+    """
+    Manifest của các block: { block_id: (bytes, crc32, file_base, replication, erasure) }
+    (chỉ block có trong catalog). Dùng để kiểm tra block report của DataNode trước khi
+    ghi nhận vị trí replica, và để biết số bản cần giữ của block.
+    """
+    if not block_ids:
+        return {}
+    with connection() as conn, conn.cursor() as cur:
+        execute_prepared(cur, 'block_manifests', (list(block_ids),))
+        return {row[0]: tuple(row[1:]) for row in cur.fetchall()}
+
 
-def get_file_conn(file_base: str):
+def get_file_settings(file_base: str) -> tuple:
     """
-    Kết nối tới database tương ứng file_base.
+    (codec, replication, erasure) của file, chọn lúc upload:
+      - codec: nén block (catalog.files.codec: 'none' | 'gzip' | 'lzma' | 'bz2'),
+        DataNode cần biết để giải nén block khi compute
+      - replication: số bản mỗi block (leader + followers), None nếu file chưa có trong catalog
+      - erasure: block lưu dạng fragment XOR 2+1 thay vì follower giữ bản đầy đủ
     """
-    params = DB.copy()
-    params['dbname'] = file_base
-    return psycopg2.connect(**params)
+    with connection() as conn, conn.cursor() as cur:
+        execute_prepared(cur, 'file_settings', (file_base,))
+        row = cur.fetchone()
+        return tuple(row) if row else ('none', None, False)
 
 
-def get_file_block_ids(file_base: str) -> list[str]:
+def is_ingest_open(file_base: str) -> bool:
     """
-    Lấy danh sách block_id từ bảng file_base.
+    True nếu file đang được upload streaming (catalog.files.status = 'uploading'),
+    tức là có thể còn block mới được đăng ký thêm.
     """
-    conn = get_file_conn(file_base)
-    try:
-        with conn.cursor() as cur:
-            tbl = sql.Identifier(file_base)
-            cur.execute(
-                sql.SQL("SELECT block_id FROM {} ORDER BY block_id;").format(tbl)
-            )
-            return [row[0] for row in cur.fetchall()]
-    finally:
-        conn.close()
+    with connection() as conn, conn.cursor() as cur:
+        execute_prepared(cur, 'file_status', (file_base,))
+        row = cur.fetchone()
+        return bool(row) and row[0] == 'uploading'
+
+
+# ─── Task Assignment (durable record) ─────────────────────────────────────────
+# Quyết định lập lịch nằm trong bộ nhớ (scheduler.py); các hàm dưới đây chỉ ghi lại
+# kết quả xuống Postgres và được gọi bất đồng bộ từ thread persist của scheduler.
+
+register_statement('persist_assignment', ('text', 'text', 'text[]', 'bigint'), """
+    WITH upd_leader AS (
+        UPDATE active_node_manager SET task = $1 WHERE node_id = $2
+    ),
+    upd_block AS (
+        UPDATE catalog.blocks SET
+          leader    = $2,
+          followers = $3,
+          status    = 'processing'
+         WHERE block_id = $1
+    ),
+    ins_placements AS (
+        INSERT INTO catalog.placements (block_id, node_id, role, bytes)
+        SELECT $1, $2, 'leader', $4
+        UNION ALL
+        SELECT $1, f, 'storage', $4 FROM unnest($3) AS f
+        ON CONFLICT (block_id, node_id) DO UPDATE
+          SET role = EXCLUDED.role, bytes = EXCLUDED.bytes
+    )
+    SELECT 1
+""")
+
+register_statement('requeue_leader_blocks', ('text',), """
+    WITH reset AS (
+        UPDATE catalog.blocks SET leader = NULL, status = 'pending'
+         WHERE leader = $1 AND status = 'processing'
+        RETURNING block_id
+    ),
+    del_placements AS (
+        DELETE FROM catalog.placements p USING reset r
+         WHERE p.block_id = r.block_id AND p.node_id = $1
+    )
+    SELECT count(*) FROM reset
+""")
+
+register_statement('complete_block', ('text', 'text', 'text', 'real', 'text'), """
+    WITH upd_block AS (
+        UPDATE catalog.blocks SET
+          status     = $3,
+          duration_s = $4,
+          result     = $5
+         WHERE block_id = $1 AND leader = $2
+    ),
+    free_node AS (
+        UPDATE active_node_manager SET task = 'free'
+         WHERE node_id = $2 AND task = $1
+    )
+    SELECT 1
+""")
+
+register_statement('add_placement', ('text', 'text', 'text', 'bigint'), """
+    INSERT INTO catalog.placements (block_id, node_id, role, bytes)
+    VALUES ($1, $2, $3, $4)
+    ON CONFLICT (block_id, node_id) DO UPDATE
+      SET role = EXCLUDED.role, bytes = EXCLUDED.bytes
+""")
+
+register_statement('node_storage_bytes', (), """
+    SELECT node_id, bytes FROM catalog.node_storage
+""")
+
+
+def persist_assignment(block_id: str, leader: str, followers: list[str], nbytes: int = 0):
+    """
+    Ghi lại 1 lần assign: task của leader, leader/followers/status trên catalog.blocks
+    và 1 dòng catalog.placements (node, block, role, bytes) cho mỗi node (1 round trip).
+    Counter catalog.node_storage được trigger trên placements cập nhật.
+    """
+    with connection() as conn, conn.cursor() as cur:
+        execute_prepared(cur, 'persist_assignment', (block_id, leader, followers, nbytes or 0))
 
 
-# ─── Task Assignment ──────────────────────────────────────────────────────────
+def persist_placement(block_id: str, node_id: str, nbytes: int = 0, role: str = 'storage'):
+    """
+    Ghi 1 replica ngoài lần assign vào catalog.placements: role 'storage' (task storage
+    dự phòng / re-replication) hoặc 'ec<i>' (fragment erasure i của block).
+    """
+    with connection() as conn, conn.cursor() as cur:
+        execute_prepared(cur, 'add_placement', (block_id, node_id, role, nbytes or 0))
 
-def assign_task_auto(task: str) -> bool:
+
+def requeue_leader_blocks(node_id: str):
     """
-    Tự động chọn 1 leader free + 2 followers ít storage,
-    cập nhật task/storage trên active_node_manager
-    và cập nhật leader/followers/status trên bảng block-manager.
-    Trả về True nếu thành công, False nếu không có node free.
+    Node leader đã chết: các block nó đang xử lý quay về 'pending' trong catalog
+    (scheduler sẽ giao lại cho node khác).
     """
-    print("run assigntask auto")
-    # 1) Kiểm tra free node
-    if not has_free_node():
-        print("no free node")
-        return False
+    with connection() as conn, conn.cursor() as cur:
+        execute_prepared(cur, 'requeue_leader_blocks', (node_id,))
+        n = cur.fetchone()[0]
+    if n:
+        print(f"[NameNode] Requeued {n} block(s) of dead leader {node_id}")
 
-    # 2) Chọn leader & followers
-    conn_meta = psycopg2.connect(**DB)
-    try:
-        with conn_meta.cursor() as cur:
-            cur.execute("""
-                SELECT node_id FROM active_node_manager
-                 WHERE status='alive' AND task='free'
-                 ORDER BY node_id LIMIT 1;
-            """)
-            row = cur.fetchone()
-            leader = row[0]
-            cur.execute("""
-                SELECT node_id FROM active_node_manager
-                 WHERE status='alive' AND node_id <> %s
-                 ORDER BY
-                   CASE WHEN storage IS NULL OR storage = '' THEN 0
-                        ELSE cardinality(string_to_array(storage, ',')) END
-                 LIMIT 2;
-            """, (leader,))
-            followers = [r[0] for r in cur.fetchall()]
-    finally:
-        conn_meta.close()
-
-    # 3) Cập nhật metadata (chờ nếu không free? Already checked)
-    conn_meta = psycopg2.connect(**DB)
-    try:
-        with conn_meta.cursor() as cur:
-            cur.execute(
-                "UPDATE active_node_manager SET task=%s WHERE node_id=%s;",
-                (task, leader)
-            )
-            for nd in followers:
-                cur.execute(
-                    """
-                    UPDATE active_node_manager SET
-                      storage = CASE
-                                  WHEN storage IS NULL OR storage = ''
-                                    THEN %s
-                                  ELSE storage || ',' || %s
-                                END
-                     WHERE node_id = %s;
-                    """, (task, task, nd)
-                )
-        conn_meta.commit()
-    finally:
-        conn_meta.close()
-
-    # 4) Cập nhật block-manager table
-    file_base = task.rsplit('.csv',1)[0].rsplit('_block',1)[0]
-    conn_file = get_file_conn(file_base)
-    try:
-        with conn_file.cursor() as cur:
-            tbl = sql.Identifier(file_base)
-            cur.execute(
-                sql.SQL("""
-                    UPDATE {} SET
-                      leader    = %s,
-                      followers = %s,
-                      status    = 'processing'
-                     WHERE block_id = %s;
-                """).format(tbl),
-                (leader, followers, task)
-            )
-        conn_file.commit()
-    finally:
-        conn_file.close()
-
-
-    send_to_datanode(leader, {
-        'type': 'task',
-        'role': 'leader',
-        'block_id': task,
-        'file': file_base
-    })
-    for nd in followers:
-        send_to_datanode(nd, {
-            'type': 'task',
-            'role': 'storage',
-            'block_id': task,
-            'file': file_base
-        })
-
-    return True
-
-
-def process_file_tasks(file_base: str, poll_interval: float = 2.0) -> None:
-    """
-    Với mỗi block trong file_base, chờ đến khi có node free rồi gọi assign_task_auto.
-    """
-    block_ids = get_file_block_ids(file_base)
-    for blk in block_ids:
-        # đợi cho đến khi assign thành công
-        while True:
-            if assign_task_auto(blk):
-                print(f"Assigned {blk}")
-                break
-            # chưa có node free, chờ
-            time.sleep(poll_interval)
+
+def persist_completion(block_id: str, leader: str, status: str, duration: float, result: str):
+    """
+    Ghi kết quả task của leader: status 'done' | 'failed' (hoặc 'pending' khi sẽ chạy lại),
+    thời gian chạy, vị trí kết quả; trả task của leader về 'free'.
+    """
+    with connection() as conn, conn.cursor() as cur:
+        execute_prepared(cur, 'complete_block', (block_id, leader, status, duration, result))
+
+
+def load_node_storage_bytes() -> dict:
+    """
+    Số byte mỗi node đang giữ theo catalog.node_storage: { node_id: bytes }.
+    Dùng để khởi tạo view trong bộ nhớ của scheduler khi NameNode khởi động
+    (đọc counter, không quét placements).
+    """
+    with connection() as conn, conn.cursor() as cur:
+        execute_prepared(cur, 'node_storage_bytes')
+        return dict(cur.fetchall())
 
 
 def send_to_datanode(node_id: str, payload: dict):
     """
-    Mở kết nối tới DataNode và gửi payload JSON.
-    node_id có định dạng 'host_port', ví dụ '127.0.0.1_6001'.
+    Gửi payload cho DataNode qua kênh task lâu dài (channels.py), không mở TCP mới mỗi lần.
+    node_id có định dạng 'host:port', ví dụ '127.0.0.1:6001'.
+    Trả về req_id; DataNode ACK bất đồng bộ.
     """
-    host, port = node_id.split(':')
-    port = int(port)
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-        s.connect((host, port))
-        s.sendall(json.dumps(payload).encode('utf-8'))
-        # (nếu DataNode cần ACK, bạn có thể đọc lại ở đây)
+    return get_channel(node_id).send(payload)
 
 
-def get_table_name_from_block_id(block_id: str) -> str:
+def _post_upload_server(route: str, body: dict, timeout: float) -> dict:
+    """POST JSON tới upload server, trả về response JSON (kể cả khi HTTP lỗi)."""
+    req = urllib.request.Request(
+        f"http://{UPLOAD_SERVER_HOST}:{UPLOAD_SERVER_PORT}{route}",
+        data=json.dumps(body).encode('utf-8'),
+        headers={'Content-Type': 'application/json'},
+        method='POST')
+    try:
+        with urllib.request.urlopen(req, timeout=timeout) as resp:
+            return json.loads(resp.read())
+    except urllib.error.HTTPError as e:
+        try:
+            return json.loads(e.read())
+        except ValueError:
+            return {'status': 'error', 'error': str(e)}
+
+
+def prepare_job_results(file_base: str, job_id: str) -> dict:
     """
-    Chuyển block_id ('alogs_block1.csv') -> table_name ('alogs')
+    Gọi /prepare của upload server trước khi job chạy: xóa thư mục kết quả cũ
+    cùng job_id (nếu có) để /finalize chỉ gộp kết quả của job này.
+    Trả về response JSON ({'status', 'cleared'}).
     """
-    file_base = block_id.rsplit('.csv', 1)[0].rsplit('_block', 1)[0]
-    table_name = file_base.replace('.', '_')
-    return table_name
+    return _post_upload_server('/prepare', {'file': file_base, 'job_id': job_id}, PREPARE_TIMEOUT)
 
 
-def reassign_leader_on_disconnect(old_leader_id: str):
+def finalize_job_results(file_base: str, job_id: str, spec: dict) -> dict:
     """
-    Khi node leader disconnect, chuyển quyền leader cho follower đầu tiên,
-    cập nhật lại bảng block-manager và active_node_manager.
+    Gọi /finalize của upload server: gộp kết quả từng block/partition của job
+    thành 1 file. Trả về response JSON ({'status', 'rows', 'result'}).
     """
-    conn_meta = psycopg2.connect(**DB)
-    try:
-        with conn_meta.cursor() as cur:
-            # 1. Lấy block node này đang làm leader (task)
-            cur.execute("""
-                SELECT task FROM active_node_manager
-                 WHERE node_id = %s
-            """, (old_leader_id,))
-            row = cur.fetchone()
-            if not row or not row[0]:
-                print(f"Node {old_leader_id} không có task để reassign.")
-                return
-            block_id = row[0]
-
-            # 2. Xác định table
-            table = get_table_name_from_block_id(block_id)
-
-            # 3. Lấy followers hiện tại
-            cur.execute(
-                sql.SQL('SELECT followers FROM {} WHERE block_id = %s').format(
-                    sql.Identifier(table)),
-                (block_id,))
-            result = cur.fetchone()
-            if not result or not result[0]:
-                print(f"Block {block_id} không có followers.")
-                return
-            followers = result[0]
-            if not followers:
-                print(f"Block {block_id} không có followers.")
-                return
-
-            # 4. Chọn follower đầu tiên làm leader mới
-            new_leader = followers[0]
-            new_followers = followers[1:] if len(followers) > 1 else []
-
-            # 5. Update block-manager table
-            cur.execute(
-                sql.SQL("""
-                    UPDATE {} SET leader = %s, followers = %s, status = 'processing'
-                     WHERE block_id = %s
-                """).format(sql.Identifier(table)),
-                (new_leader, new_followers, block_id)
-            )
-
-            # 6. Update active_node_manager cho leader mới
-            cur.execute(
-                "UPDATE active_node_manager SET task = %s WHERE node_id = %s",
-                (block_id, new_leader)
-            )
-            print(f"Reassigned leader of {block_id} to {new_leader}")
-
-            # 7. Optionally xóa task của node cũ (vì đã disconnect)
-            cur.execute(
-                "UPDATE active_node_manager SET task = 'free' WHERE node_id = %s",
-                (old_leader_id,)
-            )
-
-        conn_meta.commit()
-    finally:
-        conn_meta.close()
+    return _post_upload_server('/finalize', {'file': file_base, 'job_id': job_id, 'spec': spec},
+                               FINALIZE_TIMEOUT)
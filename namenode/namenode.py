@@ -1,125 +1,200 @@
 # namenode.py
 
-import socket
-import threading
-import json
+import asyncio
 import time
 
 from functions_namenode import *
+from channels import close_channel
+from db import pool_stats
+from framing import read_frame, write_frame
+from scheduler import scheduler
 
 HOST = ''       # listen on all interfaces
 PORT = 5001     # port for DataNode connections
+BACKLOG = 4096  # cho phép hàng nghìn DataNode kết nối cùng lúc
 
-# in-memory heartbeat timestamps
+# in-memory heartbeat timestamps (chỉ truy cập từ event loop → không cần lock)
 datanodes = {}  # { node_id: last_heartbeat_timestamp }
-lock = threading.Lock()
+monitor_task = None   # asyncio.Task của monitor_datanodes
 
 HEARTBEAT_TIMEOUT = 15   # seconds without heartbeat → dead
 MONITOR_INTERVAL  = 10   # seconds between status scans
 
-def handle_client(conn, addr):
-    """Handle a single DataNode connection."""
-    with conn:
-        print(f"[NameNode] New connection from {addr}")
+
+async def run_blocking(fn, *args):
+    """Chạy hàm blocking (DB, lập lịch) trên thread pool để không chặn event loop."""
+    return await asyncio.get_running_loop().run_in_executor(None, fn, *args)
+
+
+async def purge_dead_node(node_id: str) -> bool:
+    """
+    Xóa node khỏi view trong bộ nhớ, scheduler và active_node_manager.
+    Monitor và cleanup lúc ngắt kết nối có thể cùng purge 1 node (mỗi bên duyệt snapshot
+    riêng, nhường nhau ở await) → bên đến sau bỏ qua. Trả về True nếu lần này đã purge.
+    """
+    if datanodes.pop(node_id, None) is None:
+        return False
+    scheduler.remove_node(node_id)
+    close_channel(node_id)
+    await run_blocking(remove_node, node_id)
+    return True
+
+
+async def apply_block_report(node_id: str, added: list, removed: list = (), full: bool = False) -> int:
+    """Kiểm tra block report với manifest trong catalog rồi cập nhật index block → locations."""
+    added = [e for e in added or [] if isinstance(e, list) and len(e) == 3]
+    manifests = await run_blocking(get_block_manifests, sorted({e[1] for e in added})) if added else {}
+    return scheduler.apply_block_report(node_id, added, removed or [], manifests, full)
+
+
+async def handle_message(msg: dict) -> dict:
+    """Xử lý 1 message đã giải mã, trả về response."""
+    typ = msg.get('type')
+    node_id = msg.get('id')
+
+    if typ == 'register':
+        # register node
+        try:
+            slots = max(int(msg.get('slots', 1)), 1)
+            peer_port = int(msg['peer_port']) if msg.get('peer_port') else None
+        except (TypeError, ValueError):
+            return {'status': 'bad_request', 'error': 'bad slots / peer_port'}
+        datanodes[node_id] = time.time()
+        await run_blocking(upsert_node, node_id, 'alive', slots)
+        scheduler.add_node(node_id, slots, peer_port)
+        # block report: các block node đã có trên đĩa (task/, storage/) → không phải tải lại
+        nblocks = await apply_block_report(node_id, msg.get('blocks'), full=True)
+        print(f"[NameNode] Registered DataNode '{node_id}' ({slots} slots, {nblocks} block(s) reported)")
+        return {'status': 'registered'}
+
+    elif typ == 'heartbeat':
+        # refresh heartbeat
+        if node_id not in datanodes:
+            return {'status': 'unknown_node'}
+        datanodes[node_id] = time.time()
+        await run_blocking(upsert_node, node_id, 'alive')
+        scheduler.add_node(node_id)
+        if msg.get('added') or msg.get('removed'):
+            # delta block report kèm heartbeat
+            await apply_block_report(node_id, msg.get('added'), msg.get('removed'))
+            print(f"[NameNode] Heartbeat from '{node_id}' "
+                  f"(+{len(msg.get('added') or [])} / -{len(msg.get('removed') or [])} block(s))")
+        else:
+            print(f"[NameNode] Heartbeat from '{node_id}'")
+        return {'status': 'alive'}
+
+    elif typ == 'compute':
+        # msg['file'] is the base filename (no .csv); msg['spec'] đã được upload server kiểm tra
+        # job chạy nền, trả job_id ngay
+        file_base = msg.get('file')
+        if not file_base:
+            return {'status': 'error', 'error': 'missing file'}
+        spec = msg.get('spec')
+        if spec is not None and not isinstance(spec, dict):
+            return {'status': 'error', 'error': 'bad spec'}
+        try:
+            job_id = scheduler.submit_job(file_base, msg.get('priority', 1), spec)
+        except (TypeError, ValueError) as e:
+            return {'status': 'error', 'error': f'bad priority: {e}'}
+        return {'status': 'ok', 'file': file_base, 'job_id': job_id}
+
+    elif typ == 'job_status':
+        job = scheduler.job_status(msg.get('job_id'))
+        if job is None:
+            return {'status': 'error', 'error': 'unknown job'}
+        return {'status': 'ok', 'job': job}
+
+    # unknown message type
+    return {'status': 'bad_request'}
+
+
+async def handle_client(reader, writer):
+    """Handle a single connection (DataNode hoặc upload server)."""
+    addr = writer.get_extra_info('peername')
+    print(f"[NameNode] New connection from {addr}")
+    try:
         while True:
-            try:
-                raw = conn.recv(1024)
-                if not raw:
-                    break
-
-                msg = json.loads(raw.decode('utf-8'))
-                typ = msg.get('type')
-                node_id = msg.get('id')
-
-                with lock:
-                    if typ == 'register':
-                        # register node
-                        datanodes[node_id] = time.time()
-                        upsert_node(node_id, 'alive')
-                        conn.sendall(b'{"status":"registered"}')
-                        print(f"[NameNode] Registered DataNode '{node_id}'")
-
-                    elif typ == 'compute':
-                        file_base = msg.get('file')
-                        process_file_tasks(file_base)
-                    elif typ == 'heartbeat':
-                        # refresh heartbeat
-                        if node_id in datanodes:
-                            datanodes[node_id] = time.time()
-                            upsert_node(node_id, 'alive')
-                            conn.sendall(b'{"status":"alive"}')
-                            print(f"[NameNode] Heartbeat from '{node_id}'")
-                        else:
-                            conn.sendall(b'{"status":"unknown_node"}')
-
-                    elif typ == 'compute':
-                        # msg['file'] is the base filename (no .csv)
-                        file_base = msg.get('file')
-                        try:
-                            # assign tasks for all blocks of this file
-                            process_file_tasks(file_base)
-                            resp = {'status':'ok', 'file': file_base}
-                            conn.sendall(json.dumps(resp).encode('utf-8'))
-                            print(f"[NameNode] Computed tasks for '{file_base}'")
-                        except Exception as e:
-                            err = {'status':'error', 'error': str(e)}
-                            conn.sendall(json.dumps(err).encode('utf-8'))
-                            print(f"[NameNode] Compute error: {e}")
-
-                    else:
-                        # unknown message type
-                        conn.sendall(b'{"status":"bad_request"}')
-
-            except Exception as e:
-                print(f"[NameNode] Connection error: {e}")
+            msg = await read_frame(reader)
+            if msg is None:
                 break
-
-        # connection closed: clean up any dead nodes
-        print(f"[NameNode] Disconnected {addr}")
-        with lock:
-            for nid, ts in list(datanodes.items()):
-                if time.time() - ts > HEARTBEAT_TIMEOUT:
-                    remove_node(nid)
-                    reassign_leader_on_disconnect(node_id)
-                    del datanodes[nid]
-                    print(f"[NameNode] Removed dead DataNode '{nid}'")
-
-def monitor_datanodes():
+            resp = await handle_message(msg)
+            await write_frame(writer, resp)
+    except Exception as e:
+        print(f"[NameNode] Connection error: {e}")
+    finally:
+        writer.close()
+
+    # connection closed: clean up any dead nodes
+    print(f"[NameNode] Disconnected {addr}")
+    now = time.time()
+    for nid, ts in list(datanodes.items()):
+        if now - ts > HEARTBEAT_TIMEOUT and await purge_dead_node(nid):
+            print(f"[NameNode] Removed dead DataNode '{nid}'")
+
+
+async def monitor_datanodes():
     """Periodically print status and purge timed-out nodes."""
     while True:
-        time.sleep(MONITOR_INTERVAL)
-        now = time.time()
-        with lock:
-            print("=== NameNode Status ===")
-            for node, ts in list(datanodes.items()):
-                age = now - ts
-                state = "alive" if age < HEARTBEAT_TIMEOUT else "dead"
-                print(f"  - {node}: last heartbeat {age:.1f}s ago → {state}")
-                if state == "dead":
-                    remove_node(node)
-                    del datanodes[node]
-                    print(f"    → Removed dead DataNode '{node}'")
-            print("========================")
+        await asyncio.sleep(MONITOR_INTERVAL)
+        try:
+            await monitor_once()
+        except Exception as e:
+            # 1 lượt lỗi (VD Postgres tạm mất) không được làm dừng việc phát hiện node chết
+            print(f"[NameNode] Monitor error: {e!r}")
+
+
+async def monitor_once():
+    """1 lượt monitor: in trạng thái, purge node quá hạn heartbeat."""
+    now = time.time()
+    print("=== NameNode Status ===")
+    print(f"  DataNodes: {len(datanodes)}")
+    for node, ts in list(datanodes.items()):
+        age = now - ts
+        if age >= HEARTBEAT_TIMEOUT:
+            print(f"  - {node}: last heartbeat {age:.1f}s ago → dead")
+            if await purge_dead_node(node):
+                print(f"    → Removed dead DataNode '{node}'")
+    rep = scheduler.replication_status()
+    print(f"  Blocks: {rep['under_replicated']} under-replicated, "
+          f"{rep['replicating']} replica(s) being copied")
+    for dbname, st in pool_stats().items():
+        print(f"  [pool {dbname}] in_use={st['in_use']}/{st['maxconn']} "
+              f"peak={st['peak_in_use']} opened={st['opened']} "
+              f"checkouts={st['checkouts']} waits={st['waits']} "
+              f"wait={st['wait_time']:.3f}s")
+    print("========================")
+
+
+def _on_monitor_done(task: asyncio.Task):
+    """Monitor dừng (lỗi ngoài dự kiến / bị hủy): log lại thay vì mất lặng lẽ."""
+    if task.cancelled():
+        print("[NameNode] Monitor task cancelled")
+    elif task.exception() is not None:
+        print(f"[NameNode] Monitor task died: {task.exception()!r}")
+
+
+async def serve():
+    # ensure the metadata table + block catalog exist (không phụ thuộc upload server đã chạy)
+    await run_blocking(init_active_node_manager_table)
+    await run_blocking(init_catalog_schema)
+    await run_blocking(scheduler.start)
+
+    # start monitor task (giữ tham chiếu: event loop chỉ giữ weak ref tới task)
+    global monitor_task
+    monitor_task = asyncio.create_task(monitor_datanodes())
+    monitor_task.add_done_callback(_on_monitor_done)
+
+    # start TCP server: mọi session DataNode chạy trên 1 event loop
+    server = await asyncio.start_server(handle_client, HOST or None, PORT,
+                                        backlog=BACKLOG, reuse_address=True)
+    print(f"[NameNode] Listening on port {PORT}...")
+    async with server:
+        await server.serve_forever()
+
 
 def main():
-    # ensure the metadata table exists
-    init_active_node_manager_table()
-
-    # start monitor thread
-    threading.Thread(target=monitor_datanodes, daemon=True).start()
-
-    # start TCP server
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as srv:
-        srv.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        srv.bind((HOST, PORT))
-        srv.listen()
-        print(f"[NameNode] Listening on port {PORT}...")
-        while True:
-            conn, addr = srv.accept()
-            threading.Thread(target=handle_client,
-                             args=(conn, addr),
-                             daemon=True).start()
+    asyncio.run(serve())
+
 
 if __name__ == '__main__':
     main()
-    assign_task_auto(alogs)
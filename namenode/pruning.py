@@ -0,0 +1,62 @@
+# pruning.py
+# Bỏ qua block khi lập lịch job dựa trên zone map (min/max từng cột, ghi khi split,
+# xem server/functions/zonemap.py). Ngữ nghĩa so sánh giống engine của DataNode:
+#   - value là số  → so sánh với cột đã parse thành số; ô rỗng / không phải số là NaN,
+#                    không khớp phép so sánh nào trừ '!='
+#   - value là chuỗi → so sánh chuỗi trên giá trị gốc (ô rỗng là '')
+# Chỉ trả về False khi CHẮC CHẮN không dòng nào của block khớp.
+
+
+def _is_number(v) -> bool:
+    return isinstance(v, (int, float)) and not isinstance(v, bool)
+
+
+def _range_may_match(op: str, value, lo, hi) -> bool:
+    """Có giá trị x trong [lo, hi] thỏa `x op value` không."""
+    if op == '==':
+        return lo <= value <= hi
+    if op == '<':
+        return lo < value
+    if op == '<=':
+        return lo <= value
+    if op == '>':
+        return hi > value
+    if op == '>=':
+        return hi >= value
+    return True
+
+
+def _filter_may_match(flt: dict, stats: dict) -> bool:
+    op, value = flt.get('op', '=='), flt.get('value')
+    if op == '!=':
+        return True
+    if op == 'in':
+        values = list(value or [])
+        if not values:
+            return False
+        numeric = all(_is_number(v) for v in values)
+        return any(_filter_may_match({'op': '==', 'value': float(v) if numeric else str(v)}, stats)
+                   for v in values)
+    if _is_number(value):
+        lo, hi = stats.get('nmin'), stats.get('nmax')
+        if lo is None:
+            return False        # không có ô nào là số → toàn NaN
+        return _range_may_match(op, float(value), lo, hi)
+    lo, hi = stats.get('min'), stats.get('max')
+    if lo is None:
+        return False            # block không có dòng dữ liệu
+    return _range_may_match(op, str(value), lo, hi)
+
+
+def block_may_match(zone_map: dict, filters: list) -> bool:
+    """
+    False nếu zone map cho thấy block không có dòng nào thỏa mọi filter (AND).
+    Thiếu zone map hoặc thiếu thống kê 1 cột → không bỏ qua được.
+    """
+    if not zone_map or not filters:
+        return True
+    for flt in filters:
+        stats = zone_map.get(flt.get('column'))
+        if stats is not None and not _filter_may_match(flt, stats):
+            return False
+    return True
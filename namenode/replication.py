@@ -0,0 +1,204 @@
+# replication.py
+# Re-replication + erasure coding của Scheduler (tách khỏi scheduler.py):
+#   - block đã đặt lên DataNode phải giữ đủ replication bản của file (file erasure-coded:
+#     đủ EC_FRAGMENTS fragment XOR 2+1)
+#   - block thiếu bản (node chết, replica hỏng) vào hàng đợi under-replicated, heap theo số
+#     bản còn sống; worker nền chép lại từ replica còn sống với băng thông giới hạn,
+#     nhường slot cho task compute; fragment mất được dựng lại từ 2 fragment còn lại
+# ReplicationMixin dùng chung trạng thái + Condition của Scheduler (xem docstring Scheduler).
+
+import heapq
+import time
+
+from functions_namenode import send_to_datanode
+
+DEFAULT_REPLICATION = 3    # số bản mỗi block (leader + followers) nếu catalog không ghi
+
+# Re-replication: chép lại block thiếu bản
+REREPLICATION_INTERVAL  = 1.0               # seconds giữa 2 lượt của worker
+REREPLICATION_BANDWIDTH = 64 * 1024 * 1024  # bytes/s tối đa chép lại trên cả cluster
+REREPLICATION_STREAMS   = 2                 # số bản đang chép tối đa vào 1 node
+REREPLICATION_SCAN      = 1000              # số block tối đa xét mỗi lượt
+REREPLICATION_TIMEOUT   = 300               # seconds; quá hạn coi như thất bại, xếp lại
+REREPLICATION_GRACE     = 30                # seconds sau khởi động: chờ DataNode register + block report
+
+# Erasure coding (file upload với erasure=1): block chia 2 fragment dữ liệu + 1 parity XOR,
+# cùng cách chia với datanode_server/erasure.py; fragment i được báo với dir 'ec<i>'
+EC_DATA_FRAGMENTS = 2
+EC_FRAGMENTS = 3
+EC_DIRS = tuple(f"ec{i}" for i in range(EC_FRAGMENTS))
+
+
+def _fragment_bytes(nbytes: int) -> int:
+    """Kích thước mỗi fragment của block nbytes byte."""
+    return ((nbytes or 0) + EC_DATA_FRAGMENTS - 1) // EC_DATA_FRAGMENTS
+
+
+class ReplicationMixin:
+    """Phần re-replication của Scheduler: hàng đợi under-replicated + worker chép lại."""
+
+    def _live_copies(self, blk: str, meta: tuple) -> int:
+        """
+        Số bản còn sống, dùng làm thứ tự ưu tiên của hàng đợi: số node giữ bản đầy đủ, hoặc
+        với block erasure-coded số fragment khác nhau - (EC_DATA_FRAGMENTS - 1) (đủ 2 fragment
+        dựng lại được block ~ 1 bản).
+        """
+        if meta[4]:
+            return len(set(self.fragments.get(blk, {}).values())) - EC_DATA_FRAGMENTS + 1
+        return len(self.locations.get(blk, ()))
+
+    def _check_replication(self, blk: str):
+        """
+        Xếp blk vào hàng đợi under-replicated nếu số bản còn sống + đang chép / đã giữ chỗ
+        ít hơn replication của file (erasure: thiếu fragment nào trong EC_FRAGMENTS fragment).
+        Chỉ xét block đã từng được đặt lên DataNode (block_meta). Gọi khi đang giữ self._cond.
+        """
+        meta = self.block_meta.get(blk)
+        if meta is None or blk in self.under_replicated:
+            return
+        if meta[4]:
+            have = set(self.fragments.get(blk, {}).values())
+            have.update(index for _, index in self.replicating.get(blk, {}).values())
+            short = len(have) < EC_FRAGMENTS
+        else:
+            short = len(self.locations.get(blk, ())) + len(self.reserved.get(blk, ())) < meta[3]
+        if short:
+            self.under_replicated.add(blk)
+            heapq.heappush(self._urq, (self._live_copies(blk, meta), next(self._urq_seq), blk))
+
+    def _replication_done(self, blk: str, node_id: str):
+        """Bản chép lại blk → node_id đã kết thúc (xong, lỗi hoặc node chết)."""
+        nodes = self.replicating.get(blk)
+        if nodes is not None and nodes.pop(node_id, None) is not None and not nodes:
+            del self.replicating[blk]
+
+    def replication_status(self) -> dict:
+        with self._cond:
+            return {'under_replicated': len(self.under_replicated),
+                    'replicating': sum(len(nodes) for nodes in self.replicating.values())}
+
+    def _replication_loop(self):
+        """
+        Worker nền: mỗi REREPLICATION_INTERVAL chép lại 1 phần block under-replicated.
+        Chờ REREPLICATION_GRACE sau khởi động để các DataNode kịp gửi block report.
+        """
+        time.sleep(REREPLICATION_GRACE)
+        last = time.monotonic()
+        while True:
+            time.sleep(REREPLICATION_INTERVAL)
+            now = time.monotonic()
+            with self._cond:
+                # token bucket: tối đa REREPLICATION_BANDWIDTH byte/s, dồn tối đa 1 giây
+                self._rerep_tokens = min(self._rerep_tokens + (now - last) * REREPLICATION_BANDWIDTH,
+                                         REREPLICATION_BANDWIDTH)
+                sends = self._schedule_replications(now)
+            last = now
+            for blk, meta, targets, sources, fragments in sends:
+                origin = ([f"{src['node']}#ec{src['index']}" for src in fragments]
+                          + [src['node'] for src in sources]) or 'upload server'
+                print(f"[Scheduler] Re-replicating {blk} → {targets} (from {origin})")
+                for nd, index in targets:
+                    self._send_replicas(blk, meta, [nd], sources, fragment=index, fragments=fragments)
+
+    def _schedule_replications(self, now: float) -> list:
+        """
+        Lấy block từ hàng đợi (ít bản còn sống nhất trước) và chọn node đích ít byte nhất
+        chưa giữ block. Compute được ưu tiên: bỏ qua block leader đang chạy (chain sẽ tạo bản)
+        và node đã dùng hết slot hoặc đang nhận REREPLICATION_STREAMS bản.
+        Block erasure-coded: mỗi fragment thiếu được dựng lại trên 1 node chưa giữ fragment nào.
+        Gọi khi đang giữ self._cond. Trả về [(blk, meta, [(node, fragment | None)], sources,
+        fragment sources)] để gửi ngoài lock.
+        """
+        for blk, nodes in list(self.replicating.items()):
+            for nd, (deadline, _) in list(nodes.items()):
+                if deadline <= now:
+                    print(f"[Scheduler] Re-replication of {blk} → {nd} timed out")
+                    self._replication_done(blk, nd)
+                    self._release(blk, nd)
+                    self._check_replication(blk)
+        streams = {}
+        for nodes in self.replicating.values():
+            for nd in nodes:
+                streams[nd] = streams.get(nd, 0) + 1
+        saturated = {nd for nd, cap in self.slots.items() if self.busy[nd] >= cap}
+        saturated.update(nd for nd, n in streams.items() if n >= REREPLICATION_STREAMS)
+        running = {blk for _, blk in self.running}
+        sends, deferred = [], []
+        for _ in range(REREPLICATION_SCAN):
+            if not self._urq or self._rerep_tokens <= 0:
+                break
+            live, _, blk = heapq.heappop(self._urq)
+            self.under_replicated.discard(blk)
+            meta = self.block_meta.get(blk)
+            if meta is None or blk in running:
+                continue            # leader đang chạy: completion sẽ kiểm tra lại
+            if self._live_copies(blk, meta) != live:
+                # số bản đã đổi từ lúc xếp hàng → xếp lại đúng thứ tự ưu tiên
+                self._check_replication(blk)
+                continue
+            if meta[4]:
+                holders = self.fragments.get(blk, {})
+                pending = self.replicating.get(blk, {})
+                have = set(holders.values()) | {index for _, index in pending.values()}
+                missing = [i for i in range(EC_FRAGMENTS) if i not in have]
+                nbytes = _fragment_bytes(meta[1])
+            else:
+                holders = self.locations.get(blk, {})
+                pending = self.reserved.get(blk, {})
+                missing = [None] * (meta[3] - len(holders) - len(pending))
+                nbytes = meta[1] or 0
+            if not missing:
+                continue
+            targets = self.storage.least(len(missing), exclude=set(holders) | set(pending) | saturated)
+            if not targets:
+                deferred.append(blk)
+                continue
+            targets = list(zip(targets, missing))
+            for nd, index in targets:
+                self._reserve(blk, nd, nbytes)
+                self.replicating.setdefault(blk, {})[nd] = (now + REREPLICATION_TIMEOUT, index)
+                streams[nd] = streams.get(nd, 0) + 1
+                if streams[nd] >= REREPLICATION_STREAMS:
+                    saturated.add(nd)
+            self._rerep_tokens -= nbytes * len(targets)
+            sends.append((blk, meta, targets, self._block_sources(blk, near=targets[0][0]),
+                          self._fragment_sources(blk) if meta[4] else []))
+            if len(targets) < len(missing):
+                deferred.append(blk)
+        for blk in deferred:
+            self._check_replication(blk)
+        return sends
+
+    def _send_replicas(self, blk: str, meta: tuple, nodes: list[str], sources: list = None,
+                       job_id: str = None, fragment: int = None, fragments: list = None):
+        """
+        Task storage: mỗi node tự tải replica của blk (ngoài chain),
+        ưu tiên từ các peer trong sources, không có thì từ upload server.
+        meta = block_meta[blk]. job_id None = re-replication: DataNode chạy task ở pool nền
+        ('background') để không chiếm slot I/O của task compute.
+        fragment = i: node dựng fragment erasure i từ các fragment còn lại (fragments),
+        thiếu thì từ bản đầy đủ trong sources.
+        """
+        file_base, nbytes, crc = meta[:3]
+        for nd in nodes:
+            try:
+                send_to_datanode(nd, {
+                    'type': 'task',
+                    'role': 'storage',
+                    'block_id': blk,
+                    'file': file_base,
+                    'job_id': job_id,
+                    'bytes': nbytes,
+                    'crc32': crc,
+                    'background': job_id is None,
+                    'sources': sources or [],
+                    'fragment': fragment,
+                    'fragments': fragments or []
+                })
+            except OSError as e:
+                print(f"[Scheduler] Không gửi được replica {blk} cho {nd}: {e}")
+                if job_id is None:
+                    with self._cond:
+                        self._replication_done(blk, nd)
+                        self._release(blk, nd)
+                        self._check_replication(blk)
@@ -0,0 +1,762 @@
+# scheduler.py
+# Bộ lập lịch trong bộ nhớ của NameNode:
+#   - view authoritative về node nào đang free và block nào đang chờ
+#   - assign ngay khi có node free (Condition), không poll DB
+#   - Postgres chỉ là bản ghi bền vững, được ghi bất đồng bộ qua hàng đợi persist
+#   - mỗi /compute là 1 job; block của nhiều job được xen kẽ theo priority (fair share)
+#   - job có group_by chạy 2 pha: map (combine + chia partition theo hash khóa, giữ ở
+#     DataNode) rồi reduce (mỗi partition 1 task, kéo partition từ các node đã map)
+#   - mỗi file có replication factor riêng (chọn lúc upload); block thiếu bản (node chết,
+#     replica hỏng) vào hàng đợi under-replicated, worker nền chép lại từ replica còn sống
+#     với băng thông giới hạn, nhường slot cho task compute
+#   - file erasure-coded: follower giữ fragment XOR 2+1 thay vì bản đầy đủ; fragment mất
+#     được dựng lại từ 2 fragment còn lại
+# Chỉ mục block ↔ node nằm ở block_index.py, re-replication / erasure ở replication.py
+# (mixin của Scheduler, dùng chung trạng thái và self._cond).
+
+import itertools
+import queue
+import threading
+import time
+import uuid
+from collections import deque
+
+from block_index import BlockIndexMixin, StorageLoad
+from channels import set_message_handler
+from pruning import block_may_match
+from replication import (
+    DEFAULT_REPLICATION,
+    EC_DIRS,
+    EC_FRAGMENTS,
+    REREPLICATION_BANDWIDTH,
+    ReplicationMixin,
+    _fragment_bytes,
+)
+from functions_namenode import (
+    finalize_job_results,
+    get_file_blocks,
+    get_file_settings,
+    is_ingest_open,
+    load_node_storage_bytes,
+    persist_assignment,
+    persist_completion,
+    persist_placement,
+    prepare_job_results,
+    requeue_leader_blocks,
+    send_to_datanode,
+)
+
+INGEST_POLL_INTERVAL = 2.0 # seconds, chỉ dùng khi file còn đang upload streaming
+MAX_TASK_ATTEMPTS = 3      # số lần chạy 1 block trước khi đánh dấu 'failed'
+MAX_SHUFFLE_PARTITIONS = 64  # số partition reduce tối đa / job (mặc định = số DataNode)
+
+
+class Job:
+    """
+    1 yêu cầu compute trên 1 file.
+    Fair share: job có dispatched / priority nhỏ nhất được lấy block tiếp theo,
+    nên job priority 2 nhận gấp đôi số slot của job priority 1 khi cùng chạy.
+    """
+
+    def __init__(self, job_id: str, file_base: str, priority: int = 1, spec: dict = None):
+        self.job_id = job_id
+        self.file_base = file_base
+        self.priority = max(int(priority), 1)
+        self.spec = spec or None     # job spec đã kiểm tra ở upload server, gửi kèm task leader
+        self.pending = deque()
+        self.blocks = {}           # { block_id: (bytes, crc32) } từ manifest trong catalog
+        self.codec = 'none'        # codec nén block của file (catalog.files.codec)
+        self.replication = DEFAULT_REPLICATION  # số bản mỗi block (catalog.files.replication)
+        self.erasure = False       # block lưu dạng fragment XOR 2+1 (catalog.files.erasure)
+        self.skipped = 0           # số block bỏ qua nhờ zone map (không thể khớp filter)
+        self.state = 'loading'     # loading → queued → dispatched [→ reducing] → merging → done | failed
+        self.total = 0             # số block đã nạp
+        self.dispatched = 0        # số block đã gửi cho leader (gồm cả đã xong)
+        self.done = 0              # số block leader báo hoàn tất
+        self.failed = 0            # số block lỗi quá MAX_TASK_ATTEMPTS lần
+        self.loading = True        # còn đang đọc block từ catalog (upload streaming)
+        self.error = None
+        self.created = time.time()
+        # shuffle (chỉ job có group_by): partitions = 0 → kết quả block gửi thẳng upload server
+        self.partitions = 0
+        self.map_outputs = {}      # { block_id: node_id giữ partition của block }
+        self.reduce_tasks = {}     # { 'part-00003.csv': 3 }, tạo khi mọi block đã map xong
+        self.reduce_done = 0
+        self.reduce_failed = 0
+        # merge cuối trên upload server (/finalize) sau khi mọi task xong
+        self.finalizing = False
+        self.finalized = False
+        self.result = None         # URL tải kết quả cuối
+        # locality của các lần giao block cho leader: leader đã giữ replica ('node'),
+        # cùng host với 1 node giữ replica ('host'), hay phải tải qua mạng ('remote')
+        self.locality = {'node': 0, 'host': 0, 'remote': 0}
+
+    def share(self) -> float:
+        return self.dispatched / self.priority
+
+    def next_task(self):
+        """
+        Task giao tiếp theo trong pending: task reduce chỉ được giao khi mọi block
+        đã map xong, trước đó bỏ qua chúng để giao block (map lại) phía sau.
+        """
+        if not self.pending:
+            return None
+        head = self.pending[0]
+        if head not in self.reduce_tasks or self.done == self.total:
+            return head
+        return next((k for k in self.pending if k not in self.reduce_tasks), None)
+
+    def maps_finished(self) -> bool:
+        return not self.loading and self.done + self.failed == self.total
+
+    def update_state(self):
+        if self.loading:
+            return
+        reducing = self.reduce_done + self.reduce_failed < len(self.reduce_tasks)
+        if self.done + self.failed < self.total or reducing:
+            if not self.pending and self.state != 'failed':
+                self.state = 'reducing' if self.reduce_tasks else 'dispatched'
+            return
+        if self.failed or self.reduce_failed:
+            self.state = 'failed'
+        elif self.partitions and self.total and not self.reduce_tasks:
+            return      # chờ scheduler tạo task reduce
+        else:
+            self.state = 'done' if self.finalized else 'merging'
+
+    def locality_hit_rate(self):
+        """Tỉ lệ lần giao block mà leader đã có sẵn replica (None nếu chưa giao block nào)."""
+        total = sum(self.locality.values())
+        return round(self.locality['node'] / total, 3) if total else None
+
+    def status(self) -> dict:
+        return {
+            'job_id': self.job_id,
+            'file': self.file_base,
+            'priority': self.priority,
+            'spec': self.spec,
+            'state': self.state,
+            'blocks': self.total,
+            'skipped': self.skipped,
+            'pending': len(self.pending),
+            'dispatched': self.dispatched,
+            'running': self.dispatched - self.done - self.failed
+                       - self.reduce_done - self.reduce_failed,
+            'done': self.done,
+            'failed': self.failed,
+            'partitions': self.partitions,
+            'reduced': self.reduce_done,
+            'locality': dict(self.locality),
+            'locality_hit_rate': self.locality_hit_rate(),
+            'result': self.result,
+            'error': self.error,
+        }
+
+
+class Scheduler(BlockIndexMixin, ReplicationMixin):
+    """
+    Trạng thái lập lịch, được bảo vệ bởi 1 Condition:
+      - slots    : { node_id: số slot DataNode báo khi register }
+      - busy     : { node_id: số task leader đang chạy }
+      - inflight : { node_id: tổng byte (manifest) của các block node đang làm leader }
+      - storage  : StorageLoad — byte mỗi node đang lưu, để chọn follower ít tải nhất
+      - reserved : { block_id: { node_id: bytes } } byte đã cộng cho node lúc assign /
+                   re-replication, chờ node xác nhận đã lưu block
+      - jobs     : { job_id: Job }, mỗi job giữ hàng đợi block pending riêng
+      - running  : { (job_id, block_id | task reduce): (leader, followers) }
+      - peers    : { node_id: 'ip:port' } peer server của node (kéo partition shuffle, replica)
+      - locations: { block_id: { node_id: 'task' | 'storage' } } node đang giữ bản block đã
+                   kiểm tra checksum: từ completion của task và block report của DataNode
+                   (register: full report, heartbeat: delta). Dùng để chọn leader theo
+                   locality, chỉ nguồn tải peer-to-peer và phát hiện block thiếu replica
+      - node_blocks: { node_id: { block_id: bytes } } chỉ mục ngược của locations
+      - node_dirs: { node_id: { block_id: {'task', 'storage'} } } thư mục node đang có bản
+                   block; xóa bản ở 1 thư mục chỉ bỏ node khỏi locations khi không còn bản nào
+      - fragments: { block_id: { node_id: index } } fragment erasure node đang giữ
+                   (file erasure-coded), node_fragments: { node_id: { block_id: bytes } }
+      - block_meta : { block_id: (file_base, bytes, crc32, replication, erasure) } block đã
+                   được đặt lên DataNode ít nhất 1 lần → cần giữ đủ `replication` bản
+                   (erasure: đủ EC_FRAGMENTS fragment)
+      - under_replicated: block có ít bản hơn replication (heap theo số bản còn sống, ít
+                   nhất trước), worker re-replication lấy dần ra
+      - replicating: { block_id: { node_id: (hạn chót, index fragment | None) } } bản
+                   đang được chép lại
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self.slots = {}
+        self.busy = {}
+        self.inflight = {}
+        self.storage = StorageLoad()
+        self.reserved = {}
+        self._initial_bytes = {}   # { node_id: bytes } từ catalog.node_storage lúc khởi động
+        self.jobs = {}
+        self.running = {}
+        self.peers = {}
+        self.locations = {}
+        self.node_blocks = {}
+        self.node_dirs = {}
+        self.fragments = {}
+        self.node_fragments = {}
+        self.block_meta = {}
+        self.under_replicated = set()
+        self._urq = []             # heap (số bản còn sống, seq, block_id) của under_replicated
+        self._urq_seq = itertools.count()
+        self.replicating = {}
+        self._rerep_tokens = REREPLICATION_BANDWIDTH
+        self.attempts = {}         # { (job_id, block_id): số lần leader báo lỗi }
+        # job_id = job-<run>-<n>: <run> ngẫu nhiên mỗi lần NameNode khởi động, nên job mới không
+        # trùng id (và thư mục results/<file>/<job_id>/) với job của lần chạy trước
+        self._run_id = uuid.uuid4().hex[:8]
+        self._job_ids = itertools.count(1)
+        self._persist_q = queue.Queue()
+        self._completion_q = queue.Queue()   # message 'complete' từ thread đọc kênh
+        self._started = False
+
+    def start(self):
+        """Nạp byte mỗi node đang lưu từ catalog rồi chạy thread dispatch + completion + persist."""
+        if self._started:
+            return
+        self._started = True
+        set_message_handler(self.on_channel_message)
+        try:
+            self._initial_bytes = load_node_storage_bytes()
+        except Exception as e:
+            print(f"[Scheduler] Không nạp được node storage: {e}")
+        threading.Thread(target=self._dispatch_loop, daemon=True).start()
+        threading.Thread(target=self._completion_loop, daemon=True).start()
+        threading.Thread(target=self._persist_loop, daemon=True).start()
+        threading.Thread(target=self._replication_loop, daemon=True).start()
+
+    # ─── Node events ─────────────────────────────────────────────────────────
+
+    def add_node(self, node_id: str, slots: int = None, peer_port: int = None):
+        """
+        Node register (slots = số task chạy đồng thời) hoặc heartbeat từ node chưa biết
+        (slots=None → giữ nguyên, mặc định 1). peer_port: port peer server của node.
+        """
+        with self._cond:
+            if peer_port:
+                self.peers[node_id] = f"{node_id.split(':')[0]}:{peer_port}"
+            if node_id in self.slots and slots is None:
+                return
+            self.slots[node_id] = max(int(slots or 1), 1)
+            self.busy.setdefault(node_id, 0)
+            self.inflight.setdefault(node_id, 0)
+            if node_id not in self.storage.bytes:
+                # block report lúc register sẽ tính lại chính xác
+                self.storage.set(node_id, self._initial_bytes.pop(node_id, 0) or 0)
+            self._cond.notify_all()
+
+    def remove_node(self, node_id: str):
+        """
+        Node chết: bỏ khỏi view, các block nó đang làm leader quay lại đầu hàng đợi của job.
+        Partition shuffle nó giữ cũng mất → các block đó phải map lại.
+        Replica nó giữ (hoặc đang chép tới) mất → block thiếu bản vào hàng đợi under-replicated.
+        """
+        with self._cond:
+            if self.slots.pop(node_id, None) is None:
+                return
+            self.busy.pop(node_id, None)
+            self.inflight.pop(node_id, None)
+            self.storage.discard(node_id)
+            self.peers.pop(node_id, None)
+            lost_blocks = list(self.node_blocks.pop(node_id, {}))
+            self.node_dirs.pop(node_id, None)
+            for blk in lost_blocks:
+                self._drop_location(blk, node_id)
+            for blk in self.node_fragments.pop(node_id, {}):
+                self._drop_fragment(blk, node_id)
+                lost_blocks.append(blk)
+            for blk in [blk for blk, held in self.reserved.items() if node_id in held]:
+                self._unreserve(blk, node_id)
+                lost_blocks.append(blk)
+            for blk in [blk for blk, nodes in self.replicating.items() if node_id in nodes]:
+                self._replication_done(blk, node_id)
+            for blk in lost_blocks:
+                self._check_replication(blk)
+            for job in self.jobs.values():
+                if job.state in ('merging', 'done', 'failed'):
+                    continue
+                lost_maps = [b for b, n in job.map_outputs.items() if n == node_id]
+                for blk in lost_maps:
+                    del job.map_outputs[blk]
+                    job.pending.appendleft(blk)
+                    job.done -= 1
+                    job.dispatched -= 1
+                if lost_maps:
+                    job.state = 'queued'
+            lost = [key for key, (leader, _) in self.running.items() if leader == node_id]
+            for job_id, blk in lost:
+                del self.running[(job_id, blk)]
+                job = self.jobs.get(job_id)
+                if job is not None:
+                    job.pending.appendleft(blk)
+                    job.dispatched -= 1
+                    job.state = 'queued'
+            if lost:
+                self._persist_q.put((requeue_leader_blocks, (node_id,)))
+            self._cond.notify_all()
+
+    # ─── Jobs ────────────────────────────────────────────────────────────────
+
+    def submit_job(self, file_base: str, priority: int = 1, spec: dict = None) -> str:
+        """
+        Tạo job compute cho file_base và trả về job_id ngay.
+        Block được nạp từ catalog trên 1 thread nền (kể cả khi file còn đang upload).
+        spec: job spec (filters/columns/group_by/aggregates), None = đếm số dòng.
+        """
+        with self._cond:
+            job = Job(f"job-{self._run_id}-{next(self._job_ids)}", file_base, priority, spec)
+            if spec and spec.get('group_by'):
+                job.partitions = min(max(len(self.slots), 1), MAX_SHUFFLE_PARTITIONS)
+            self.jobs[job.job_id] = job
+        threading.Thread(target=self._load_job, args=(job,), daemon=True).start()
+        print(f"[Scheduler] Job {job.job_id} queued for '{file_base}' (priority {job.priority})")
+        return job.job_id
+
+    def job_status(self, job_id: str):
+        with self._cond:
+            job = self.jobs.get(job_id)
+            return job.status() if job else None
+
+    def _load_job(self, job: Job):
+        """
+        Đọc block của job từ catalog. Nếu file đang upload streaming,
+        đọc thêm block mới (mỗi INGEST_POLL_INTERVAL) cho tới khi upload kết thúc.
+        Block có zone map cho thấy không thể khớp filter của job bị bỏ qua.
+        """
+        seen = set()
+        filters = (job.spec or {}).get('filters')
+        try:
+            # kết quả cũ cùng job_id trên upload server (nếu có) bị xóa trước khi block nào chạy
+            resp = prepare_job_results(job.file_base, job.job_id)
+            if resp.get('status') != 'ok':
+                raise RuntimeError(f"cannot prepare results: {resp.get('error', resp)}")
+            codec, replication, erasure = get_file_settings(job.file_base)
+            with self._cond:
+                # job đã có trong self.jobs (job_status, dispatcher) → chỉ ghi khi giữ lock
+                job.codec = codec
+                job.replication = replication or DEFAULT_REPLICATION
+                job.erasure = bool(erasure)
+            while True:
+                # Đọc trạng thái trước khi lấy block: nếu đã xong thì danh sách là đầy đủ
+                uploading = is_ingest_open(job.file_base)
+                rows = [r for r in get_file_blocks(job.file_base) if r[0] not in seen]
+                seen.update(r[0] for r in rows)
+                kept = [r for r in rows if block_may_match(r[3], filters)]
+                block_ids = [r[0] for r in kept]
+                with self._cond:
+                    job.skipped += len(rows) - len(kept)
+                    job.blocks.update((blk, (nbytes, crc)) for blk, nbytes, crc, _ in kept)
+                    job.pending.extend(block_ids)
+                    job.total += len(block_ids)
+                    if block_ids:
+                        job.state = 'queued'
+                        self._cond.notify_all()
+                if not uploading:
+                    break
+                time.sleep(INGEST_POLL_INTERVAL)
+        except Exception as e:
+            print(f"[Scheduler] Job {job.job_id} load error: {e}")
+            with self._cond:
+                job.error = str(e)
+        with self._cond:
+            job.loading = False
+            if job.error and not job.total:
+                job.state = 'failed'
+            else:
+                self._maybe_start_reduce(job)
+                job.update_state()
+                self._maybe_finalize(job)
+            self._cond.notify_all()
+
+    def _maybe_start_reduce(self, job: Job):
+        """Mọi block của job shuffle đã map xong → xếp 1 task reduce cho mỗi partition."""
+        if (not job.partitions or job.reduce_tasks or job.failed
+                or not job.total or not job.maps_finished()):
+            return
+        job.reduce_tasks = {f"part-{p:05d}.csv": p for p in range(job.partitions)}
+        job.pending.extend(job.reduce_tasks)
+        job.state = 'reducing'
+        print(f"[Scheduler] {job.job_id}: map done, {job.partitions} reduce task(s) queued")
+
+    def _next_job(self):
+        """Job có block pending với share nhỏ nhất (tie → job tạo trước)."""
+        ready = [j for j in self.jobs.values() if j.next_task() is not None]
+        if not ready:
+            return None
+        return min(ready, key=lambda j: (j.share(), j.created))
+
+    # ─── Assignment ──────────────────────────────────────────────────────────
+
+    @staticmethod
+    def _host(node_id: str) -> str:
+        return node_id.rsplit(':', 1)[0]
+
+    def _locality(self, block_id: str, node_id: str) -> str:
+        """
+        'node'  : node đã báo giữ bản block đã kiểm tra manifest (self.locations)
+        'host'  : node khác trên cùng host giữ block (tải qua loopback)
+        'remote': phải tải block qua mạng
+        """
+        holders = self.locations.get(block_id, {})
+        if node_id in holders:
+            return 'node'
+        host = self._host(node_id)
+        if any(self._host(nd) == host for nd in holders if nd in self.slots):
+            return 'host'
+        return 'remote'
+
+    def assign_task_auto(self, block_id: str, nbytes: int = 0,
+                         replication: int = DEFAULT_REPLICATION, erasure: bool = False):
+        """
+        Chọn 1 leader còn slot trống, ưu tiên theo locality (_locality): node đã giữ replica
+        của block, rồi node cùng host với 1 replica, rồi node bất kỳ; cùng mức locality thì
+        node có ít byte đang xử lý / slot nhất (cân bằng theo kích thước block trong manifest),
+        rồi node nhiều slot trống nhất. Kèm replication - 1 followers đang lưu ít byte nhất
+        (StorageLoad: heap, không quét mọi node / placement); byte của block được giữ chỗ
+        ngay cho leader + followers để các lần assign liền sau thấy tải mới.
+        erasure: followers[i] = node nhận fragment i (None nếu fragment i đã có / đang dựng lại),
+        giữ chỗ kích thước fragment.
+        Gọi khi đang giữ self._cond. Trả về (leader, followers) hoặc None nếu không còn slot.
+        """
+        free = [n for n, cap in self.slots.items() if self.busy[n] < cap]
+        if not free:
+            return None
+        rank = {'node': 0, 'host': 1, 'remote': 2}
+        leader = min(free, key=lambda n: (rank[self._locality(block_id, n)],
+                                          self.inflight[n] / self.slots[n],
+                                          self.busy[n] - self.slots[n], n))
+        self.busy[leader] += 1
+        self.inflight[leader] += nbytes or 0
+        self._reserve(block_id, leader, nbytes)
+        if erasure:
+            holders = self.fragments.get(block_id, {})
+            pending = self.replicating.get(block_id, {})
+            have = set(holders.values()) | {index for _, index in pending.values()}
+            missing = [i for i in range(EC_FRAGMENTS) if i not in have]
+            picked = iter(self.storage.least(len(missing), exclude={leader} | set(holders) | set(pending)))
+            followers = [next(picked, None) if i in missing else None for i in range(EC_FRAGMENTS)]
+            for nd in followers:
+                if nd is not None:
+                    self._reserve(block_id, nd, _fragment_bytes(nbytes))
+            return leader, followers
+        followers = self.storage.least(max(replication - 1, 0), exclude=(leader,))
+        for nd in followers:
+            self._reserve(block_id, nd, nbytes)
+        return leader, followers
+
+    def assign_reduce(self, partition: int):
+        """
+        Chọn node chạy reduce cho 1 partition: partition p thuộc node thứ p (mod số node)
+        trong danh sách node có peer server → mỗi node giữ 1 dải khóa; node đó hết slot
+        thì lấy node free bất kỳ. Gọi khi đang giữ self._cond. Trả về (node, []) hoặc None.
+        """
+        free = [n for n, cap in self.slots.items() if self.busy[n] < cap]
+        if not free:
+            return None
+        owners = sorted(self.peers) or sorted(self.slots)
+        owner = owners[partition % len(owners)]
+        node = owner if owner in free else min(free, key=lambda n: (self.busy[n] - self.slots[n], n))
+        self.busy[node] += 1
+        return node, []
+
+    def _dispatch_loop(self):
+        while True:
+            with self._cond:
+                while True:
+                    job = self._next_job()
+                    choice = None
+                    if job is not None:
+                        blk = job.next_task()
+                        if blk in job.reduce_tasks:
+                            choice = self.assign_reduce(job.reduce_tasks[blk])
+                        else:
+                            choice = self.assign_task_auto(blk, job.blocks.get(blk, (0,))[0],
+                                                           job.replication, job.erasure)
+                    if choice:
+                        break
+                    # chưa có block hoặc chưa có node free → ngủ tới khi có sự kiện
+                    self._cond.wait()
+                if job.pending[0] == blk:
+                    job.pending.popleft()
+                else:
+                    job.pending.remove(blk)
+                job.dispatched += 1
+                job.update_state()
+                leader, followers = choice
+                self.running[(job.job_id, blk)] = (leader, followers)
+                if blk in job.reduce_tasks:
+                    # task reduce không phải block của catalog → không ghi DB
+                    sources = [{'block_id': b, 'peer': self.peers.get(n, n)}
+                               for b, n in sorted(job.map_outputs.items())]
+                else:
+                    sources = None
+                    job.locality[self._locality(blk, leader)] += 1
+                    replica_sources = self._block_sources(blk, exclude=(leader,), near=leader)
+                    fragment_sources = self._fragment_sources(blk) if job.erasure else []
+                    # enqueue trong lock để thứ tự ghi DB khớp thứ tự sự kiện;
+                    # fragment được ghi placement khi leader báo đã gửi xong
+                    self._persist_q.put((persist_assignment, (blk, leader,
+                                                              [] if job.erasure else followers,
+                                                              job.blocks.get(blk, (0,))[0])))
+
+            if sources is not None:
+                if self._send_reduce(job, blk, leader, sources):
+                    print(f"[Scheduler] {job.job_id}: assigned reduce {blk} → {leader}")
+                continue
+
+            # Gửi lỗi thì remove_node đã đưa block về hàng đợi của job
+            if self._send_task(job, blk, leader, followers, replica_sources, fragment_sources):
+                print(f"[Scheduler] {job.job_id}: assigned {blk} → leader {leader}, followers {followers}")
+
+    def _block_sources(self, blk: str, exclude=(), near: str = None) -> list[dict]:
+        """
+        Các DataNode còn sống đang giữ blk (trừ exclude), node cùng host với `near` trước,
+        rồi node ít tải nhất: load = số task leader đang chạy / slot, hòa thì ít byte
+        đang xử lý hơn. Gọi khi đang giữ self._cond.
+        """
+        near_host = self._host(near) if near else None
+        sources = [{'node': nd, 'peer': self.peers[nd], 'dir': where,
+                    'load': round(self.busy[nd] / self.slots[nd], 3)}
+                   for nd, where in self.locations.get(blk, {}).items()
+                   if nd not in exclude and nd in self.slots and nd in self.peers]
+        sources.sort(key=lambda src: (self._host(src['node']) != near_host, src['load'],
+                                      self.inflight[src['node']], src['node']))
+        return sources
+
+    def _send_task(self, job: Job, blk: str, leader: str, followers: list[str],
+                   sources: list = None, fragments: list = None) -> bool:
+        """
+        Gửi task cho leader kèm chain replication leader → followers[0] → followers[1]:
+        leader tải block từ upload server 1 lần và đẩy tiếp cho follower, nên upload server
+        không phải gửi cùng 1 block cho từng replica. Follower không nhận được qua chain
+        sẽ được giao task storage riêng khi leader báo xong (complete_task).
+        sources: replica đã có trên DataNode khác (_block_sources) → leader tải từ peer
+        ít tải nhất, upload server chỉ là nguồn dự phòng.
+        Nếu không gửi được cho leader thì coi leader là không liên lạc được và đưa block về hàng đợi.
+        bytes/crc32 (manifest) cho phép DataNode bỏ qua tải lại block đã có nguyên vẹn;
+        codec cho leader biết cách giải nén block khi chạy plan.
+        File erasure-coded: không có chain, leader chia block và gửi fragment i cho
+        followers[i] ('ec'); fragments = fragment đã có trên DataNode khác, để leader dựng
+        lại block khi không còn bản đầy đủ nào (sources rỗng).
+        """
+        nbytes, crc = job.blocks.get(blk, (None, None))
+        try:
+            send_to_datanode(leader, {
+                'type': 'task',
+                'role': 'leader',
+                'block_id': blk,
+                'file': job.file_base,
+                'job_id': job.job_id,
+                'bytes': nbytes,
+                'crc32': crc,
+                'codec': job.codec,
+                'plan': job.spec,
+                'partitions': job.partitions,
+                'chain': [] if job.erasure else followers,
+                'ec': followers if job.erasure and any(followers) else None,
+                'sources': sources or [],
+                'fragments': fragments or []
+            })
+        except OSError as e:
+            print(f"[Scheduler] Không gửi được task {blk} cho {leader}: {e}")
+            self.remove_node(leader)
+            return False
+        return True
+
+    def _send_reduce(self, job: Job, name: str, node: str, sources: list) -> bool:
+        """Gửi task reduce partition job.reduce_tasks[name]; sources = nơi giữ partition của từng block."""
+        try:
+            send_to_datanode(node, {
+                'type': 'task',
+                'role': 'reduce',
+                'block_id': name,
+                'file': job.file_base,
+                'job_id': job.job_id,
+                'plan': job.spec,
+                'partition': job.reduce_tasks[name],
+                'sources': sources
+            })
+        except OSError as e:
+            print(f"[Scheduler] Không gửi được reduce {name} cho {node}: {e}")
+            self.remove_node(node)
+            return False
+        return True
+
+    # ─── Completion ──────────────────────────────────────────────────────────
+
+    def on_channel_message(self, node_id: str, msg: dict):
+        """
+        Message DataNode gửi lên qua kênh task (channels.py). Chạy trên thread đọc của kênh
+        nên chỉ xếp hàng: complete_task có thể gửi tiếp qua kênh khác (storage task, reduce…),
+        nếu kênh đó đang đầy MAX_INFLIGHT thì thread đọc bị chặn → không ai nhận ACK → kẹt.
+        """
+        if msg.get('type') == 'complete':
+            self._completion_q.put((node_id, msg))
+        else:
+            print(f"[Scheduler] Unknown message from {node_id}: {msg}")
+
+    def _completion_loop(self):
+        """Xử lý tuần tự các báo cáo hoàn thành (giữ thứ tự DataNode gửi lên)."""
+        while True:
+            node_id, msg = self._completion_q.get()
+            try:
+                self.complete_task(node_id, msg)
+            except Exception as e:
+                print(f"[Scheduler] Completion {msg.get('job_id')}/{msg.get('block_id')} "
+                      f"from {node_id} lỗi: {e!r}")
+
+    def complete_task(self, node_id: str, msg: dict):
+        """
+        DataNode báo xong 1 task. Với leader: đánh dấu block done (hoặc chạy lại nếu lỗi),
+        trả slot của node về và đánh thức dispatcher để giao ngay block tiếp theo.
+        msg['replicas'] = follower đã nhận block qua chain; follower còn thiếu được
+        giao task storage để tự tải từ upload server.
+        msg['fragments'] = { node: index } fragment erasure leader đã gửi xong; fragment còn
+        thiếu để worker re-replication dựng lại.
+        Task storage (dự phòng hoặc re-replication) xong / lỗi → kiểm tra lại số bản của block.
+        """
+        blk = msg.get('block_id')
+        ok = msg.get('status') == 'ok'
+        if msg.get('role') not in ('leader', 'reduce'):
+            with self._cond:
+                self._replication_done(blk, node_id)
+                if not ok:
+                    print(f"[Scheduler] Replica {blk} on {node_id} failed: {msg.get('error')}")
+                    self._release(blk, node_id)
+                elif node_id in self.slots and msg.get('fragment') is not None:
+                    index = int(msg['fragment'])
+                    nbytes = _fragment_bytes(self.block_meta.get(blk, (None, 0))[1])
+                    self._add_fragment(blk, node_id, index, nbytes)
+                    self._persist_q.put((persist_placement, (blk, node_id, nbytes, EC_DIRS[index])))
+                elif node_id in self.slots:
+                    nbytes = self.block_meta.get(blk, (None, 0))[1] or 0
+                    self._add_location(blk, node_id, 'storage', nbytes=nbytes)
+                    self._persist_q.put((persist_placement, (blk, node_id, nbytes)))
+                self._check_replication(blk)
+            return
+        with self._cond:
+            key = (msg.get('job_id'), blk)
+            entry = self.running.get(key)
+            if entry is None or entry[0] != node_id:
+                # báo cáo muộn của 1 lần assign cũ (block đã được giao lại)
+                return
+            del self.running[key]
+            missing = []
+            if msg.get('role') == 'leader':
+                job = self.jobs.get(key[0])
+                nbytes, crc = job.blocks.get(blk, (0, None)) if job is not None else (0, None)
+                replicas = set(msg.get('replicas') or ())
+                stored = {nd: int(i) for nd, i in (msg.get('fragments') or {}).items()}
+                followers = [nd for nd in entry[1] if nd is not None]
+                if job is not None and (ok or replicas or stored):
+                    # block đã có bản trên DataNode → từ giờ phải giữ đủ job.replication bản
+                    self.block_meta[blk] = (job.file_base, nbytes, crc, job.replication, job.erasure)
+                for nd in replicas:
+                    self._add_location(blk, nd, 'storage', nbytes=nbytes)
+                for nd, index in stored.items():
+                    self._add_fragment(blk, nd, index, _fragment_bytes(nbytes))
+                    self._persist_q.put((persist_placement, (blk, nd, _fragment_bytes(nbytes),
+                                                             EC_DIRS[index])))
+                if ok:
+                    # leader chạy thẳng trên replica storage thì giữ 'storage'
+                    self._add_location(blk, node_id, 'task', replace=False, nbytes=nbytes)
+                if ok and not (job is not None and job.erasure):
+                    missing = [nd for nd in followers if nd not in replicas and nd in self.slots]
+                    fallback_sources = self._block_sources(blk, exclude=missing)
+                    fallback_meta = self.block_meta.get(blk)
+                else:
+                    for nd in ([] if ok else [node_id]) + followers:
+                        if nd not in replicas and nd not in stored:
+                            self._release(blk, nd)
+                if not missing:
+                    self._check_replication(blk)
+            if self.busy.get(node_id):
+                self.busy[node_id] -= 1
+            job = self.jobs.get(key[0])
+            if job is not None and node_id in self.inflight:
+                self.inflight[node_id] -= job.blocks.get(blk, (0,))[0] or 0
+            is_reduce = job is not None and blk in job.reduce_tasks
+            if ok:
+                status = 'done'
+                self.attempts.pop(key, None)
+                if job is not None:
+                    if is_reduce:
+                        job.reduce_done += 1
+                    else:
+                        job.done += 1
+                        if job.partitions:
+                            job.map_outputs[blk] = node_id
+            else:
+                n = self.attempts[key] = self.attempts.get(key, 0) + 1
+                status = 'pending' if n < MAX_TASK_ATTEMPTS else 'failed'
+                print(f"[Scheduler] {blk} failed on {node_id} (attempt {n}): {msg.get('error')}")
+                if job is not None:
+                    if status == 'pending':
+                        job.pending.appendleft(blk)
+                        job.dispatched -= 1
+                    elif is_reduce:
+                        job.reduce_failed += 1
+                    else:
+                        job.failed += 1
+            if job is not None:
+                self._maybe_start_reduce(job)
+                job.update_state()
+                self._maybe_finalize(job)
+                if job.state in ('merging', 'failed'):
+                    print(f"[Scheduler] Job {job.job_id} {job.state}: "
+                          f"{job.done}/{job.total} blocks done, {job.failed} failed, "
+                          f"locality {job.locality} (hit rate {job.locality_hit_rate()})"
+                          + (f", {job.reduce_done}/{job.partitions} partitions reduced"
+                             if job.partitions else ""))
+            if not is_reduce:
+                self._persist_q.put((persist_completion, (
+                    blk, node_id, status, msg.get('duration'),
+                    msg.get('result') if ok else msg.get('error'))))
+            self._cond.notify_all()
+        if missing and fallback_meta is not None:
+            print(f"[Scheduler] Chain replication of {blk} incomplete "
+                  f"({msg.get('replication_error')}); storage task → {missing}")
+            self._send_replicas(blk, fallback_meta, missing, fallback_sources, key[0])
+
+    # ─── Final merge ─────────────────────────────────────────────────────────
+
+    def _maybe_finalize(self, job: Job):
+        """Mọi task của job đã xong → gộp kết quả trên upload server (thread nền)."""
+        if job.state != 'merging' or job.finalizing:
+            return
+        job.finalizing = True
+        threading.Thread(target=self._finalize_job, args=(job,), daemon=True).start()
+
+    def _finalize_job(self, job: Job):
+        try:
+            resp = finalize_job_results(job.file_base, job.job_id, job.spec)
+        except Exception as e:
+            resp = {'status': 'error', 'error': str(e)}
+        with self._cond:
+            if resp.get('status') == 'ok':
+                job.finalized = True
+                job.result = resp.get('result')
+                job.update_state()
+                print(f"[Scheduler] Job {job.job_id} done: {resp.get('rows')} row(s) → {job.result}")
+            else:
+                job.state = 'failed'
+                job.error = f"finalize: {resp.get('error')}"
+                print(f"[Scheduler] Job {job.job_id} failed to merge results: {resp.get('error')}")
+
+    # ─── Persist ─────────────────────────────────────────────────────────────
+
+    def _persist_loop(self):
+        """Ghi tuần tự các thay đổi xuống Postgres; lỗi DB không chặn việc lập lịch."""
+        while True:
+            fn, args = self._persist_q.get()
+            try:
+                fn(*args)
+            except Exception as e:
+                print(f"[Scheduler] Persist {fn.__name__}{args} lỗi: {e}")
+
+
+scheduler = Scheduler()
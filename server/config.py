@@ -2,7 +2,7 @@ SUPERUSER = 'postgres'
 SUPERUSER_PW = '12345'
 
 DB = {
-    'dbname':   'postgres',       # ban đầu kết nối để tạo DB
+    'dbname':   'postgres',       # database chứa schema catalog + active_node_manager
     'user':     SUPERUSER,
     'password': SUPERUSER_PW,
     'host':     'localhost',
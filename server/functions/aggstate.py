@@ -0,0 +1,68 @@
+# aggstate.py
+# Định dạng trạng thái từng phần của aggregate trong file kết quả block / partition:
+# DataNode (engine.py) ghi và gộp khi combine / reduce shuffle, upload server
+# (functions/reduce.py) merge k-way và finalize. Mỗi aggregate chiếm 1 cột CSV,
+# riêng avg chiếm 2 cột (sum, count) để gộp được giữa các block.
+# File này có bản sao giống hệt ở datanode_server/ và server/functions/ (mỗi thành phần
+# chạy độc lập từ thư mục của mình): sửa mọi bản cùng lúc, tests/test_shared_modules.py
+# kiểm tra các bản giống nhau.
+
+
+def label(agg: dict) -> str:
+    return f"{agg['op']}({agg.get('column') or '*'})"
+
+
+def state_columns(agg: dict) -> list[str]:
+    """Tên cột của trạng thái từng phần 1 aggregate trong file kết quả."""
+    if agg['op'] == 'avg':
+        return [f"{label(agg)}.sum", f"{label(agg)}.count"]
+    return [label(agg)]
+
+
+def init_state(op: str):
+    if op == 'count':
+        return 0
+    if op == 'sum':
+        return 0.0
+    if op == 'avg':
+        return [0.0, 0]
+    return None     # min / max
+
+
+def merge_state(op: str, acc, part):
+    """Gộp trạng thái từng phần `part` vào `acc`; trả về acc mới."""
+    if op in ('count', 'sum'):
+        return acc + part
+    if op == 'avg':
+        acc[0] += part[0]
+        acc[1] += part[1]
+        return acc
+    if part is None:
+        return acc
+    if acc is None:
+        return part
+    return min(acc, part) if op == 'min' else max(acc, part)
+
+
+def parse_state(op: str, cells: list):
+    """Đọc trạng thái từng phần từ các ô CSV (ngược với state_cells)."""
+    if op == 'count':
+        return int(float(cells[0] or 0))
+    if op == 'sum':
+        return float(cells[0] or 0)
+    if op == 'avg':
+        return [float(cells[0] or 0), int(float(cells[1] or 0))]
+    return float(cells[0]) if cells[0] != '' else None
+
+
+def state_cells(op: str, acc) -> list:
+    if op == 'avg':
+        return list(acc)
+    return ['' if acc is None else acc]
+
+
+def final_value(op: str, acc):
+    """Giá trị cuối của aggregate (avg = sum / count), ghi vào kết quả job."""
+    if op == 'avg':
+        return acc[0] / acc[1] if acc[1] else ''
+    return '' if acc is None else acc
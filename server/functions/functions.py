@@ -1,30 +1,197 @@
+import bz2
+import gzip
+import json
+import lzma
 import os
-import psycopg2
-from psycopg2 import sql, errors
+import mmap
+import threading
+import zlib
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+
+from psycopg2 import pool
+
+from config import DB
+from functions.catalog_ddl import CATALOG_DDL
+from functions.zonemap import ZoneMap
 
 
 
 #==========================================================================================================
 
-def split_csv_to_blocks(input_path: str, block_size: int =   10  * 1024 * 1024) -> int:
+def _find_block_ranges(mm, data_start: int, size: int, payload: int) -> list[tuple[int, int]]:
+    """
+    Cắt các mốc ứng viên tại data_start + k*payload, rồi dời mỗi mốc tới
+    sau ký tự xuống dòng kế tiếp để không block nào cắt ngang một dòng.
+    Trả về danh sách (start, end) theo byte offset trong file gốc.
+    """
+    cuts = [data_start]
+    for cand in range(data_start + payload, size, payload):
+        # Nếu byte ngay trước mốc đã là '\n' thì mốc giữ nguyên
+        nl = mm.find(b'\n', cand - 1)
+        cut = size if nl == -1 else nl + 1
+        if cut > cuts[-1]:
+            cuts.append(cut)
+    if cuts[-1] < size:
+        cuts.append(size)
+    return list(zip(cuts[:-1], cuts[1:]))
+
+
+# Codec nén block, chọn cho từng file lúc upload. Block lưu trên đĩa và gửi qua mạng ở dạng nén;
+# DataNode giải nén dạng stream khi compute. 'gzip' = zlib (deflate) trong container gzip.
+BLOCK_CODECS = {
+    'none': None,
+    'gzip': lambda f: gzip.GzipFile(fileobj=f, mode='wb', compresslevel=6, mtime=0),
+    'lzma': lambda f: lzma.LZMAFile(f, 'wb'),
+    'bz2':  lambda f: bz2.BZ2File(f, 'wb'),
+}
+DEFAULT_BLOCK_CODEC = 'none'
+
+# Số bản của mỗi block trên DataNode (leader + followers), chọn cho từng file lúc upload.
+# NameNode chép lại block từ replica còn sống khi số bản giảm dưới mức này (node chết, hỏng).
+DEFAULT_REPLICATION = 3
+MAX_REPLICATION = 10
+_CODEC_MAGIC = ((b'\x1f\x8b', gzip.open), (b'\xfd7zXZ\x00', lzma.open), (b'BZh', bz2.open))
+
+
+def open_block(path: str):
+    """Mở 1 file block ở chế độ text, tự giải nén theo magic bytes đầu file."""
+    with open(path, 'rb') as f:
+        head = f.read(6)
+    opener = next((op for magic, op in _CODEC_MAGIC if head.startswith(magic)), None)
+    if opener is None:
+        return open(path, 'r', encoding='utf-8', newline='')
+    return opener(path, 'rt', encoding='utf-8', newline='')
+
+
+class BlockManifest:
+    """
+    Tích lũy manifest của 1 block trong lúc ghi: số byte và số dòng dữ liệu chưa nén
+    (không tính header), đoạn byte [src_start, src_end) trong file gốc
+    và zone map (thống kê từng cột, xem zonemap.py).
+    """
+
+    def __init__(self, block_id: str, header: bytes, src_start: int):
+        self.block_id = block_id
+        self.bytes = len(header)
+        self.rows = 0
+        self.src_start = src_start
+        self.src_end = src_start
+        self.zone_map = ZoneMap(header)
+        self._last = b'\n'
+
+    def update(self, data: bytes):
+        if not data:
+            return
+        self.bytes += len(data)
+        self.rows += data.count(b'\n')
+        self.src_end += len(data)
+        self.zone_map.update(data)
+        self._last = data[-1:]
+
+    def to_dict(self) -> dict:
+        return {
+            'block_id': self.block_id,
+            'raw_bytes': self.bytes,
+            # dòng cuối file không có '\n' vẫn là 1 dòng
+            'rows': self.rows + (self._last != b'\n'),
+            'src_start': self.src_start,
+            'src_end': self.src_end,
+            'zone_map': self.zone_map.to_dict(),
+        }
+
+
+class _ChecksumSink:
+    """File đích đếm byte + CRC32 của dữ liệu thật sự ghi xuống đĩa (sau khi nén)."""
+
+    def __init__(self, f):
+        self._f = f
+        self.bytes = 0
+        self.crc32 = 0
+
+    def write(self, data) -> int:
+        self._f.write(data)
+        self.bytes += len(data)
+        self.crc32 = zlib.crc32(data, self.crc32)
+        return len(data)
+
+    def flush(self):
+        self._f.flush()
+
+
+class BlockWriter:
+    """
+    Ghi 1 file block: header + các dòng, nén theo codec, đồng thời tích lũy manifest.
+    bytes / crc32 của manifest là của file trên đĩa (đã nén) — đúng thứ DataNode tải về
+    và kiểm tra; raw_bytes / rows / zone_map là của dữ liệu CSV gốc.
+    """
+
+    def __init__(self, path: str, header: bytes, src_start: int, codec: str = DEFAULT_BLOCK_CODEC):
+        self.path = path
+        self.codec = codec
+        self.manifest = BlockManifest(os.path.basename(path), header, src_start)
+        self._file = open(path, 'wb')
+        self._sink = _ChecksumSink(self._file)
+        wrap = BLOCK_CODECS[codec]
+        self._out = wrap(self._sink) if wrap else self._sink
+        self._out.write(header)
+
+    def write(self, data: bytes):
+        self._out.write(data)
+        self.manifest.update(data)
+
+    def close(self) -> dict:
+        """Đóng file, trả về manifest hoàn chỉnh."""
+        if self._out is not self._sink:
+            self._out.close()       # ghi phần cuối của stream nén vào sink
+        self._file.close()
+        return dict(self.manifest.to_dict(),
+                    bytes=self._sink.bytes, crc32=self._sink.crc32, codec=self.codec)
+
+
+def _write_block_range(input_path: str, out_path: str, header: bytes,
+                       start: int, end: int, codec: str = DEFAULT_BLOCK_CODEC,
+                       chunk_size: int = 4 * 1024 * 1024) -> dict:
+    """
+    Ghi 1 block: header + đoạn byte [start, end) của file gốc, copy theo từng chunk lớn,
+    nén theo codec. Chạy trong process pool nên chỉ nhận tham số picklable.
+    Trả về manifest của block (BlockWriter.close()).
+    """
+    writer = BlockWriter(out_path, header, start, codec)
+    try:
+        with open(input_path, 'rb') as src:
+            src.seek(start)
+            remaining = end - start
+            while remaining > 0:
+                buf = src.read(min(chunk_size, remaining))
+                if not buf:
+                    break
+                writer.write(buf)
+                remaining -= len(buf)
+    finally:
+        manifest = writer.close()
+    return manifest
+
+
+def split_csv_to_blocks(input_path: str, block_size: int =   10  * 1024 * 1024,
+                        workers: int = None, codec: str = DEFAULT_BLOCK_CODEC) -> list[dict]:
     """
-    Split a CSV file into multiple blocks, each no larger than block_size bytes (including header).
+    Split a CSV file into multiple blocks of about block_size bytes (including header).
     - Các block sẽ được lưu trong thư mục 'blocks' nằm trong cùng thư mục chứa file gốc.
     - Mỗi block được đặt tên <basename>_block<N>.csv.
     - Mỗi block có header giống file gốc.
-    - Những dòng quá dài để nằm vừa block mới sẽ bị bỏ qua.
-    Trả về số lượng block đã tạo.
+    - File gốc được mmap, mốc cắt đặt tại bội số của block_size rồi dời tới cuối dòng,
+      nên 1 block có thể vượt block_size tối đa bằng độ dài 1 dòng.
+    - Các block được ghi song song bằng process pool (`workers`, mặc định = số CPU).
+    - codec: nén block trên đĩa ('none' | 'gzip' | 'lzma' | 'bz2', xem BLOCK_CODECS);
+      block_size tính theo dữ liệu chưa nén.
+    Trả về danh sách manifest theo thứ tự block: block_id, bytes, crc32 (file trên đĩa),
+    raw_bytes, rows, src_start, src_end, zone_map, codec.
     """
     base, ext = os.path.splitext(input_path)
     if ext.lower() != '.csv':
         print(f"[Warning] File '{input_path}' không có phần mở rộng .csv, vẫn tiếp tục…")
 
-    # Đọc header
-    with open(input_path, 'r', encoding='utf-8', newline='') as f:
-        header = f.readline()
-    header_bytes = header.encode('utf-8')
-    header_size = len(header_bytes)
-
     # Thư mục chứa file gốc, và blocks/
     container_dir = os.path.dirname(input_path)
     blocks_dir = os.path.join(container_dir, 'blocks')
@@ -32,149 +199,260 @@ def split_csv_to_blocks(input_path: str, block_size: int =   10  * 1024 * 1024)
 
     # Tên cơ bản để ghép block
     basename = os.path.basename(base)
-    block_num = 1
-    current_size = header_size
 
-    # Mở block đầu tiên và ghi header
-    out_path = os.path.join(blocks_dir, f"{basename}_block{block_num}.csv")
-    outfile = open(out_path, 'w', encoding='utf-8', newline='')
-    outfile.write(header)
+    size = os.path.getsize(input_path)
+    ranges = []
+    header = b''
+    if size > 0:
+        with open(input_path, 'rb') as f, \
+             mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            # Đọc header
+            nl = mm.find(b'\n')
+            data_start = size if nl == -1 else nl + 1
+            header = mm[:data_start]
+            payload = max(block_size - len(header), 1)
+            ranges = _find_block_ranges(mm, data_start, size, payload)
+
+    # File chỉ có header (hoặc rỗng) vẫn tạo 1 block chứa header như trước
+    if not ranges:
+        ranges = [(size, size)]
+
+    jobs = [
+        (input_path, os.path.join(blocks_dir, f"{basename}_block{i}.csv"), header, start, end, codec)
+        for i, (start, end) in enumerate(ranges, start=1)
+    ]
+    workers = min(workers or os.cpu_count() or 1, len(jobs))
+    if workers <= 1:
+        manifests = [_write_block_range(*job) for job in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as ex:
+            manifests = list(ex.map(_write_block_range, *zip(*jobs)))
+
+    print(f"Hoàn thành: tạo được {len(manifests)} block trong '{blocks_dir}'.")
+    return manifests
+
 
-    # Xử lý các dòng còn lại
-    with open(input_path, 'r', encoding='utf-8', newline='') as f:
-        next(f)
-        for lineno, line in enumerate(f, start=2):
-            line_bytes = line.encode('utf-8')
-            line_size = len(line_bytes)
 
-            if line_size > block_size - header_size:
-                print(f"[Warn] Dòng {lineno} ({line_size} bytes) quá dài, bỏ qua.")
-                continue
+#==========================================================================================================
+
+class StreamingBlockSplitter:
+    """
+    Cắt block trực tiếp từ stream upload (không lưu file gốc xuống đĩa).
+    - feed(data) nhận từng chunk byte theo thứ tự, close() khi hết stream.
+    - Layout giống split_csv_to_blocks: <blocks_dir>/<basename>_block<N>.csv, mỗi block có header.
+    - Block chỉ bị cắt tại cuối dòng; mỗi block hoàn tất sẽ gọi on_block(block_num, path, manifest)
+      ngay lập tức để đăng ký vào bảng block trong khi upload vẫn đang chạy.
+    - codec: nén block trên đĩa như split_csv_to_blocks.
+    """
 
-            if current_size + line_size > block_size:
-                outfile.close()
-                block_num += 1
-                current_size = header_size
-                out_path = os.path.join(blocks_dir, f"{basename}_block{block_num}.csv")
-                outfile = open(out_path, 'w', encoding='utf-8', newline='')
-                outfile.write(header)
+    def __init__(self, blocks_dir: str, basename: str,
+                 block_size: int = 10 * 1024 * 1024, on_block=None,
+                 codec: str = DEFAULT_BLOCK_CODEC):
+        self.blocks_dir = blocks_dir
+        self.basename = basename
+        self.block_size = block_size
+        self.on_block = on_block
+        self.codec = codec
+        os.makedirs(blocks_dir, exist_ok=True)
 
-            outfile.write(line)
-            current_size += line_size
+        self.header = None
+        self._tail = b''          # dòng chưa kết thúc ở cuối chunk trước
+        self._out = None          # BlockWriter của block đang ghi
+        self._out_path = None
+        self._current_size = 0
+        self._src_pos = 0         # offset trong stream gốc của byte kế tiếp được ghi
+        self.block_num = 0
+        self.manifests = []
 
-    outfile.close()
-    print(f"Hoàn thành: tạo được {block_num} block trong '{blocks_dir}'.")
-    return block_num
+    def _open_block(self):
+        self.block_num += 1
+        self._out_path = os.path.join(self.blocks_dir, f"{self.basename}_block{self.block_num}.csv")
+        self._out = BlockWriter(self._out_path, self.header, self._src_pos, self.codec)
+        self._current_size = len(self.header)
+
+    def _finish_block(self):
+        manifest = self._out.close()
+        self._out = None
+        self.manifests.append(manifest)
+        if self.on_block:
+            self.on_block(self.block_num, self._out_path, manifest)
+
+    def _write_lines(self, data: bytes):
+        """Ghi các dòng hoàn chỉnh vào block hiện tại, sang block mới khi đầy."""
+        while data:
+            if self._out is None:
+                self._open_block()
+            room = max(self.block_size - self._current_size, 1)
+            if len(data) <= room:
+                cut = len(data)
+            else:
+                cut = data.rfind(b'\n', 0, room) + 1
+                if cut == 0:
+                    if self._current_size > len(self.header):
+                        # Block hiện tại đã có dữ liệu: đóng lại, dòng này sang block mới
+                        self._finish_block()
+                        continue
+                    # Dòng dài hơn cả block: ghi nguyên dòng vào block riêng
+                    cut = data.find(b'\n') + 1 or len(data)
+            self._out.write(data[:cut])
+            self._src_pos += cut
+            self._current_size += cut
+            data = data[cut:]
+            if self._current_size >= self.block_size:
+                self._finish_block()
+
+    def feed(self, data: bytes):
+        data = self._tail + data
+        if self.header is None:
+            nl = data.find(b'\n')
+            if nl == -1:
+                self._tail = data
+                return
+            self.header, data = data[:nl + 1], data[nl + 1:]
+            self._src_pos = len(self.header)
+        last_nl = data.rfind(b'\n')
+        self._tail = data[last_nl + 1:]
+        self._write_lines(data[:last_nl + 1])
+
+    def close(self) -> int:
+        """Ghi phần còn lại, đóng block cuối. Trả về số block đã tạo."""
+        if self.header is None:
+            self.header, self._tail = self._tail, b''
+            self._src_pos = len(self.header)
+        if self._tail:
+            self._write_lines(self._tail)
+            self._tail = b''
+        if self._out is None and self.block_num == 0:
+            # File chỉ có header vẫn tạo 1 block như split_csv_to_blocks
+            self._open_block()
+        if self._out is not None:
+            self._finish_block()
+        print(f"Hoàn thành: tạo được {self.block_num} block trong '{self.blocks_dir}'.")
+        return self.block_num
 
 
 
 #==========================================================================================================
+# Block catalog: 1 schema `catalog` dùng chung cho mọi file (thay cho 1 database / file).
+#   catalog.files      : 1 dòng / file upload, status 'uploading' | 'ready' | 'failed'
+#   catalog.blocks     : 1 dòng / block, index theo (file_base, status);
+#                        status 'pending' → 'processing' → 'done' | 'failed'
+#   catalog.placements : node nào đang giữ block nào, với role leader/storage và số byte
+#   catalog.node_storage: tổng block / byte mỗi node đang giữ (trigger trên placements)
+# DDL ở functions/catalog_ddl.py (NameNode có bản sao, cũng chạy lúc khởi động).
 
-def create_database_and_user(
-    db_name: str,
-    db_user: str,
-    db_password: str,
-    superuser: str = 'postgres',
-    super_password: str = None,
-    host: str = 'localhost',
-    port: int = 5432
-) -> None:
-    """
-    Tạo database và user mới trong PostgreSQL.
-
-    1. Kết nối tới database 'postgres' với quyền superuser.
-    2. Tạo database `db_name` nếu chưa tồn tại.
-    3. Tạo user `db_user` với password `db_password` nếu chưa tồn tại.
-    4. Gán toàn quyền trên `db_name` cho `db_user`.
-
-    Raises:
-        psycopg2.Error nếu có lỗi kết nối hoặc thực thi SQL.
-    """
-    # Kết nối với superuser
-    conn = psycopg2.connect(
-        dbname='postgres',
-        user=superuser,
-        password=super_password,
-        host=host,
-        port=port
-    )
-    conn.autocommit = True
-    cur = conn.cursor()
-
-    # 1. Tạo database
-    try:
-        cur.execute(
-            sql.SQL("CREATE DATABASE {};").format(sql.Identifier(db_name))
-        )
-        print(f"✔ Database '{db_name}' created.")
-    except errors.DuplicateDatabase:
-        print(f"Database '{db_name}' already exists, skipping.")
-    
-    # 2. Tạo user
+_catalog_pool = None
+_catalog_pool_lock = threading.Lock()
+
+
+def _get_catalog_pool():
+    """
+    Tạo (1 lần) ThreadedConnectionPool tới database chứa catalog và tạo schema nếu chưa có.
+    Flask xử lý request trên nhiều thread nên cần pool thread-safe.
+    """
+    global _catalog_pool
+    with _catalog_pool_lock:
+        if _catalog_pool is None:
+            p = pool.ThreadedConnectionPool(minconn=1, maxconn=10, **DB)
+            conn = p.getconn()
+            try:
+                conn.autocommit = True
+                with conn.cursor() as cur:
+                    cur.execute(CATALOG_DDL)
+            finally:
+                p.putconn(conn)
+            _catalog_pool = p
+    return _catalog_pool
+
+
+@contextmanager
+def catalog_conn():
+    """
+    Mượn 1 connection (autocommit) từ pool catalog, tự trả lại khi xong.
+    """
+    p = _get_catalog_pool()
+    conn = p.getconn()
     try:
-        cur.execute(
-            sql.SQL("CREATE USER {} WITH PASSWORD %s;").format(sql.Identifier(db_user)),
-            [db_password]
-        )
-        print(f"✔ User '{db_user}' created.")
-    except errors.DuplicateObject:
-        print(f" User '{db_user}' already exists, skipping.")
-
-    # 3. Gán quyền
-    cur.execute(
-        sql.SQL("GRANT ALL PRIVILEGES ON DATABASE {} TO {};").format(
-            sql.Identifier(db_name),
-            sql.Identifier(db_user)
-        )
-    )
-    print(f"✔ Granted all privileges on '{db_name}' to '{db_user}'.")
-
-    # Đóng kết nối
-    cur.close()
-    conn.close()
-
-
-def register_blocks_in_db(db_name: str, block_ids: list[str], db_user: str, db_password: str, host: str, port: int):
-    """
-    Kết nối tới database `db_name`, tạo table (tên = db_name.replace('.', '_')),
-    và insert tất cả block_ids với status='pending'.
-    """
-    import psycopg2
-    from psycopg2.extras import execute_values
-    from psycopg2 import sql
-
-    # Kết nối đến riêng database mới
-    conn = psycopg2.connect(
-        dbname=db_name,
-        user=db_user,
-        password=db_password,
-        host=host,
-        port=port
-    )
-    conn.autocommit = True
-    cur = conn.cursor()
-
-    tbl = db_name.replace('.', '_')
-    # 1) Tạo table nếu chưa có
-    cur.execute(f"""
-      CREATE TABLE IF NOT EXISTS "{tbl}" (
-        block_id TEXT PRIMARY KEY,
-        status    VARCHAR(10) NOT NULL DEFAULT 'pending',
-        leader    TEXT,
-        followers TEXT[]
-      );
-    """)
-
-    # 2) Insert các block
-    rows = [(bid, 'pending', None, []) for bid in block_ids]
-    execute_values(cur,
-      f"""
-      INSERT INTO "{tbl}" (block_id, status, leader, followers)
-      VALUES %s
-      ON CONFLICT (block_id) DO NOTHING
-      """,
-      rows
-    )
-
-    cur.close()
-    conn.close()
+        conn.autocommit = True
+        yield conn
+    finally:
+        p.putconn(conn)
+
+
+def register_blocks_in_db(file_base: str, block_ids: list[str], file_status: str = None,
+                          manifests: list[dict] = None, codec: str = None,
+                          replication: int = None, erasure: bool = None):
+    """
+    Ghi file + các block_id (status='pending') vào catalog trong 1 round trip.
+    - file_status: nếu có thì đặt status cho file (VD 'ready' sau khi split xong);
+      None thì giữ nguyên status hiện tại (dùng khi upload streaming đăng ký từng block).
+    - manifests: manifest của từng block (cùng thứ tự block_ids) do splitter trả về,
+      lưu vào các cột bytes/raw_bytes/rows/crc32/src_start/src_end/zone_map.
+    - codec: codec nén block của file (BLOCK_CODECS); None thì giữ nguyên.
+    - replication: số bản mỗi block của file (1..MAX_REPLICATION); None thì giữ nguyên.
+    - erasure: lưu block dạng fragment erasure-coded thay vì bản đầy đủ; None thì giữ nguyên.
+    Block đã tồn tại (upload lại cùng file) được reset về 'pending'.
+    """
+    block_nums = [int(bid.rsplit('_block', 1)[1].split('.', 1)[0]) for bid in block_ids]
+    manifests = manifests or [{} for _ in block_ids]
+    col = lambda k: [m.get(k) for m in manifests]
+    zone_maps = [json.dumps(m['zone_map']) if m.get('zone_map') is not None else None
+                 for m in manifests]
+    with catalog_conn() as conn, conn.cursor() as cur:
+        cur.execute("""
+          WITH f AS (
+            INSERT INTO catalog.files (file_base, status, codec, replication, erasure)
+            VALUES (%(file)s, COALESCE(%(status)s, 'uploading'), COALESCE(%(codec)s, 'none'),
+                    COALESCE(%(replication)s, %(default_replication)s), COALESCE(%(erasure)s, false))
+            ON CONFLICT (file_base) DO UPDATE
+              SET status = COALESCE(%(status)s, catalog.files.status),
+                  codec  = COALESCE(%(codec)s, catalog.files.codec),
+                  replication = COALESCE(%(replication)s, catalog.files.replication),
+                  erasure = COALESCE(%(erasure)s, catalog.files.erasure)
+          )
+          INSERT INTO catalog.blocks (block_id, file_base, block_num, bytes, raw_bytes,
+                                      rows, crc32, src_start, src_end, zone_map)
+          SELECT b.block_id, %(file)s, b.block_num, b.bytes, b.raw_bytes,
+                 b.rows, b.crc32, b.src_start, b.src_end, b.zone_map::jsonb
+            FROM unnest(%(ids)s::text[], %(nums)s::int[],
+                        %(bytes)s::bigint[], %(raw)s::bigint[], %(rows)s::bigint[],
+                        %(crc)s::bigint[], %(start)s::bigint[], %(end)s::bigint[],
+                        %(zm)s::text[])
+                 AS b (block_id, block_num, bytes, raw_bytes, rows, crc32,
+                       src_start, src_end, zone_map)
+          ON CONFLICT (block_id) DO UPDATE
+            SET status = 'pending', leader = NULL, followers = '{}',
+                duration_s = NULL, result = NULL,
+                bytes = EXCLUDED.bytes, raw_bytes = EXCLUDED.raw_bytes,
+                rows = EXCLUDED.rows, crc32 = EXCLUDED.crc32,
+                src_start = EXCLUDED.src_start, src_end = EXCLUDED.src_end,
+                zone_map = EXCLUDED.zone_map
+        """, {'file': file_base, 'status': file_status, 'codec': codec,
+              'replication': replication, 'default_replication': DEFAULT_REPLICATION,
+              'erasure': erasure,
+              'ids': block_ids, 'nums': block_nums,
+              'bytes': col('bytes'), 'raw': col('raw_bytes'), 'rows': col('rows'), 'crc': col('crc32'),
+              'start': col('src_start'), 'end': col('src_end'), 'zm': zone_maps})
+
+
+def set_file_status(file_base: str, status: str):
+    """
+    Đặt status của file trong catalog:
+      - 'uploading': upload streaming đang chạy, block mới có thể còn được thêm vào
+      - 'ready'    : đã có đủ block
+      - 'failed'   : upload bị lỗi giữa chừng
+    NameNode dựa vào status này để biết có cần chờ thêm block khi compute hay không.
+    """
+    with catalog_conn() as conn, conn.cursor() as cur:
+        cur.execute("""
+          INSERT INTO catalog.files (file_base, status) VALUES (%s, %s)
+          ON CONFLICT (file_base) DO UPDATE SET status = EXCLUDED.status
+        """, (file_base, status))
+
+
+def delete_file_from_catalog(file_base: str):
+    """
+    Xóa file khỏi catalog; blocks và placements bị xóa theo (ON DELETE CASCADE).
+    """
+    with catalog_conn() as conn, conn.cursor() as cur:
+        cur.execute("DELETE FROM catalog.files WHERE file_base = %s", (file_base,))
@@ -0,0 +1,123 @@
+# jobspec.py
+# Job spec khai báo cho /compute: lọc gì, lấy cột nào, group theo gì, tính aggregate gì.
+# Spec được kiểm tra + chuẩn hóa 1 lần ở upload server rồi đi nguyên vẹn qua
+# NameNode tới từng task của DataNode (datanode_server/engine.py compile thành plan).
+#
+#   {
+#     "filters":    [{"column": "status", "op": "==", "value": "200"}],
+#     "columns":    ["host", "bytes"],
+#     "group_by":   ["host"],
+#     "aggregates": [{"op": "count"}, "sum(bytes)", {"op": "avg", "column": "bytes"}]
+#   }
+# Aggregate viết gọn dạng chuỗi "op(column)" hoặc "count(*)" cũng được chấp nhận.
+
+import re
+
+FILTER_OPS = ('==', '!=', '<', '<=', '>', '>=', 'in')
+AGG_OPS    = ('count', 'sum', 'min', 'max', 'avg')
+SPEC_KEYS  = ('filters', 'columns', 'group_by', 'aggregates')
+
+_AGG_SHORT = re.compile(r'^\s*(\w+)\s*\(\s*([^()]*?)\s*\)\s*$')
+
+
+class JobSpecError(ValueError):
+    """Job spec không hợp lệ; message trả thẳng cho client."""
+
+
+def _column(name, where: str) -> str:
+    if not isinstance(name, str) or not name:
+        raise JobSpecError(f"{where}: tên cột phải là chuỗi khác rỗng")
+    return name
+
+
+def _columns(value, where: str) -> list:
+    if value is None:
+        return []
+    if isinstance(value, str):
+        value = [value]
+    if not isinstance(value, list):
+        raise JobSpecError(f"{where}: phải là danh sách tên cột")
+    cols = [_column(c, where) for c in value]
+    if len(set(cols)) != len(cols):
+        raise JobSpecError(f"{where}: cột bị lặp")
+    return cols
+
+
+def _scalar(v) -> bool:
+    return isinstance(v, (str, int, float)) and not isinstance(v, bool)
+
+
+def _filter(f, i: int) -> dict:
+    where = f"filters[{i}]"
+    if not isinstance(f, dict):
+        raise JobSpecError(f"{where}: phải là object {{column, op, value}}")
+    op = f.get('op', '==')
+    if op not in FILTER_OPS:
+        raise JobSpecError(f"{where}: op '{op}' không hỗ trợ (chỉ {', '.join(FILTER_OPS)})")
+    value = f.get('value')
+    if op == 'in':
+        if not isinstance(value, list) or not value or not all(_scalar(v) for v in value):
+            raise JobSpecError(f"{where}: 'in' cần danh sách giá trị khác rỗng")
+    elif not _scalar(value):
+        raise JobSpecError(f"{where}: value phải là chuỗi hoặc số")
+    return {'column': _column(f.get('column'), where), 'op': op, 'value': value}
+
+
+def _aggregate(a, i: int) -> dict:
+    where = f"aggregates[{i}]"
+    if isinstance(a, str):
+        m = _AGG_SHORT.match(a)
+        if not m:
+            raise JobSpecError(f"{where}: '{a}' không đúng dạng op(column)")
+        a = {'op': m.group(1).lower(), 'column': None if m.group(2) in ('', '*') else m.group(2)}
+    if not isinstance(a, dict):
+        raise JobSpecError(f"{where}: phải là object {{op, column}} hoặc chuỗi op(column)")
+    op, col = a.get('op'), a.get('column')
+    if op not in AGG_OPS:
+        raise JobSpecError(f"{where}: aggregate '{op}' không hỗ trợ (chỉ {', '.join(AGG_OPS)})")
+    if col is None or col == '*':
+        if op != 'count':
+            raise JobSpecError(f"{where}: {op} cần tên cột")
+        return {'op': op}
+    return {'op': op, 'column': _column(col, where)}
+
+
+def validate_job_spec(spec, header: list = None):
+    """
+    Kiểm tra + chuẩn hóa job spec. Trả về dict chuẩn (chỉ các key có giá trị),
+    hoặc None nếu spec rỗng (DataNode dùng plan mặc định: đếm số dòng).
+    header: danh sách cột của file (nếu biết) để kiểm tra tên cột ngay từ đầu.
+    Raise JobSpecError nếu spec sai.
+    """
+    if spec is None or spec == {}:
+        return None
+    if not isinstance(spec, dict):
+        raise JobSpecError("spec phải là object JSON")
+    unknown = set(spec) - set(SPEC_KEYS)
+    if unknown:
+        raise JobSpecError(f"key không hỗ trợ: {', '.join(sorted(unknown))}")
+
+    filters = spec.get('filters') or []
+    aggregates = spec.get('aggregates') or []
+    if not isinstance(filters, list) or not isinstance(aggregates, list):
+        raise JobSpecError("filters / aggregates phải là danh sách")
+
+    out = {
+        'filters':    [_filter(f, i) for i, f in enumerate(filters)],
+        'columns':    _columns(spec.get('columns'), 'columns'),
+        'group_by':   _columns(spec.get('group_by'), 'group_by'),
+        'aggregates': [_aggregate(a, i) for i, a in enumerate(aggregates)],
+    }
+    if out['group_by'] and not out['aggregates']:
+        raise JobSpecError("group_by cần ít nhất 1 aggregate")
+    if out['columns'] and out['aggregates']:
+        raise JobSpecError("columns (projection) không dùng chung với aggregates")
+
+    if header is not None:
+        used = ([f['column'] for f in out['filters']] + out['columns'] + out['group_by']
+                + [a['column'] for a in out['aggregates'] if 'column' in a])
+        missing = sorted(set(used) - set(header))
+        if missing:
+            raise JobSpecError(f"cột không có trong file: {', '.join(missing)}")
+
+    return {k: v for k, v in out.items() if v} or None
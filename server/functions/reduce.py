@@ -0,0 +1,131 @@
+# reduce.py
+# Bước reduce cuối trên upload server: gộp các file kết quả của 1 job
+# (data/results/<file_base>/<job_id>/*) thành 1 file kết quả cuối.
+#   - job có aggregate: mỗi file là trạng thái từng phần đã sắp theo khóa group
+#     (datanode_server/engine.py, định dạng chung trong aggstate.py) → merge k-way bằng
+#     heap, gộp trạng thái cùng khóa, rồi finalize (avg = sum / count)
+#   - job projection: nối các file theo thứ tự block
+# Mỗi lượt merge mở tối đa MAX_FANIN file; nhiều file hơn thì merge thành file trung gian
+# rồi merge tiếp, nên bộ nhớ không phụ thuộc số block.
+
+import csv
+import heapq
+import itertools
+import os
+import re
+import shutil
+import tempfile
+
+from functions.aggstate import (final_value, init_state, label, merge_state, parse_state,
+                                state_cells, state_columns)
+
+MAX_FANIN = 64
+
+_BLOCK_NUM = re.compile(r'_block(\d+)\.csv$')
+
+
+def _block_order(name: str):
+    m = _BLOCK_NUM.search(name)
+    return (int(m.group(1)) if m else 0, name)
+
+
+# ─── Merge ───────────────────────────────────────────────────────────────────
+
+def _merge_states(paths: list, spec: dict, out_path: str, final: bool) -> int:
+    """
+    1 lượt merge k-way các file trạng thái từng phần (mỗi file sắp theo khóa group).
+    final=True: ghi giá trị cuối thay vì trạng thái. Trả về số nhóm.
+    """
+    group_by = spec.get('group_by') or []
+    aggs = spec['aggregates']
+    ngroup = len(group_by)
+    files = [open(p, 'r', encoding='utf-8', newline='') for p in paths]
+    try:
+        readers = []
+        for f in files:
+            r = csv.reader(f)
+            next(r, None)       # header
+            readers.append(r)
+        merged = heapq.merge(*readers, key=lambda row: row[:ngroup])
+        with open(out_path, 'w', encoding='utf-8', newline='') as out:
+            writer = csv.writer(out)
+            if final:
+                writer.writerow(group_by + [label(a) for a in aggs])
+            else:
+                writer.writerow(group_by + [c for a in aggs for c in state_columns(a)])
+            nrows = 0
+            for key, rows in itertools.groupby(merged, key=lambda row: row[:ngroup]):
+                accs = [init_state(a['op']) for a in aggs]
+                for row in rows:
+                    i = ngroup
+                    for j, a in enumerate(aggs):
+                        w = len(state_columns(a))
+                        accs[j] = merge_state(a['op'], accs[j], parse_state(a['op'], row[i:i + w]))
+                        i += w
+                if final:
+                    writer.writerow(key + [final_value(a['op'], acc) for a, acc in zip(aggs, accs)])
+                else:
+                    writer.writerow(key + [c for a, acc in zip(aggs, accs) for c in state_cells(a['op'], acc)])
+                nrows += 1
+            if nrows == 0 and not group_by:
+                # aggregate toàn bộ file mà không có dòng nào vẫn trả về 1 dòng
+                accs = [init_state(a['op']) for a in aggs]
+                if final:
+                    writer.writerow([final_value(a['op'], acc) for a, acc in zip(aggs, accs)])
+                else:
+                    writer.writerow([c for a, acc in zip(aggs, accs) for c in state_cells(a['op'], acc)])
+                nrows = 1
+        return nrows
+    finally:
+        for f in files:
+            f.close()
+
+
+def _concat(paths: list, out_path: str) -> int:
+    """Nối các file projection (bỏ header lặp lại), stream từng file."""
+    nrows = 0
+    with open(out_path, 'w', encoding='utf-8', newline='') as out:
+        writer = csv.writer(out)
+        header_written = False
+        for p in paths:
+            with open(p, 'r', encoding='utf-8', newline='') as f:
+                reader = csv.reader(f)
+                header = next(reader, None)
+                if header is None:
+                    continue
+                if not header_written:
+                    writer.writerow(header)
+                    header_written = True
+                for row in reader:
+                    writer.writerow(row)
+                    nrows += 1
+    return nrows
+
+
+def merge_job_results(result_dir: str, spec: dict, out_path: str) -> int:
+    """
+    Gộp mọi file kết quả trong result_dir thành out_path.
+    spec: job spec đã chuẩn hóa (None = plan mặc định đếm số dòng).
+    Trả về số dòng kết quả.
+    """
+    spec = spec or {'aggregates': [{'op': 'count'}]}
+    names = os.listdir(result_dir) if os.path.isdir(result_dir) else []
+    names = sorted((n for n in names if n.endswith('.csv')), key=_block_order)
+    paths = [os.path.join(result_dir, n) for n in names]
+    if not spec.get('aggregates'):
+        return _concat(paths, out_path)
+
+    tmp_dir = tempfile.mkdtemp(prefix='merge-', dir=os.path.dirname(out_path) or '.')
+    try:
+        level = 0
+        while len(paths) > MAX_FANIN:
+            # merge trung gian: mỗi nhóm MAX_FANIN file → 1 file trạng thái từng phần
+            merged = []
+            for i in range(0, len(paths), MAX_FANIN):
+                p = os.path.join(tmp_dir, f"l{level}_{i // MAX_FANIN}.csv")
+                _merge_states(paths[i:i + MAX_FANIN], spec, p, final=False)
+                merged.append(p)
+            paths, level = merged, level + 1
+        return _merge_states(paths, spec, out_path, final=True)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
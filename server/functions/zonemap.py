@@ -0,0 +1,112 @@
+# zonemap.py
+# Zone map của 1 block: thống kê từng cột, ghi cùng manifest khi splitter cắt block.
+#   min / max   : giá trị nhỏ / lớn nhất theo so sánh chuỗi (kể cả ô rỗng)
+#   nmin / nmax : nhỏ / lớn nhất trong các ô parse được thành số (None nếu không có)
+#   nulls       : số ô rỗng
+#   ndv / kmv   : ước lượng số giá trị phân biệt bằng sketch K-minimum-values
+#                 (KMV_K hash crc32 nhỏ nhất; sketch của nhiều block gộp được)
+# NameNode dùng min/max để bỏ qua block không thể khớp filter của job
+# (cùng ngữ nghĩa so sánh với datanode_server/engine.py).
+
+import csv
+import heapq
+import io
+import zlib
+
+KMV_K = 32
+_HASH_SPACE = 2 ** 32
+
+
+def _to_float(v: str):
+    try:
+        x = float(v)
+    except ValueError:
+        return None
+    return x if x == x else None     # bỏ NaN
+
+
+class ColumnStats:
+    __slots__ = ('smin', 'smax', 'nmin', 'nmax', 'nulls', 'kmv')
+
+    def __init__(self):
+        self.smin = self.smax = None
+        self.nmin = self.nmax = None
+        self.nulls = 0
+        self.kmv = []           # KMV_K hash crc32 nhỏ nhất (đã sắp xếp) của các giá trị khác rỗng
+
+    def add_many(self, values):
+        """Cập nhật với cả 1 cột của 1 batch dòng (min/max/count chạy ở tốc độ C)."""
+        if not values:
+            return
+        lo, hi = min(values), max(values)
+        self.smin = lo if self.smin is None else min(self.smin, lo)
+        self.smax = hi if self.smax is None else max(self.smax, hi)
+        distinct = set(values)
+        if '' in distinct:
+            self.nulls += values.count('')
+            distinct.discard('')
+        if not distinct:
+            return
+        try:
+            nums = list(map(float, distinct))
+        except ValueError:
+            nums = [x for x in map(_to_float, distinct) if x is not None]
+        nums = [x for x in nums if x == x]
+        if nums:
+            lo, hi = min(nums), max(nums)
+            self.nmin = lo if self.nmin is None else min(self.nmin, lo)
+            self.nmax = hi if self.nmax is None else max(self.nmax, hi)
+        hashes = {zlib.crc32(v.encode('utf-8')) for v in distinct}
+        self.kmv = heapq.nsmallest(KMV_K, hashes.union(self.kmv))
+
+    def ndv(self) -> int:
+        """Ước lượng số giá trị phân biệt (chính xác nếu < KMV_K)."""
+        if len(self.kmv) < KMV_K:
+            return len(self.kmv)
+        return int((KMV_K - 1) * _HASH_SPACE / (self.kmv[-1] + 1))
+
+    def to_dict(self) -> dict:
+        return {
+            'min': self.smin, 'max': self.smax,
+            'nmin': self.nmin, 'nmax': self.nmax,
+            'nulls': self.nulls,
+            'ndv': self.ndv(),
+            'kmv': self.kmv,
+        }
+
+
+class ZoneMap:
+    """
+    Thống kê các cột của 1 block, cập nhật theo từng đoạn byte của block
+    (đoạn có thể cắt giữa dòng; phần dòng dở được giữ lại tới lần update sau).
+    """
+
+    def __init__(self, header: bytes):
+        row = next(csv.reader([header.decode('utf-8', errors='replace').rstrip('\r\n')]), [])
+        self.columns = row
+        self.stats = [ColumnStats() for _ in row]
+        self._tail = b''
+
+    def update(self, data: bytes):
+        if not self.columns:
+            return
+        data = self._tail + data
+        last_nl = data.rfind(b'\n')
+        self._tail = data[last_nl + 1:]
+        self._add_lines(data[:last_nl + 1])
+
+    def _add_lines(self, data: bytes):
+        if not data:
+            return
+        ncols = len(self.columns)
+        text = io.StringIO(data.decode('utf-8', errors='replace'), newline='')
+        # engine cũng bỏ qua dòng sai số cột
+        rows = [row for row in csv.reader(text) if len(row) == ncols]
+        for st, col in zip(self.stats, zip(*rows)):
+            st.add_many(col)
+
+    def to_dict(self) -> dict:
+        if self._tail:
+            self._add_lines(self._tail)
+            self._tail = b''
+        return {name: st.to_dict() for name, st in zip(self.columns, self.stats)}
@@ -1,32 +1,41 @@
 # upload_server.py
 
+import csv
 import os
 import shutil
 import socket
-import json
 from flask import Flask, request, render_template_string, jsonify, send_from_directory
 from werkzeug.utils import secure_filename
 from flask import send_from_directory
 
 from functions.functions import (
     split_csv_to_blocks,
-    create_database_and_user,
-    register_blocks_in_db
+    StreamingBlockSplitter,
+    register_blocks_in_db,
+    BLOCK_CODECS,
+    DEFAULT_BLOCK_CODEC,
+    DEFAULT_REPLICATION,
+    MAX_REPLICATION,
+    open_block,
+    set_file_status,
+    delete_file_from_catalog
 )
-from config import DB, SUPERUSER, SUPERUSER_PW, NAMENODE_HOST, NAMENODE_PORT
-
-import psycopg2
-from psycopg2 import sql
+from functions.framing import send_frame, recv_frame
+from functions.jobspec import validate_job_spec, JobSpecError
+from functions.reduce import merge_job_results
+from config import NAMENODE_HOST, NAMENODE_PORT
 
 app = Flask(__name__)
 
 # ─────────── Thiết lập thư mục upload ───────────
 BASE_DIR    = os.path.dirname(os.path.abspath(__file__))
 UPLOAD_ROOT = os.path.join(BASE_DIR, 'data', 'uploads')
+RESULTS_ROOT = os.path.join(BASE_DIR, 'data', 'results')   # kết quả DataNode gửi lên + kết quả cuối
 os.makedirs(UPLOAD_ROOT, exist_ok=True)
 # ──────────────────────────────────────────────────
 
 ALLOWED_EXT = {'csv', 'json'}
+STREAM_CHUNK = 1024 * 1024   # byte đọc mỗi lần từ request stream
 
 def allowed(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXT
@@ -90,7 +99,7 @@ HTML = '''
     }
 
     function deleteFile(name){
-      if(!confirm(`Xóa file và database "${name}" ?`)) return;
+      if(!confirm(`Xóa file "${name}" ?`)) return;
       fetch('/delete?file='+encodeURIComponent(name), {method:'DELETE'})
         .then(r=>r.json()).then(res=>{
           alert(res.status==='ok'
@@ -108,7 +117,7 @@ HTML = '''
       })
       .then(r=>r.json()).then(res=>{
         if(res.status==='ok')
-          alert(`Compute "${name}" gửi NameNode thành công`);
+          alert(`Compute "${name}" đã vào hàng đợi: ${res.job_id}`);
         else
           alert(`Compute lỗi: ${res.error}`);
       });
@@ -128,8 +137,12 @@ HTML = '''
           <div class="progress"><div class="progress-bar" id="bar${i}"></div></div>`;
         prog.appendChild(wrapper);
 
+        // CSV: gửi raw body để server cắt block ngay trong lúc upload
+        const streaming = file.name.toLowerCase().endsWith('.csv');
         const xhr=new XMLHttpRequest();
-        xhr.open('POST','/upload',true);
+        xhr.open('POST', streaming
+          ? '/upload_stream?file='+encodeURIComponent(file.name)
+          : '/upload', true);
         xhr.upload.onprogress = e => {
           if(e.lengthComputable){
             document.getElementById(`bar${i}`)
@@ -138,7 +151,8 @@ HTML = '''
         };
         xhr.onload = ()=>{
           if(xhr.status===200){
-            const res=JSON.parse(xhr.responseText);
+            const body=JSON.parse(xhr.responseText);
+            const res=Array.isArray(body) ? body : [body];
             res.forEach(r=>{
               msg.innerHTML += `<p>${r.status==='success'
                 ? `Upload ${r.filename} thành công`
@@ -149,7 +163,12 @@ HTML = '''
             msg.innerHTML += `<p>Lỗi khi upload ${file.name}</p>`;
           }
         };
-        xhr.send(form);
+        if(streaming){
+          xhr.setRequestHeader('Content-Type','application/octet-stream');
+          xhr.send(file);
+        } else {
+          xhr.send(form);
+        }
       }
     };
   </script>
@@ -165,9 +184,34 @@ def index():
     return render_template_string(HTML, uploads=uploads)
 
 # --- upload như trước ---
+def _requested_codec():
+    """Codec nén block (?codec= hoặc field form 'codec'); None nếu không hợp lệ."""
+    codec = (request.values.get('codec') or DEFAULT_BLOCK_CODEC).lower()
+    codec = {'zlib': 'gzip'}.get(codec, codec)
+    return codec if codec in BLOCK_CODECS else None
+
+def _requested_replication():
+    """Số bản mỗi block (?replication= hoặc field form 'replication'); None nếu không hợp lệ."""
+    try:
+        n = int(request.values.get('replication') or DEFAULT_REPLICATION)
+    except ValueError:
+        return None
+    return n if 1 <= n <= MAX_REPLICATION else None
+
+def _requested_erasure() -> bool:
+    """?erasure=1 (hoặc field form): lưu block dạng fragment XOR 2+1 thay vì bản đầy đủ."""
+    return (request.values.get('erasure') or '').lower() in ('1', 'true', 'yes', 'on', 'xor')
+
 @app.route('/upload', methods=['POST'])
 def upload():
     files = request.files.getlist('files')
+    codec = _requested_codec()
+    if codec is None:
+        return jsonify({'status':'error','error':f"codec phải là một trong {sorted(BLOCK_CODECS)}"}),400
+    replication = _requested_replication()
+    if replication is None:
+        return jsonify({'status':'error','error':f"replication phải từ 1 tới {MAX_REPLICATION}"}),400
+    erasure = _requested_erasure()
     results=[]
     for f in files:
         name = secure_filename(f.filename)
@@ -181,26 +225,72 @@ def upload():
         except Exception as e:
             results.append({'filename':name,'status':'save_error','error':str(e),'blocks':0})
             continue
-        # tạo db + blocks + meta
+        # blocks + catalog
         db_name = os.path.splitext(name)[0]
         try:
-            create_database_and_user(db_name,DB['user'],DB['password'],
-                                     SUPERUSER, SUPERUSER_PW,
-                                     DB['host'],DB['port'])
-            n=0
+            manifests=[]
             if name.lower().endswith('.csv'):
-                n=split_csv_to_blocks(fp)
-                block_ids=[f"{db_name}_block{i}.csv" for i in range(1,n+1)]
-                register_blocks_in_db(db_name,block_ids,
-                                     DB['user'],DB['password'],
-                                     DB['host'],DB['port'])
+                manifests=split_csv_to_blocks(fp,codec=codec)
+            n=len(manifests)
+            block_ids=[m['block_id'] for m in manifests]
+            register_blocks_in_db(db_name,block_ids,file_status='ready',manifests=manifests,codec=codec,
+                                  replication=replication,erasure=erasure)
         except Exception as e:
             results.append({'filename':name,'status':'error','error':str(e),'blocks':0})
             continue
         results.append({'filename':name,'status':'success','blocks':n})
     return jsonify(results)
 
-# --- delete cả folder + drop database ---
+# --- upload streaming: cắt block trực tiếp từ request stream ---
+@app.route('/upload_stream', methods=['POST', 'PUT'])
+def upload_stream():
+    """
+    Nhận raw body của 1 file CSV (tên file qua ?file=...).
+    Block được cắt ngay khi dữ liệu tới và đăng ký vào bảng block từng cái một,
+    nên /compute có thể chạy trên các block đầu trong khi upload chưa xong.
+    File gốc không được lưu lại, chỉ còn thư mục blocks/.
+    ?codec=gzip|lzma|bz2 nén từng block trên đĩa (mặc định không nén).
+    ?replication=N số bản mỗi block trên DataNode (mặc định DEFAULT_REPLICATION).
+    ?erasure=1 lưu block dạng fragment erasure-coded XOR 2+1 (1.5x) thay vì replication.
+    """
+    name = secure_filename(request.args.get('file',''))
+    if not name or not allowed(name) or not name.lower().endswith('.csv'):
+        return jsonify({'filename':name or'unknown','status':'invalid','error':'không hợp lệ','blocks':0})
+    codec = _requested_codec()
+    if codec is None:
+        return jsonify({'filename':name,'status':'invalid','error':f"codec phải là một trong {sorted(BLOCK_CODECS)}",'blocks':0}),400
+    replication = _requested_replication()
+    if replication is None:
+        return jsonify({'filename':name,'status':'invalid','error':f"replication phải từ 1 tới {MAX_REPLICATION}",'blocks':0}),400
+    erasure = _requested_erasure()
+    dest = os.path.join(UPLOAD_ROOT,name)
+    os.makedirs(dest,exist_ok=True)
+    db_name = os.path.splitext(name)[0]
+    try:
+        set_file_status(db_name,'uploading')
+    except Exception as e:
+        return jsonify({'filename':name,'status':'error','error':str(e),'blocks':0})
+
+    def on_block(block_num, path, manifest):
+        register_blocks_in_db(db_name,[manifest['block_id']],manifests=[manifest],codec=codec,
+                              replication=replication,erasure=erasure)
+
+    splitter = StreamingBlockSplitter(os.path.join(dest,'blocks'), db_name, on_block=on_block, codec=codec)
+    try:
+        while True:
+            chunk = request.stream.read(STREAM_CHUNK)
+            if not chunk:
+                break
+            splitter.feed(chunk)
+        n = splitter.close()
+        set_file_status(db_name,'ready')
+    except Exception as e:
+        try: set_file_status(db_name,'failed')
+        except Exception: pass
+        return jsonify({'filename':name,'status':'error','error':str(e),'blocks':splitter.block_num})
+    return jsonify({'filename':name,'status':'success','blocks':n})
+
+# --- delete cả folder + xóa khỏi catalog ---
 @app.route('/delete', methods=['DELETE'])
 def delete():
     fn = secure_filename(request.args.get('file',''))
@@ -212,30 +302,32 @@ def delete():
             shutil.rmtree(folder)
         except Exception as e:
             return jsonify({'status':'error','error':str(e)}),500
-    # drop database
+    # xóa file + blocks khỏi catalog
     db_base = os.path.splitext(fn)[0]
     try:
-        conn = psycopg2.connect(dbname='postgres',
-                                user=SUPERUSER,
-                                password=SUPERUSER_PW,
-                                host=DB['host'],port=DB['port'])
-        conn.autocommit=True
-        cur=conn.cursor()
-        # terminate connections
-        cur.execute(sql.SQL("""
-            SELECT pg_terminate_backend(pid)
-              FROM pg_stat_activity
-             WHERE datname = %s
-        """),[db_base])
-        cur.execute(sql.SQL("DROP DATABASE IF EXISTS {};").format(
-                         sql.Identifier(db_base)))
-        cur.close(); conn.close()
+        delete_file_from_catalog(db_base)
     except Exception as e:
         return jsonify({'status':'error','error':str(e)}),500
 
     return jsonify({'status':'ok'})
 
-# --- compute: gửi yêu cầu đến NameNode qua socket TCP ---
+# --- header của file (dòng đầu block 1), None nếu chưa có block nào ---
+def read_file_header(fn: str):
+    db_base = os.path.splitext(fn)[0]
+    first = os.path.join(UPLOAD_ROOT, fn, 'blocks', f"{db_base}_block1.csv")
+    try:
+        with open_block(first) as f:
+            return next(csv.reader(f), None)
+    except OSError:
+        return None
+
+# --- gửi 1 message tới NameNode qua socket TCP, nhận về response ---
+def ask_namenode(msg: dict) -> dict:
+    with socket.create_connection((NAMENODE_HOST, NAMENODE_PORT)) as s:
+        send_frame(s, msg)
+        return recv_frame(s)
+
+# --- compute: NameNode xếp job vào hàng đợi và trả job_id ngay ---
 @app.route('/compute', methods=['POST'])
 def compute():
     data = request.get_json(force=True)
@@ -243,17 +335,39 @@ def compute():
     if not fn:
         return jsonify({'status':'error','error':'không có file'}),400
     db_base = os.path.splitext(fn)[0]
+    # job spec: kiểm tra 1 lần ở đây, NameNode/DataNode chỉ việc chạy
+    try:
+        spec = validate_job_spec(data.get('spec'), read_file_header(fn))
+    except JobSpecError as e:
+        return jsonify({'status':'error','error':f'spec không hợp lệ: {e}'}),400
+    # priority: số nguyên >= 1 (job priority 2 nhận gấp đôi slot của job priority 1)
     try:
-        s = socket.socket()
-        s.connect((NAMENODE_HOST, NAMENODE_PORT))
-        msg = {'type':'compute','file':db_base}
-        s.sendall(json.dumps(msg).encode())
-        resp = s.recv(1024)
-        s.close() 
+        priority = int(data.get('priority',1))
+    except (TypeError, ValueError):
+        priority = 0
+    if priority < 1:
+        return jsonify({'status':'error','error':f"priority không hợp lệ: {data.get('priority')!r}"}),400
+    try:
+        resp = ask_namenode({'type':'compute','file':db_base,
+                             'priority':priority,
+                             'spec':spec})
     except Exception as e:
         return jsonify({'status':'error','error':str(e)}),500
+    if not resp or resp.get('status') != 'ok':
+        return jsonify({'status':'error','error':(resp or {}).get('error','no response')}),500
 
-    return jsonify({'status':'ok','namenode':resp.decode()})
+    return jsonify({'status':'ok','job_id':resp['job_id'],'namenode':resp})
+
+# --- trạng thái job compute ---
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    try:
+        resp = ask_namenode({'type':'job_status','job_id':job_id})
+    except Exception as e:
+        return jsonify({'status':'error','error':str(e)}),500
+    if not resp or resp.get('status') != 'ok':
+        return jsonify({'status':'error','error':(resp or {}).get('error','no response')}),404
+    return jsonify(resp['job'])
 
 # --- Route phục vụ download block --from flask import send_from_directory
 
@@ -261,9 +375,12 @@ def compute():
 def download_block(filename, block_id):
     # filename: tên folder, VD: alogs.csv
     # blockfile: VD: alogs_block1.csv
+    # conditional=True: hỗ trợ Range / If-Range / ETag để DataNode tải tiếp phần còn thiếu
+    # Block của file có codec được gửi nguyên dạng nén như trên đĩa (không Content-Encoding,
+    # để Range tính theo byte đã nén); DataNode giải nén khi compute.
     blocks_dir = os.path.join(UPLOAD_ROOT, filename, 'blocks')
-    print (blocks_dir)
-    return send_from_directory(blocks_dir, block_id, as_attachment=True)
+    return send_from_directory(blocks_dir, block_id, as_attachment=True,
+                               conditional=True, etag=True)
 
 
 @app.route('/upload_block', methods=['POST'])
@@ -271,13 +388,17 @@ def upload_block():
     file = request.files.get('file')
     file_base = request.form.get('file_base')     # Ví dụ: 'alogs'
     block_id  = request.form.get('block_id')      # Ví dụ: 'alogs_block1.csv'
+    job_id    = request.form.get('job_id')        # Ví dụ: 'job-1f2e3d4c-3' (tùy chọn)
 
     if not file or not file_base or not block_id:
         return jsonify({"status": "error", "msg": "Missing parameters"}), 400
 
-    # ===> ĐƯỜNG DẪN MỚI: server/data/results/alogs/alogs_block1.csv
+    # ===> ĐƯỜNG DẪN MỚI: server/data/results/alogs[/job-1f2e3d4c-3]/alogs_block1.csv
+    # mỗi job 1 thư mục con để các job cùng file không ghi đè kết quả của nhau
     base_dir = os.path.dirname(os.path.abspath(__file__))
     results_dir = os.path.join(base_dir, "data", "results", file_base)
+    if job_id:
+        results_dir = os.path.join(results_dir, secure_filename(job_id))
     os.makedirs(results_dir, exist_ok=True)
     save_path = os.path.join(results_dir, block_id)
     file.save(save_path)
@@ -286,6 +407,63 @@ def upload_block():
 
 
 
+# --- NameNode gọi trước khi job chạy: xóa kết quả cũ cùng job_id ---
+@app.route('/prepare', methods=['POST'])
+def prepare():
+    """
+    Xóa data/results/<file_base>/<job_id>/ và <job_id>.csv còn sót lại, để /finalize
+    chỉ gộp kết quả block của job này (không lẫn kết quả / spec của lần chạy khác).
+    """
+    data = request.get_json(force=True)
+    file_base = secure_filename(data.get('file',''))
+    job_id = secure_filename(data.get('job_id',''))
+    if not file_base or not job_id:
+        return jsonify({'status':'error','error':'Missing parameters'}),400
+    results_dir = os.path.join(RESULTS_ROOT, file_base)
+    cleared = False
+    job_dir = os.path.join(results_dir, job_id)
+    if os.path.isdir(job_dir):
+        shutil.rmtree(job_dir)
+        cleared = True
+    out_path = os.path.join(results_dir, f"{job_id}.csv")
+    for path in (out_path, out_path + '.tmp'):
+        if os.path.exists(path):
+            os.remove(path)
+            cleared = True
+    return jsonify({'status':'ok','cleared':cleared})
+
+# --- reduce cuối: NameNode gọi khi block/partition cuối cùng của job đã xong ---
+@app.route('/finalize', methods=['POST'])
+def finalize():
+    """
+    Gộp data/results/<file_base>/<job_id>/* thành data/results/<file_base>/<job_id>.csv
+    (merge k-way, xem functions/reduce.py) rồi trả về URL tải kết quả.
+    """
+    data = request.get_json(force=True)
+    file_base = secure_filename(data.get('file',''))
+    job_id = secure_filename(data.get('job_id',''))
+    if not file_base or not job_id:
+        return jsonify({'status':'error','error':'Missing parameters'}),400
+    results_dir = os.path.join(RESULTS_ROOT, file_base)
+    os.makedirs(results_dir, exist_ok=True)
+    out_path = os.path.join(results_dir, f"{job_id}.csv")
+    tmp_path = out_path + '.tmp'
+    try:
+        rows = merge_job_results(os.path.join(results_dir, job_id), data.get('spec'), tmp_path)
+        os.replace(tmp_path, out_path)
+    except Exception as e:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return jsonify({'status':'error','error':str(e)}),500
+    return jsonify({'status':'ok','rows':rows,'result':f"/results/{file_base}/{job_id}"})
+
+# --- tải kết quả cuối của 1 job ---
+@app.route('/results/<file_base>/<job_id>')
+def download_result(file_base, job_id):
+    return send_from_directory(os.path.join(RESULTS_ROOT, secure_filename(file_base)),
+                               f"{secure_filename(job_id)}.csv", as_attachment=True)
+
+
 if __name__=='__main__':
     app.run(host='0.0.0.0', port=5000, debug=True)
 
@@ -0,0 +1,12 @@
+# conftest.py
+# Các thành phần import theo thư mục chạy của mình (datanode_server/: `import engine`,
+# server/: `import functions.reduce`), nên test thêm các thư mục đó vào sys.path.
+
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for sub in ('datanode_server', 'server'):
+    path = os.path.join(ROOT, sub)
+    if path not in sys.path:
+        sys.path.insert(0, path)
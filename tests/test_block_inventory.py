@@ -0,0 +1,39 @@
+import os
+
+import pytest
+
+pytest.importorskip('requests')
+
+from functions_datanode import BlockInventory, receive_replica
+
+
+def _write(path: str, data: bytes = b'host\na\n'):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def test_scan_skips_blocks_in_wrong_directory(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    _write(os.path.join('task', 'alogs', 'alogs_block1.csv'))
+    _write(os.path.join('task', 'alogs.csv', 'alogs_block2.csv'))
+    _write(os.path.join('storage', 'alogs', 'alogs_block3.csv.ec1'))
+    _write(os.path.join('storage', 'blogs', 'alogs_block4.csv'))
+    _write(os.path.join('storage', 'alogs', 'alogs_block5.csv.part'))
+    found = BlockInventory().scan()
+    assert sorted(found) == [('ec1', 'alogs_block3.csv'), ('task', 'alogs_block1.csv')]
+
+
+@pytest.mark.parametrize('msg', [
+    {'type': 'replicate', 'block_id': 'alogs_block1.csv'},
+    {'type': 'replicate', 'file': 'alogs', 'block_id': 'alogs_block1.csv', 'fragment': 'x'},
+    {'type': 'replicate', 'file': 'alogs', 'block_id': 'alogs_block1.csv', 'fragment': 7},
+    {'type': 'replicate', 'file': '..', 'block_id': 'alogs_block1.csv'},
+    {'type': 'replicate', 'file': 'alogs', 'block_id': 'alogs_block1.csv', 'bytes': 'many'},
+])
+def test_malformed_replicate_gets_error_ack(tmp_path, monkeypatch, msg):
+    monkeypatch.chdir(tmp_path)
+    reply = receive_replica(None, msg)
+    assert reply['type'] == 'replicated' and reply['status'] == 'error'
+    assert not os.path.exists('storage')
+
@@ -0,0 +1,60 @@
+import csv
+
+import pytest
+
+import engine
+
+ROWS = [('host', 'status', 'bytes'),
+        ('a', '404', '10'),
+        ('x', '404', ''),
+        ('b', '200', '5'),
+        ('', '200', '7')]
+
+
+@pytest.fixture(params=['numpy', 'python'])
+def kernel(request, monkeypatch):
+    """Chạy mỗi test trên cả kernel NumPy lẫn kernel Python thuần."""
+    if request.param == 'numpy':
+        if engine.np is None:
+            pytest.skip('NumPy not installed')
+    else:
+        monkeypatch.setattr(engine, 'np', None)
+    return request.param
+
+
+@pytest.fixture
+def block(tmp_path):
+    path = tmp_path / 'a_block1.csv'
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        csv.writer(f).writerows(ROWS)
+    return str(path)
+
+
+def _run(plan: dict, block: str, tmp_path, batch_rows: int = None, monkeypatch=None) -> list:
+    if batch_rows is not None:
+        defaults = engine.scan.__defaults__
+        monkeypatch.setattr(engine.scan, '__defaults__', (batch_rows,) + defaults[1:])
+    out = tmp_path / 'out.csv'
+    engine.compile_plan(plan).run(block, str(out))
+    with open(out, encoding='utf-8', newline='') as f:
+        return list(csv.reader(f))
+
+
+def test_count_column_counts_non_empty_strings(kernel, block, tmp_path):
+    rows = _run({'group_by': ['status'],
+                 'aggregates': [{'op': 'count', 'column': 'host'},
+                                {'op': 'count', 'column': 'bytes'},
+                                {'op': 'count'}]}, block, tmp_path)
+    assert rows == [['status', 'count(host)', 'count(bytes)', 'count(*)'],
+                    ['200', '1', '2', '2'],
+                    ['404', '2', '1', '2']]
+
+
+def test_projection_header_written_once(kernel, block, tmp_path, monkeypatch):
+    # batch 2 dòng: batch đầu (404) bị lọc hết, batch sau có dòng khớp
+    rows = _run({'columns': ['host'], 'filters': [{'column': 'status', 'op': '==', 'value': 200}]},
+                block, tmp_path, batch_rows=2, monkeypatch=monkeypatch)
+    assert rows == [['host'], ['b'], ['']]
+    rows = _run({'columns': ['host'], 'filters': [{'column': 'status', 'op': '==', 'value': 999}]},
+                block, tmp_path, batch_rows=2, monkeypatch=monkeypatch)
+    assert rows == [['host']]
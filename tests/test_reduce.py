@@ -0,0 +1,57 @@
+import csv
+import os
+import random
+
+import pytest
+
+import engine
+from functions import reduce
+
+SPEC = {'group_by': ['status'],
+        'aggregates': [{'op': 'count'}, {'op': 'count', 'column': 'host'},
+                       {'op': 'sum', 'column': 'bytes'}, {'op': 'avg', 'column': 'bytes'},
+                       {'op': 'min', 'column': 'bytes'}, {'op': 'max', 'column': 'bytes'}]}
+
+
+def _write_block(path, rows):
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['host', 'status', 'bytes'])
+        writer.writerows(rows)
+
+
+def _read(path):
+    with open(path, encoding='utf-8', newline='') as f:
+        return list(csv.reader(f))
+
+
+def test_merge_matches_single_block(tmp_path, monkeypatch):
+    # kết quả từng phần của engine, merge bởi reduce (nhiều lượt vì MAX_FANIN = 2),
+    # phải bằng aggregate trên toàn bộ dữ liệu trong 1 block
+    monkeypatch.setattr(reduce, 'MAX_FANIN', 2)
+    rnd = random.Random(7)
+    blocks = [[(rnd.choice(['a', 'b', '']), rnd.choice(['200', '404', '500']),
+                rnd.choice(['', str(rnd.randrange(1000))])) for _ in range(rnd.randrange(1, 30))]
+              for _ in range(5)]
+    pipeline = engine.compile_plan(SPEC)
+    results = tmp_path / 'results'
+    results.mkdir()
+    for n, rows in enumerate(blocks, 1):
+        _write_block(tmp_path / f"f_block{n}.csv", rows)
+        pipeline.run(str(tmp_path / f"f_block{n}.csv"), str(results / f"f_block{n}.csv"))
+    reduce.merge_job_results(str(results), SPEC, str(tmp_path / 'merged.csv'))
+
+    _write_block(tmp_path / 'all.csv', [r for rows in blocks for r in rows])
+    pipeline.run(str(tmp_path / 'all.csv'), str(tmp_path / 'all_states.csv'))
+    whole = tmp_path / 'whole'
+    whole.mkdir()
+    os.replace(tmp_path / 'all_states.csv', whole / 'f_block1.csv')
+    reduce.merge_job_results(str(whole), SPEC, str(tmp_path / 'expected.csv'))
+
+    merged, expected = _read(tmp_path / 'merged.csv'), _read(tmp_path / 'expected.csv')
+    assert merged[0] == expected[0]
+    assert len(merged) == len(expected)
+    for got, want in zip(merged[1:], expected[1:]):
+        assert got[:3] == want[:3]
+        assert [float(x or 'nan') for x in got[3:]] == pytest.approx(
+            [float(x or 'nan') for x in want[3:]], nan_ok=True)
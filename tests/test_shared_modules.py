@@ -0,0 +1,44 @@
+import filecmp
+import os
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# module dùng chung được chép giống hệt vào thư mục của từng thành phần
+# (mỗi thành phần chạy độc lập từ thư mục của mình, không import chéo)
+SHARED_MODULES = {
+    'aggstate.py':    ('datanode_server', 'server/functions'),
+    'catalog_ddl.py': ('namenode', 'server/functions'),
+    'framing.py':     ('datanode_server', 'namenode', 'server/functions'),
+}
+
+
+def _find_copies(name):
+    found = []
+    for dirpath, dirnames, filenames in os.walk(ROOT):
+        dirnames[:] = [d for d in dirnames if not d.startswith('.') and d != '__pycache__']
+        if name in filenames:
+            found.append(os.path.relpath(dirpath, ROOT).replace(os.sep, '/'))
+    return sorted(found)
+
+
+@pytest.mark.parametrize('name', sorted(SHARED_MODULES))
+def test_shared_module_copies_identical(name):
+    copies = [os.path.join(ROOT, d, name) for d in SHARED_MODULES[name]]
+    for other in copies[1:]:
+        assert filecmp.cmp(copies[0], other, shallow=False), f"{other} differs from {copies[0]}"
+
+
+@pytest.mark.parametrize('name', sorted(SHARED_MODULES))
+def test_no_unlisted_copies(name):
+    # bản mới chép vào thành phần khác phải được thêm vào SHARED_MODULES
+    assert _find_copies(name) == sorted(SHARED_MODULES[name])
+
+
+@pytest.mark.parametrize('name', sorted(SHARED_MODULES))
+def test_header_lists_every_copy(name):
+    with open(os.path.join(ROOT, SHARED_MODULES[name][0], name), encoding='utf-8') as f:
+        header = ''.join(line for line in f if line.startswith('#'))
+    for d in SHARED_MODULES[name]:
+        assert f"{d}/" in header